@@ -1,13 +1,18 @@
 import requests
 import json
+import time
+
+BASE_URL = 'http://localhost:8000'
+POLL_SECONDS = 0.5
+
 
 class CliClient:
     def prompt_user(self):
         origin = input("Input origin: ")
         destination = input("Input destination: ")
-        resp = self.make_request(origin, destination)
-        data = json.loads(resp.content)
-        self.pretty_print_data(data)
+        data = self.wait_for_job(self.submit_job(origin, destination))
+        if data is not None:
+            self.pretty_print_data(data)
 
     def pretty_print_data(self, data):
         print("###### Driving ######")
@@ -19,8 +24,13 @@ class CliClient:
         driving_distance = driving_data['distance_miles']
         print(f'{int(driving_hours)} hr {int(driving_minutes)} min ({int(driving_distance)} miles)')
         print(f'${round(driving_price, 2)}')
+        for stop in driving_data.get('overnight_stops', []):
+            print(f"  night near {stop['lat']:.2f},{stop['lng']:.2f}: ${stop['nightly_price']}")
         print("###### Flying ######")
         flying_data = data['flying']
+        if flying_data is None:
+            print("Couldn't find a way to fly this trip")
+            return
         flying_time = flying_data['total_info']['total_duration_minutes']
         flying_hours = flying_time // 60
         flying_minutes = flying_time % 60
@@ -28,13 +38,44 @@ class CliClient:
         flying_price = flying_data['total_info']['total_price']
         print(f'${round(flying_price, 2)}')
 
+    def print_leg(self, leg, result):
+        if leg == 'driving':
+            print(f"... driving: {int(result['distance_miles'])} miles, ${round(result['total_price'], 2)}")
+        elif leg in ('drive_to_airport', 'drive_from_airport'):
+            print(f"... {leg.replace('_', ' ')} {result['airport']}: {int(result['driving_duration_seconds'] / 60)} min")
+        elif leg == 'flight':
+            print(f"... flight {result['origin']} -> {result['destination']}: ${round(result['estimated_price'], 2)}")
+
     def make_request(self, origin, destination):
-        base_url = 'http://localhost:8000'
-        full_url = f'{base_url}/api/calculate'
+        full_url = f'{BASE_URL}/api/calculate'
         data = {'origin': origin, 'destination': destination}
         return requests.post(full_url, data=json.dumps(data), headers={'Content-type': 'application/json'})
 
+    def submit_job(self, origin, destination):
+        data = {'origin': origin, 'destination': destination}
+        resp = requests.post(f'{BASE_URL}/api/jobs', data=json.dumps(data), headers={'Content-type': 'application/json'})
+        resp.raise_for_status()
+        return json.loads(resp.content)['id']
+
+    def wait_for_job(self, job_id):
+        """
+        Poll the job, printing each leg as the server finishes it
+        """
+        shown = set()
+        while True:
+            job = json.loads(requests.get(f'{BASE_URL}/api/jobs/{job_id}').content)
+            for leg, result in job['partial'].items():
+                if leg not in shown:
+                    shown.add(leg)
+                    self.print_leg(leg, result)
+            if job['status'] == 'done':
+                return job['result']
+            if job['status'] == 'failed':
+                print(f"Calculation failed: {job['error']}")
+                return None
+            time.sleep(POLL_SECONDS)
+
 
 if __name__ == "__main__":
     client = CliClient()
-    client.prompt_user()
\ No newline at end of file
+    client.prompt_user()
@@ -0,0 +1,291 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import Future
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from .metrics import cache_collector, registry
+from .rate_limit import BULK, lane
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CACHE_PATH = os.path.join(BASE_DIR, '../cache.sqlite3')
+
+MISSING = object()
+
+
+class CacheStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = {}
+        self.misses = {}
+
+    def record(self, namespace, hit):
+        counter = self.hits if hit else self.misses
+        with self.lock:
+            counter[namespace] = counter.get(namespace, 0) + 1
+
+    def to_dict(self):
+        with self.lock:
+            namespaces = set(self.hits) | set(self.misses)
+            return {
+                ns: {'hits': self.hits.get(ns, 0), 'misses': self.misses.get(ns, 0)}
+                for ns in sorted(namespaces)
+            }
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls for the same key into one,
+    everyone waiting on it gets the same result (or exception)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.calls[key] = future
+        if not leader:
+            return future.result()
+
+        try:
+            future.set_result(fn())
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                del self.calls[key]
+        return future.result()
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight for coroutines. Calls are only shared within an event loop
+    """
+
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key, fn):
+        call_key = (id(asyncio.get_event_loop()), key)
+        task = self.calls.get(call_key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self.calls[call_key] = task
+            task.add_done_callback(lambda _: self.calls.pop(call_key, None))
+        # one waiter giving up shouldn't cancel the call for everyone else
+        return await asyncio.shield(task)
+
+
+class LRUCache:
+    """
+    Thread safe in-memory LRU with a per entry expiry
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key, MISSING)
+            if entry is MISSING:
+                return MISSING
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.time():
+                del self.entries[key]
+                return MISSING
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at=None):
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SqliteCache:
+    """
+    On-disk cache of json-serializable values, shared by every worker process on the box
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        self.con = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.con.execute('PRAGMA journal_mode=WAL;')
+            self.con.execute("""CREATE TABLE IF NOT EXISTS response_cache
+                                (key TEXT NOT NULL PRIMARY KEY, value TEXT NOT NULL, expires_at REAL);""")
+            self.con.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.con.execute('SELECT value, expires_at FROM response_cache WHERE key = ?;', (key,)).fetchone()
+        if row is None:
+            return MISSING, None
+        value, expires_at = row
+        if expires_at is not None and expires_at < time.time():
+            return MISSING, None
+        return json.loads(value), expires_at
+
+    def set(self, key, value, expires_at=None):
+        with self.lock:
+            self.con.execute('INSERT OR REPLACE INTO response_cache (key, value, expires_at) VALUES (?, ?, ?);',
+                             (key, json.dumps(value), expires_at))
+            self.con.commit()
+
+    def purge_expired(self):
+        with self.lock:
+            self.con.execute('DELETE FROM response_cache WHERE expires_at < ?;', (time.time(),))
+            self.con.commit()
+
+
+class TieredCache:
+    """
+    Memory LRU in front of the sqlite cache. Keys are namespaced so hit rates can be tracked
+    per cached method, and every entry carries its own ttl (None means never expire)
+    """
+
+    def __init__(self, memory=None, disk=None):
+        self.memory = memory if memory is not None else LRUCache()
+        self.disk = disk
+        self.stats = CacheStats()
+        self.single_flight = SingleFlight()
+        self.async_single_flight = AsyncSingleFlight()
+        self.refresh_lock = threading.Lock()
+        self.refreshing = set()
+
+    @staticmethod
+    def make_key(namespace, key):
+        return f'{namespace}:{key}'
+
+    def get(self, namespace, key):
+        full_key = self.make_key(namespace, key)
+        value = self.memory.get(full_key)
+        if value is MISSING and self.disk is not None:
+            value, expires_at = self.disk.get(full_key)
+            if value is not MISSING:
+                self.memory.set(full_key, value, expires_at)
+        self.stats.record(namespace, value is not MISSING)
+        return value
+
+    def set(self, namespace, key, value, ttl=None):
+        full_key = self.make_key(namespace, key)
+        expires_at = time.time() + ttl if ttl is not None else None
+        self.memory.set(full_key, value, expires_at)
+        if self.disk is not None:
+            self.disk.set(full_key, value, expires_at)
+
+    def get_or_set(self, namespace, key, compute, ttl=None):
+        """
+        Concurrent misses on the same key share a single compute()
+        """
+        value = self.get(namespace, key)
+        if value is MISSING:
+            def load():
+                loaded = compute()
+                self.set(namespace, key, loaded, ttl)
+                return loaded
+            value = self.single_flight.do(self.make_key(namespace, key), load)
+        return value
+
+    def get_or_refresh(self, namespace, key, compute, ttl, stale_ttl, executor, refresh=None):
+        """
+        Stale-while-revalidate get_or_set. For ttl seconds an entry is served as is, for stale_ttl seconds
+        after that it's still served but a refresh is started on executor, and after that it's gone.
+        Misses are computed on the calling thread, shared with any concurrent misses on the same key.
+        compute() must return something json serializable
+
+        :param refresh: what a background refresh calls instead of compute, e.g. to skip shortcuts
+            that would only hand back other cached data
+        """
+        entry = self.get(namespace, key)
+        if entry is MISSING:
+            return self.single_flight.do(self.make_key(namespace, key),
+                                         lambda: self.__compute_entry(namespace, key, compute, ttl, stale_ttl))
+        if not self.is_fresh(entry):
+            self.__refresh_in_background(namespace, key, refresh or compute, ttl, stale_ttl, executor)
+        return entry['value']
+
+    @staticmethod
+    def is_fresh(entry):
+        """
+        :param entry: what get returns for a key written by get_or_refresh
+        """
+        return entry is not MISSING and entry['fresh_until'] > time.time()
+
+    def __compute_entry(self, namespace, key, compute, ttl, stale_ttl):
+        value = compute()
+        self.set(namespace, key, {'value': value, 'fresh_until': time.time() + ttl}, ttl + stale_ttl)
+        return value
+
+    def __refresh_in_background(self, namespace, key, compute, ttl, stale_ttl, executor):
+        full_key = self.make_key(namespace, key)
+        with self.refresh_lock:
+            if full_key in self.refreshing:
+                return
+            self.refreshing.add(full_key)
+
+        def refresh():
+            try:
+                # the stale value has already been served, so nobody's waiting on this
+                with lane(BULK):
+                    self.single_flight.do(full_key, lambda: self.__compute_entry(namespace, key, compute, ttl, stale_ttl))
+            except Exception as e:
+                # keep serving the stale value, the next stale read tries again
+                logger.warning("Failed to refresh %s: %r", full_key, e)
+            finally:
+                with self.refresh_lock:
+                    self.refreshing.discard(full_key)
+
+        executor.submit(refresh)
+
+    async def get_or_set_async(self, namespace, key, compute, ttl=None):
+        """
+        get_or_set for a coroutine function compute
+        """
+        value = self.get(namespace, key)
+        if value is MISSING:
+            async def load():
+                loaded = await compute()
+                self.set(namespace, key, loaded, ttl)
+                return loaded
+            value = await self.async_single_flight.do(self.make_key(namespace, key), load)
+        return value
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """
+    Process-wide cache. FLYORDRIVE_CACHE_DB overrides the sqlite file, set it to an empty string
+    to keep everything in memory
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                path = os.environ.get('FLYORDRIVE_CACHE_DB', DEFAULT_CACHE_PATH)
+                _cache = TieredCache(disk=SqliteCache(path) if path else None)
+                registry.add_collector(cache_collector(_cache))
+    return _cache
@@ -0,0 +1,66 @@
+"""
+How long the work on this thread has left, so that no single upstream call can use up a whole trip's time.
+
+A trip sets its budget with `with deadline(seconds): ...`, and everything under it (carried over to the upstream pool
+by executor.TracingThreadPoolExecutor) sizes its http timeouts, rate limit waits and waits on other calls
+by remaining(). Nested deadlines can only make the time left shorter
+"""
+from contextlib import contextmanager
+import threading
+import time
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+_local = threading.local()
+
+
+def current_deadline():
+    """
+    :return: time.monotonic() by which the work should be done, or None if there's no deadline
+    """
+    return getattr(_local, 'deadline', None)
+
+
+def set_current_deadline(at):
+    _local.deadline = at
+
+
+def remaining():
+    """
+    :return: seconds left (at least 0), or None if there's no deadline
+    """
+    at = current_deadline()
+    return max(0.0, at - time.monotonic()) if at is not None else None
+
+
+def capped(seconds):
+    """
+    :param seconds: how long something would wait without a deadline, or None for forever
+    :return: seconds, cut down to the time left
+    :raise DeadlineExceeded: if there's no time left at all
+    """
+    left = remaining()
+    if left is None:
+        return seconds
+    if left <= 0:
+        raise DeadlineExceeded("out of time")
+    return left if seconds is None else min(seconds, left)
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Give the block at most seconds, None for no limit (an outer deadline still applies)
+    """
+    previous = current_deadline()
+    at = previous
+    if seconds is not None:
+        at = time.monotonic() + seconds if previous is None else min(previous, time.monotonic() + seconds)
+    set_current_deadline(at)
+    try:
+        yield
+    finally:
+        set_current_deadline(previous)
@@ -0,0 +1,67 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import os
+import threading
+
+from .deadline import current_deadline, set_current_deadline
+from .metrics import current_trace, set_current_trace
+from .rate_limit import current_lane, set_current_lane
+
+
+class InlineExecutor:
+    """
+    Executor that runs work immediately on the calling thread,
+    for running the same task graph sequentially
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class TracingThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    Runs submitted work under the submitting thread's trip trace, rate limit lane and deadline,
+    so upstream calls made on pool threads still count towards the trip that caused them,
+    wait their turn the way it would and give up when it has to
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        trip_trace = current_trace()
+        lane = current_lane()
+        at = current_deadline()
+
+        def run():
+            previous, previous_lane, previous_deadline = current_trace(), current_lane(), current_deadline()
+            set_current_trace(trip_trace)
+            set_current_lane(lane)
+            set_current_deadline(at)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                set_current_trace(previous)
+                set_current_lane(previous_lane)
+                set_current_deadline(previous_deadline)
+
+        return super().submit(run)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Process-wide pool for upstream calls. Almost all of the work is waiting on the network,
+    so this is sized by how many calls we're happy to have in flight (FLYORDRIVE_MAX_WORKERS)
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                max_workers = int(os.environ.get('FLYORDRIVE_MAX_WORKERS', 32))
+                _executor = TracingThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='flyordrive')
+    return _executor
@@ -0,0 +1,80 @@
+"""
+Which EIA gas price region a point falls in.
+
+EIA publishes weekly retail prices for California, for each PADD (Petroleum Administration for
+Defense District) and for the US as a whole. The outlines below follow state borders closely enough
+to pick a region, they are not meant for anything finer than that
+"""
+
+# (lat, lng) vertices, checked in order so California wins over the West Coast district it sits in
+REGION_POLYGONS = [
+    ('california', [
+        (42.0, -124.4), (42.0, -120.0), (39.0, -120.0), (35.0, -114.6), (34.3, -114.1),
+        (32.7, -114.7), (32.5, -117.1), (34.4, -120.6), (40.4, -124.4),
+    ]),
+    # WA, OR, NV, AZ, CA (Alaska and Hawaii are boxes below)
+    ('west_coast', [
+        (49.0, -125.0), (49.0, -117.03), (42.0, -117.03), (42.0, -114.04), (37.0, -114.04),
+        (37.0, -109.05), (31.33, -109.05), (31.33, -111.07), (32.5, -114.8), (32.5, -117.2),
+        (30.0, -120.0),
+    ]),
+    ('west_coast', [(51.0, -180.0), (72.0, -180.0), (72.0, -129.0), (51.0, -129.0)]),
+    ('west_coast', [(18.5, -161.0), (22.5, -161.0), (22.5, -154.5), (18.5, -154.5)]),
+    # ID, MT, WY, UT, CO
+    ('rocky_mountain', [
+        (49.0, -117.03), (49.0, -104.04), (41.0, -104.05), (41.0, -102.05), (37.0, -102.05),
+        (37.0, -114.04), (42.0, -114.04), (42.0, -117.03),
+    ]),
+    # NM, TX, AR, LA, MS, AL
+    ('gulf_coast', [
+        (37.0, -109.05), (37.0, -103.0), (36.5, -103.0), (36.5, -100.0), (34.5, -100.0),
+        (33.8, -96.0), (33.6, -94.5), (36.5, -94.6), (36.5, -90.1), (35.0, -90.3),
+        (35.0, -85.6), (31.0, -85.0), (31.0, -87.6), (30.2, -87.6), (29.0, -89.0),
+        # down the coast, then up the Rio Grande with some slack past El Paso
+        (28.0, -97.0), (25.8, -97.2), (26.4, -99.2), (29.3, -100.9), (28.9, -103.0), (29.3, -104.5),
+        (31.5, -106.3), (31.7, -106.55), (31.7, -108.2), (31.33, -108.2), (31.33, -109.05),
+    ]),
+    # New England down the seaboard to FL, inland as far as PA, WV, VA, NC and GA
+    ('east_coast', [
+        (47.5, -69.0), (45.0, -71.5), (45.0, -74.7), (43.6, -79.2), (42.3, -79.76),
+        (42.3, -80.52), (39.72, -80.52), (40.6, -80.6), (38.4, -82.6), (37.2, -82.0),
+        (36.6, -83.7), (35.0, -84.3), (35.0, -85.6), (31.0, -85.0), (31.0, -87.6),
+        # round Florida past the Keys, keeping well out to sea
+        (30.2, -87.6), (24.3, -82.2), (24.3, -79.5), (30.0, -80.0), (35.0, -75.3),
+        (40.5, -73.9), (41.0, -70.0), (43.5, -70.0), (44.8, -66.9),
+    ]),
+]
+
+# everything else in the lower 48 is the Midwest district. It reaches no further south than Oklahoma,
+# so nothing the Gulf Coast and East Coast outlines miss along the southern coasts ends up in it
+MIDWEST_BOUNDS = (33.6, 49.5, -104.05, -80.52)
+
+
+def _contains(polygon, lat, lng):
+    # ray casting along the longitude axis
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        lat_i, lng_i = polygon[i]
+        lat_j, lng_j = polygon[j]
+        if (lat_i > lat) != (lat_j > lat):
+            crossing_lng = lng_i + (lat - lat_i) * (lng_j - lng_i) / (lat_j - lat_i)
+            if lng < crossing_lng:
+                inside = not inside
+        j = i
+    return inside
+
+
+def region_for(coords):
+    """
+    :param coords: (lat, lng)
+    :return: one of the REGION_POLYGONS names, 'midwest', or 'us' when we can't tell
+    """
+    lat, lng = coords
+    for region, polygon in REGION_POLYGONS:
+        if _contains(polygon, lat, lng):
+            return region
+    min_lat, max_lat, min_lng, max_lng = MIDWEST_BOUNDS
+    if min_lat <= lat <= max_lat and min_lng <= lng <= max_lng:
+        return 'midwest'
+    return 'us'
@@ -0,0 +1,84 @@
+"""
+Picks what sits behind each upstream gateway, from FLYORDRIVE_GATEWAY_MODE:
+
+- live (default): the real APIs
+- record: the real APIs, saving every response under FLYORDRIVE_FIXTURES_DIR
+- replay: only the saved responses, no network and no API keys
+- stub: synthetic answers from stub_gateways, no fixtures needed
+
+replay and stub wait FLYORDRIVE_GATEWAY_LATENCY_MS (+ up to FLYORDRIVE_GATEWAY_JITTER_MS) per call,
+so benchmarks see something like real upstream round trips.
+Whatever the mode, the gateway comes back instrumented (see metrics.InstrumentedGateway)
+behind a circuit breaker, with slow calls hedged (see resilience)
+"""
+import os
+
+from .replay_gateway import DEFAULT_FIXTURES_DIR, AsyncGatewayAdapter, DelayedGateway, InjectedLatency, ReplayGateway
+from .stub_gateways import StubEIAGateway, StubGoogleDistanceMatrixGateway, StubGoogleHotelsGateway, StubSkyScannerGateway
+from ..metrics import AsyncInstrumentedGateway, InstrumentedGateway
+from ..resilience import AsyncResilientGateway, ResilientGateway
+
+MODES = ('live', 'record', 'replay', 'stub')
+
+STUBS = {
+    'google': StubGoogleDistanceMatrixGateway,
+    'skyscanner': StubSkyScannerGateway,
+    'eia': StubEIAGateway,
+    'hotels': StubGoogleHotelsGateway,
+}
+
+
+def gateway_mode():
+    mode = os.environ.get('FLYORDRIVE_GATEWAY_MODE', 'live')
+    if mode not in MODES:
+        raise ValueError(f"FLYORDRIVE_GATEWAY_MODE must be one of {MODES}, got {mode!r}")
+    return mode
+
+
+def injected_latency():
+    return InjectedLatency(float(os.environ.get('FLYORDRIVE_GATEWAY_LATENCY_MS', 0)) / 1000,
+                           float(os.environ.get('FLYORDRIVE_GATEWAY_JITTER_MS', 0)) / 1000)
+
+
+def fixtures_dir():
+    return os.environ.get('FLYORDRIVE_FIXTURES_DIR') or DEFAULT_FIXTURES_DIR
+
+
+def _local_gateway(name, mode):
+    if mode == 'replay':
+        return ReplayGateway(name, fixtures_dir=fixtures_dir())
+    return STUBS[name]()
+
+
+def build_gateway(name, live_factory):
+    """
+    :param name: 'google', 'skyscanner', 'eia' or 'hotels'
+    :param live_factory: builds the real gateway, only called in live and record mode
+    """
+    return ResilientGateway(name, InstrumentedGateway(name, _build_gateway(name, live_factory)))
+
+
+def _build_gateway(name, live_factory):
+    mode = gateway_mode()
+    if mode == 'live':
+        return live_factory()
+    if mode == 'record':
+        return ReplayGateway(name, live_factory(), fixtures_dir=fixtures_dir())
+    latency = injected_latency()
+    gateway = _local_gateway(name, mode)
+    return DelayedGateway(gateway, latency) if latency else gateway
+
+
+def build_async_gateway(name, live_factory):
+    """
+    Same as build_gateway for the async gateways. Record with the sync service,
+    the fixtures are shared since both make the same calls
+    """
+    mode = gateway_mode()
+    if mode == 'live':
+        gateway = live_factory()
+    elif mode == 'record':
+        raise ValueError("Recording is only supported by the sync gateways, replay works for both")
+    else:
+        gateway = AsyncGatewayAdapter(_local_gateway(name, mode), injected_latency())
+    return AsyncResilientGateway(name, AsyncInstrumentedGateway(name, gateway))
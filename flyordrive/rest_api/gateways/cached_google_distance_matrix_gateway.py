@@ -0,0 +1,129 @@
+from collections import OrderedDict
+
+from ..cache import MISSING
+from ..metrics import span
+
+
+class CachedGoogleDistanceMatrixGateway:
+    """
+    Wraps GoogleDistanceMatrixGateway with a response cache.
+
+    Geocodes basically never change so they're kept for a long time,
+    but routes are requested with live traffic so they go stale quickly
+    """
+    GEOCODE_TTL_SECONDS = 90 * 24 * 60 * 60
+    REVERSE_GEOCODE_TTL_SECONDS = 90 * 24 * 60 * 60
+    ROUTE_TTL_SECONDS = 15 * 60
+
+    def __init__(self, gateway, cache):
+        self.gateway = gateway
+        self.cache = cache
+
+    @staticmethod
+    def normalize_place(place):
+        return ' '.join(place.lower().split())
+
+    @staticmethod
+    def coords_key(coords):
+        lat, lng = coords
+        return f'{lat:.6f},{lng:.6f}'
+
+    def get_lat_lng(self, place):
+        with span('geocode', place=place):
+            lat, lng = self.cache.get_or_set('geocode',
+                                             self.normalize_place(place),
+                                             lambda: self.gateway.get_lat_lng(place),
+                                             ttl=self.GEOCODE_TTL_SECONDS)
+        return lat, lng
+
+    def reverse_geocode(self, coords):
+        with span('reverse_geocode', coords=coords):
+            return self.cache.get_or_set('reverse_geocode',
+                                         self.coords_key(coords),
+                                         lambda: self.gateway.reverse_geocode(coords),
+                                         ttl=self.REVERSE_GEOCODE_TTL_SECONDS)
+
+    def route_key(self, origin, destination):
+        return f'{self.normalize_place(origin)}|{self.normalize_place(destination)}'
+
+    def get_driving_route(self, origin, destination):
+        key = self.route_key(origin, destination)
+        distance_meters, duration_seconds = self.cache.get_or_set('route',
+                                                                  key,
+                                                                  lambda: self.gateway.get_driving_route(origin, destination),
+                                                                  ttl=self.ROUTE_TTL_SECONDS)
+        return distance_meters, duration_seconds
+
+    def _cached_routes(self, origins, destinations):
+        """
+        :return: the route matrix with MISSING holes, and the distinct origins and destinations
+            that cover the holes, so only that sub-matrix has to be fetched
+        """
+        routes = [[self.cache.get('route', self.route_key(o, d)) for d in destinations] for o in origins]
+        missing = [(i, j) for i, row in enumerate(routes) for j, route in enumerate(row) if route is MISSING]
+        missing_origins = list(OrderedDict.fromkeys(origins[i] for i, _ in missing))
+        missing_destinations = list(OrderedDict.fromkeys(destinations[j] for _, j in missing))
+        return routes, missing_origins, missing_destinations
+
+    def _fill_routes(self, routes, origins, destinations, missing_origins, missing_destinations, fetched):
+        fetched_routes = {}
+        for fi, o in enumerate(missing_origins):
+            for fj, d in enumerate(missing_destinations):
+                route = fetched[fi][fj]
+                if route is not None:
+                    self.cache.set('route', self.route_key(o, d), route, ttl=self.ROUTE_TTL_SECONDS)
+                fetched_routes[(o, d)] = route
+        return [
+            [fetched_routes[(o, d)] if route is MISSING else route for d, route in zip(destinations, row)]
+            for o, row in zip(origins, routes)
+        ]
+
+    @staticmethod
+    def _as_tuples(routes):
+        return [[tuple(route) if route is not None else None for route in row] for row in routes]
+
+    def get_driving_routes(self, origins, destinations):
+        routes, missing_origins, missing_destinations = self._cached_routes(origins, destinations)
+        if missing_origins:
+            fetched = self.gateway.get_driving_routes(missing_origins, missing_destinations)
+            routes = self._fill_routes(routes, origins, destinations, missing_origins, missing_destinations, fetched)
+        return self._as_tuples(routes)
+
+    def find_airport(self, airport_code):
+        return self.gateway.find_airport(airport_code)
+
+
+class AsyncCachedGoogleDistanceMatrixGateway(CachedGoogleDistanceMatrixGateway):
+    """
+    The same cache in front of AsyncGoogleDistanceMatrixGateway
+    """
+
+    async def get_lat_lng(self, place):
+        with span('geocode', place=place):
+            lat, lng = await self.cache.get_or_set_async('geocode',
+                                                         self.normalize_place(place),
+                                                         lambda: self.gateway.get_lat_lng(place),
+                                                         ttl=self.GEOCODE_TTL_SECONDS)
+        return lat, lng
+
+    async def reverse_geocode(self, coords):
+        with span('reverse_geocode', coords=coords):
+            return await self.cache.get_or_set_async('reverse_geocode',
+                                                     self.coords_key(coords),
+                                                     lambda: self.gateway.reverse_geocode(coords),
+                                                     ttl=self.REVERSE_GEOCODE_TTL_SECONDS)
+
+    async def get_driving_route(self, origin, destination):
+        key = self.route_key(origin, destination)
+        distance_meters, duration_seconds = await self.cache.get_or_set_async('route',
+                                                                              key,
+                                                                              lambda: self.gateway.get_driving_route(origin, destination),
+                                                                              ttl=self.ROUTE_TTL_SECONDS)
+        return distance_meters, duration_seconds
+
+    async def get_driving_routes(self, origins, destinations):
+        routes, missing_origins, missing_destinations = self._cached_routes(origins, destinations)
+        if missing_origins:
+            fetched = await self.gateway.get_driving_routes(missing_origins, missing_destinations)
+            routes = self._fill_routes(routes, origins, destinations, missing_origins, missing_destinations, fetched)
+        return self._as_tuples(routes)
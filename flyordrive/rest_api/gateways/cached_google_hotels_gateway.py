@@ -0,0 +1,77 @@
+import math
+
+from ..cache import MISSING
+from ..metrics import span
+
+
+class CachedGoogleHotelsGateway:
+    """
+    Wraps GoogleHotelsGateway with a spatial cache. Points are snapped to a grid of CELL_DEGREES cells
+    and looked up at the cell's center, so every trip stopping for the night in the same area shares
+    one lookup. Drives along a popular corridor mostly stop in cells someone has already paid for
+    """
+    CELL_DEGREES = 0.25
+    # rates move, but the price level of a town's hotels doesn't
+    HOTEL_TTL_SECONDS = 7 * 24 * 60 * 60
+
+    def __init__(self, gateway, cache):
+        self.gateway = gateway
+        self.cache = cache
+
+    @classmethod
+    def cell(cls, coords):
+        lat, lng = coords
+        return math.floor(lat / cls.CELL_DEGREES), math.floor(lng / cls.CELL_DEGREES)
+
+    @classmethod
+    def cell_center(cls, cell):
+        return (cell[0] + 0.5) * cls.CELL_DEGREES, (cell[1] + 0.5) * cls.CELL_DEGREES
+
+    @staticmethod
+    def cell_key(cell):
+        return f'{cell[0]},{cell[1]}'
+
+    def _cached_prices(self, coords_list):
+        """
+        :return: the cell of each point, prices of the cells we have, and the distinct cells we don't
+        """
+        cells = [self.cell(coords) for coords in coords_list]
+        prices = {}
+        missing = []
+        for cell in cells:
+            if cell in prices or cell in missing:
+                continue
+            price = self.cache.get('hotel', self.cell_key(cell))
+            if price is MISSING:
+                missing.append(cell)
+            else:
+                prices[cell] = price
+        return cells, prices, missing
+
+    def _fill_prices(self, cells, prices, missing, fetched):
+        for cell, price in zip(missing, fetched):
+            # nothing to go on is worth remembering too, it won't change any time soon
+            self.cache.set('hotel', self.cell_key(cell), price, ttl=self.HOTEL_TTL_SECONDS)
+            prices[cell] = price
+        return [prices[cell] for cell in cells]
+
+    def get_nightly_prices(self, coords_list):
+        """
+        :return: $ per night around each point, None where there's nothing to go on
+        """
+        with span('hotels', points=len(coords_list)):
+            cells, prices, missing = self._cached_prices(coords_list)
+            fetched = self.gateway.get_nightly_prices([self.cell_center(cell) for cell in missing]) if missing else []
+            return self._fill_prices(cells, prices, missing, fetched)
+
+
+class AsyncCachedGoogleHotelsGateway(CachedGoogleHotelsGateway):
+    """
+    The same cache in front of AsyncGoogleHotelsGateway
+    """
+
+    async def get_nightly_prices(self, coords_list):
+        with span('hotels', points=len(coords_list)):
+            cells, prices, missing = self._cached_prices(coords_list)
+            fetched = await self.gateway.get_nightly_prices([self.cell_center(cell) for cell in missing]) if missing else []
+            return self._fill_prices(cells, prices, missing, fetched)
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+
+from .skyscanner_gateway import travel_month
+from ..cache import MISSING
+from ..metrics import span
+
+logger = logging.getLogger(__name__)
+
+
+class CachedSkyScannerGateway:
+    """
+    Wraps SkyScannerGateway with a response cache.
+
+    An airport's PlaceId never really changes so those are kept forever,
+    quotes move around so they're only kept briefly. Concurrent lookups of the same
+    place or route share one upstream call. Every quote that comes back from upstream is also
+    handed to fares.observe (see services.fare_history), which keeps them for good
+    """
+    QUOTES_TTL_SECONDS = 30 * 60
+
+    def __init__(self, gateway, cache, fares=None):
+        self.gateway = gateway
+        self.cache = cache
+        self.fares = fares
+
+    @staticmethod
+    def quotes_key(origin_place_id, destination_place_id, month):
+        return f'{origin_place_id}|{destination_place_id}|{month}'
+
+    def autosuggest_place(self, place):
+        with span('autosuggest', place=place):
+            return self.cache.get_or_set('skyscanner_place',
+                                         place.upper(),
+                                         lambda: self.gateway.autosuggest_place(place))
+
+    def _observe(self, route, month, data):
+        """
+        :param route: (origin, destination) airport codes the quotes are for, None if we don't know them
+        """
+        if self.fares is not None and route is not None:
+            try:
+                self.fares.observe(*route, month, [quote['MinPrice'] for quote in data.get('Quotes', ())])
+            except Exception as e:
+                # the quotes are still good, losing them from the history isn't worth failing the trip over
+                logger.warning("Couldn't record fares for %s to %s: %r", *route, e)
+        return data
+
+    def browse_quotes(self, origin_place_id, destination_place_id, month=None, route=None):
+        """
+        :param route: (origin, destination) airport codes, to record the quotes in the fare history under
+        """
+        month = month or travel_month()
+        with span('browse_quotes', origin=origin_place_id, destination=destination_place_id):
+            return self.cache.get_or_set('skyscanner_quotes',
+                                         self.quotes_key(origin_place_id, destination_place_id, month),
+                                         lambda: self._observe(route, month, self.gateway.browse_quotes(
+                                             origin_place_id, destination_place_id, month)),
+                                         ttl=self.QUOTES_TTL_SECONDS)
+
+    def get_flight_info(self, origin, destination, month=None):
+        origin_place_id = self.autosuggest_place(origin)
+        destination_place_id = self.autosuggest_place(destination)
+        return self.browse_quotes(origin_place_id, destination_place_id, month, route=(origin, destination))
+
+    def cached_flight_info(self, origin, destination, month=None):
+        """
+        get_flight_info if it can be answered from the cache, otherwise None. Never goes upstream
+        """
+        month = month or travel_month()
+        origin = self.cache.get('skyscanner_place', origin.upper())
+        destination = self.cache.get('skyscanner_place', destination.upper())
+        if origin is MISSING or destination is MISSING:
+            return None
+        quotes = self.cache.get('skyscanner_quotes', self.quotes_key(origin, destination, month))
+        return quotes if quotes is not MISSING else None
+
+
+class AsyncCachedSkyScannerGateway(CachedSkyScannerGateway):
+    """
+    The same cache in front of AsyncSkyScannerGateway
+    """
+
+    async def autosuggest_place(self, place):
+        with span('autosuggest', place=place):
+            return await self.cache.get_or_set_async('skyscanner_place',
+                                                     place.upper(),
+                                                     lambda: self.gateway.autosuggest_place(place))
+
+    async def __fetch_quotes(self, origin_place_id, destination_place_id, month, route):
+        return self._observe(route, month, await self.gateway.browse_quotes(origin_place_id, destination_place_id, month))
+
+    async def browse_quotes(self, origin_place_id, destination_place_id, month=None, route=None):
+        month = month or travel_month()
+        with span('browse_quotes', origin=origin_place_id, destination=destination_place_id):
+            return await self.cache.get_or_set_async('skyscanner_quotes',
+                                                     self.quotes_key(origin_place_id, destination_place_id, month),
+                                                     lambda: self.__fetch_quotes(origin_place_id, destination_place_id,
+                                                                                 month, route),
+                                                     ttl=self.QUOTES_TTL_SECONDS)
+
+    async def get_flight_info(self, origin, destination, month=None):
+        origin_place_id, destination_place_id = await asyncio.gather(self.autosuggest_place(origin),
+                                                                     self.autosuggest_place(destination))
+        return await self.browse_quotes(origin_place_id, destination_place_id, month, route=(origin, destination))
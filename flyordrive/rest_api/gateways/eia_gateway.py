@@ -1,26 +1,51 @@
 import json
 import os
 
-import requests
+from ..gas_regions import region_for
+from ..http_session import get_http_session
 
 
 class EIAGateway:
-    eia_api_key = os.environ['EIA_API_KEY']
-    url = f"http://api.eia.gov/category/?api_key={eia_api_key}&category_id=711295"
+    category_url = "http://api.eia.gov/category/?api_key={api_key}&category_id=711295"
+    series_url = "http://api.eia.gov/series/?api_key={api_key}&series_id={series_id}"
+    # weekly retail gasoline, all grades and formulations, $/gal
+    region_series = {
+        'us': 'PET.EMM_EPM0_PTE_NUS_DPG.W',
+        'california': 'PET.EMM_EPM0R_PTE_SCA_DPG.W',
+        'east_coast': 'PET.EMM_EPM0_PTE_R10_DPG.W',
+        'midwest': 'PET.EMM_EPM0_PTE_R20_DPG.W',
+        'gulf_coast': 'PET.EMM_EPM0_PTE_R30_DPG.W',
+        'rocky_mountain': 'PET.EMM_EPM0_PTE_R40_DPG.W',
+        'west_coast': 'PET.EMM_EPM0_PTE_R50_DPG.W',
+    }
 
-    ca_thing = f"http://api.eia.gov/series/?api_key={eia_api_key}&series_id=PET.EMM_EPM0R_PTE_SCA_DPG.W"
-    us_thing = f"http://api.eia.gov/series/?api_key={eia_api_key}&series_id=PET.EMM_EPM0_PTE_NUS_DPG.W"
+    def __init__(self, session=None):
+        self.session = session or get_http_session()
+
+    @staticmethod
+    def region_series_url(region):
+        # read the key when it's needed, so importing the gateway doesn't require it
+        return EIAGateway.series_url.format(api_key=os.environ['EIA_API_KEY'],
+                                            series_id=EIAGateway.region_series[region])
+
+    @staticmethod
+    def series_url_for(coords):
+        return EIAGateway.region_series_url(region_for(coords))
+
+    @staticmethod
+    def latest_price(series):
+        """
+        :return: (price, period) of the newest data point, e.g. (3.301, '20210906')
+        """
+        period, price = series['series'][0]['data'][0]
+        return price, period
+
+    def get_region_price(self, region):
+        resp = self.session.get(self.region_series_url(region))
+        return self.latest_price(json.loads(resp.content))
 
     def get_gas_prices_around_location(self, coords):
-        lat, lng = coords
-        # hack. assume california bounded simply by flat rect top, angled side, and rect bottom
-        if ((lng < -119.9 and lat < 42) or
-                (35 < lat < 39 and lng < -1.5 * lat - 123 / 2) or
-                (lat < 35 and lng < -114.5)):
-            to_check = EIAGateway.ca_thing
-        else:
-            to_check = EIAGateway.us_thing
-
-        resp = requests.get(to_check)
-        gas_price = json.loads(resp.content)['series'][0]['data'][0][1]
+        resp = self.session.get(self.series_url_for(coords))
+        gas_price, _ = self.latest_price(json.loads(resp.content))
         return [gas_price]
+
@@ -1,13 +1,42 @@
+import asyncio
 from datetime import datetime
 import os
+import time
 
 import googlemaps
+from googlemaps.exceptions import ApiError
+
+from ..http_session import get_async_http_client, get_http_session
+
+# https://developers.google.com/maps/documentation/distance-matrix/usage-and-billing#other-usage-limits
+MAX_ORIGINS_OR_DESTINATIONS = 25
+MAX_ELEMENTS = 100
+
+
+def matrix_chunks(origins, destinations):
+    """
+    Split an origins x destinations matrix into blocks that fit in one distance matrix request
+
+    :return: generator of (origin offset, destination offset, origins block, destinations block)
+    """
+    destination_chunk = min(len(destinations), MAX_ORIGINS_OR_DESTINATIONS) or 1
+    origin_chunk = min(MAX_ORIGINS_OR_DESTINATIONS, MAX_ELEMENTS // destination_chunk)
+    for i in range(0, len(origins), origin_chunk):
+        for j in range(0, len(destinations), destination_chunk):
+            yield i, j, origins[i:i + origin_chunk], destinations[j:j + destination_chunk]
+
+
+def fill_routes(routes, i, j, route_info):
+    for di, row in enumerate(route_info['rows']):
+        for dj, element in enumerate(row['elements']):
+            if element['status'] == 'OK':
+                routes[i + di][j + dj] = (element['distance']['value'], element['duration']['value'])
 
 
 class GoogleDistanceMatrixGateway:
-    def __init__(self):
+    def __init__(self, session=None):
         googlemaps_api_key = os.environ['GOOGLE_API_KEY']
-        self.gmaps = googlemaps.Client(key=googlemaps_api_key)
+        self.gmaps = googlemaps.Client(key=googlemaps_api_key, requests_session=session or get_http_session())
 
     def get_lat_lng(self, place):
         latlng = self.gmaps.geocode(place)[0]['geometry']['location']
@@ -30,5 +59,81 @@ class GoogleDistanceMatrixGateway:
 
         return (distance_meters, duration_seconds)
 
+    def get_driving_routes(self, origins, destinations):
+        """
+        Route every origin to every destination, in as few distance matrix requests as the usage limits allow
+
+        :return: matrix indexed [origin][destination] of (distance_meters, duration_seconds),
+            or None for pairs google couldn't route
+        """
+        now = datetime.now()
+        routes = [[None] * len(destinations) for _ in origins]
+        for i, j, origins_block, destinations_block in matrix_chunks(origins, destinations):
+            route_info = self.gmaps.distance_matrix(origins_block, destinations_block,
+                                                    mode='driving', departure_time=now,
+                                                    language='en-US',
+                                                    traffic_model='optimistic')
+            fill_routes(routes, i, j, route_info)
+
+        return routes
+
     def find_airport(self, airport_code):
-        return self.gmaps.places(airport_code, type='airport')
\ No newline at end of file
+        return self.gmaps.places(airport_code, type='airport')
+
+
+class AsyncGoogleDistanceMatrixGateway:
+    """
+    Same calls as GoogleDistanceMatrixGateway, made straight against the web service
+    since the googlemaps client is blocking
+    """
+    base_url = 'https://maps.googleapis.com/maps/api'
+
+    def __init__(self, client=None):
+        self.api_key = os.environ['GOOGLE_API_KEY']
+        self.client = client
+
+    async def __get(self, service, params):
+        client = self.client or get_async_http_client()
+        response = await client.get(f'{self.base_url}/{service}/json', params={**params, 'key': self.api_key})
+        response.raise_for_status()
+        body = response.json()
+        if body['status'] not in ('OK', 'ZERO_RESULTS'):
+            raise ApiError(body['status'], body.get('error_message'))
+        return body
+
+    async def __distance_matrix(self, origins, destinations, departure_time):
+        return await self.__get('distancematrix', {
+            'origins': '|'.join(origins),
+            'destinations': '|'.join(destinations),
+            'mode': 'driving',
+            'departure_time': departure_time,
+            'language': 'en-US',
+            'traffic_model': 'optimistic'
+        })
+
+    async def get_lat_lng(self, place):
+        body = await self.__get('geocode', {'address': place})
+        latlng = body['results'][0]['geometry']['location']
+        return latlng['lat'], latlng['lng']
+
+    async def reverse_geocode(self, coords):
+        lat, lng = coords
+        body = await self.__get('geocode', {'latlng': f'{lat},{lng}'})
+        return body['results'][0]['address_components'][0]['long_name']
+
+    async def get_driving_route(self, origin, destination):
+        route_info = await self.__distance_matrix([origin], [destination], int(time.time()))
+        relevant_part = route_info['rows'][0]['elements'][0]
+        return relevant_part['distance']['value'], relevant_part['duration']['value']
+
+    async def get_driving_routes(self, origins, destinations):
+        now = int(time.time())
+        routes = [[None] * len(destinations) for _ in origins]
+        chunks = list(matrix_chunks(origins, destinations))
+        route_infos = await asyncio.gather(*[
+            self.__distance_matrix(origins_block, destinations_block, now)
+            for _, _, origins_block, destinations_block in chunks
+        ])
+        for (i, j, _, _), route_info in zip(chunks, route_infos):
+            fill_routes(routes, i, j, route_info)
+        return routes
@@ -1,3 +1,77 @@
+import asyncio
+import os
+from statistics import median
+
+import googlemaps
+from googlemaps.exceptions import ApiError
+
+from ..http_session import get_async_http_client, get_http_session
+
+# google's price_level, 0 (cheapest) to 4 (very expensive), as $ per night
+PRICE_LEVEL_NIGHTLY = (70, 95, 140, 220, 350)
+# how far around a point to look for somewhere to stay
+SEARCH_RADIUS_METERS = 25000
+
+
+def nightly_price(results):
+    """
+    :param results: places search results
+    :return: $ per night at the typical price level around here, or None if nothing there has one
+    """
+    levels = [result['price_level'] for result in results if result.get('price_level') is not None]
+    if not levels:
+        return None
+    return PRICE_LEVEL_NIGHTLY[int(round(median(levels)))]
+
 
 class GoogleHotelsGateway:
-    pass
\ No newline at end of file
+    """
+    Google doesn't publish hotel rates, so a nightly price is inferred from the price level
+    of the lodging places finds around a point
+    """
+
+    def __init__(self, session=None):
+        googlemaps_api_key = os.environ['GOOGLE_API_KEY']
+        self.gmaps = googlemaps.Client(key=googlemaps_api_key, requests_session=session or get_http_session())
+
+    def get_nightly_price(self, coords):
+        places = self.gmaps.places_nearby(location=coords, radius=SEARCH_RADIUS_METERS, type='lodging')
+        return nightly_price(places['results'])
+
+    def get_nightly_prices(self, coords_list):
+        """
+        Places has no batch endpoint, so this is one request per point
+
+        :return: $ per night around each point, None where there's nothing to go on
+        """
+        return [self.get_nightly_price(coords) for coords in coords_list]
+
+
+class AsyncGoogleHotelsGateway:
+    """
+    Same calls as GoogleHotelsGateway, made straight against the web service
+    since the googlemaps client is blocking
+    """
+    base_url = 'https://maps.googleapis.com/maps/api'
+
+    def __init__(self, client=None):
+        self.api_key = os.environ['GOOGLE_API_KEY']
+        self.client = client
+
+    async def get_nightly_price(self, coords):
+        lat, lng = coords
+        client = self.client or get_async_http_client()
+        response = await client.get(f'{self.base_url}/place/nearbysearch/json', params={
+            'location': f'{lat},{lng}',
+            'radius': SEARCH_RADIUS_METERS,
+            'type': 'lodging',
+            'key': self.api_key
+        })
+        response.raise_for_status()
+        body = response.json()
+        if body['status'] not in ('OK', 'ZERO_RESULTS'):
+            raise ApiError(body['status'], body.get('error_message'))
+        return nightly_price(body['results'])
+
+    async def get_nightly_prices(self, coords_list):
+        return list(await asyncio.gather(*[self.get_nightly_price(coords) for coords in coords_list]))
@@ -0,0 +1,141 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+
+DEFAULT_FIXTURES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                    'fixtures')
+
+
+class FixtureNotFound(LookupError):
+    pass
+
+
+class InjectedLatency:
+    """
+    Simulated upstream round trip: latency_seconds plus up to jitter_seconds of uniform noise
+    """
+
+    def __init__(self, latency_seconds=0.0, jitter_seconds=0.0, seed=None):
+        self.latency_seconds = latency_seconds
+        self.jitter_seconds = jitter_seconds
+        self.random = random.Random(seed)
+
+    def __bool__(self):
+        return self.latency_seconds > 0 or self.jitter_seconds > 0
+
+    def next_delay(self):
+        return self.latency_seconds + self.random.uniform(0, self.jitter_seconds)
+
+
+class ReplayGateway:
+    """
+    Stands in for a raw gateway (Google, SkyScanner, EIA) by method name.
+    When recording, calls go through to the real gateway and every response is written to a json fixture,
+    keyed by method and arguments. When replaying, responses only ever come from those fixtures,
+    so nothing touches the network and no API keys are needed.
+
+    Responses round trip through json, so tuples come back as lists. Everything downstream only unpacks them
+    """
+
+    def __init__(self, name, gateway=None, fixtures_dir=DEFAULT_FIXTURES_DIR):
+        """
+        :param name: fixture subdirectory, e.g. 'google'
+        :param gateway: the real gateway to record from, or None to replay
+        """
+        self.name = name
+        self.gateway = gateway
+        self.dir = os.path.join(fixtures_dir, name)
+        self.lock = threading.Lock()
+
+    @property
+    def recording(self):
+        return self.gateway is not None
+
+    @staticmethod
+    def fixture_key(method, args, kwargs):
+        payload = json.dumps([method, args, kwargs], sort_keys=True, default=str)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+
+    def fixture_path(self, method, args, kwargs):
+        return os.path.join(self.dir, f'{method}-{self.fixture_key(method, args, kwargs)}.json')
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+
+        def call(*args, **kwargs):
+            if self.recording:
+                return self.record(method, args, kwargs)
+            return self.replay(method, args, kwargs)
+
+        return call
+
+    def replay(self, method, args, kwargs):
+        path = self.fixture_path(method, args, kwargs)
+        try:
+            with open(path) as f:
+                return json.load(f)['response']
+        except FileNotFoundError:
+            raise FixtureNotFound(f"No {self.name} fixture for {method}{tuple(args)!r} {kwargs!r}, "
+                                  f"record one with FLYORDRIVE_GATEWAY_MODE=record (looked for {path})")
+
+    def record(self, method, args, kwargs):
+        response = getattr(self.gateway, method)(*args, **kwargs)
+        path = self.fixture_path(method, args, kwargs)
+        fixture = {'method': method, 'args': args, 'kwargs': kwargs, 'response': response}
+        with self.lock:
+            os.makedirs(self.dir, exist_ok=True)
+            # write then rename so a concurrent replay never reads half a fixture
+            tmp_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(fixture, f, indent=2, default=str)
+            os.replace(tmp_path, path)
+        return response
+
+
+class DelayedGateway:
+    """
+    Adds injected latency in front of any sync gateway
+    """
+
+    def __init__(self, gateway, latency):
+        self.gateway = gateway
+        self.latency = latency
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        fn = getattr(self.gateway, method)
+
+        def call(*args, **kwargs):
+            time.sleep(self.latency.next_delay())
+            return fn(*args, **kwargs)
+
+        return call
+
+
+class AsyncGatewayAdapter:
+    """
+    Exposes a sync, local gateway (replay or stub) with the coroutine interface of the async gateways.
+    The injected latency is awaited, so it doesn't block the event loop the way a real sleep would
+    """
+
+    def __init__(self, gateway, latency=None):
+        self.gateway = gateway
+        self.latency = latency or InjectedLatency()
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        fn = getattr(self.gateway, method)
+
+        async def call(*args, **kwargs):
+            if self.latency:
+                await asyncio.sleep(self.latency.next_delay())
+            return fn(*args, **kwargs)
+
+        return call
@@ -1,27 +1,74 @@
+import asyncio
+from datetime import date
 import json
 import os
 
-import requests
+from ..http_session import get_async_http_client, get_http_session
+
+HOST = "skyscanner-skyscanner-flight-search-v1.p.rapidapi.com"
+AUTOSUGGEST_URL = f"https://{HOST}/apiservices/autosuggest/v1.0/US/USD/en-US/"
+BROWSEQUOTES_URL = f"https://{HOST}/apiservices/browsequotes/v1.0/US/USD/en-us/{{origin}}/{{destination}}/{{month}}/{{month}}"
+
+
+def travel_month(today=None):
+    """
+    The month fares are quoted for, FLYORDRIVE_TRAVEL_MONTH (e.g. 2024-09) or next month
+    """
+    month = os.environ.get('FLYORDRIVE_TRAVEL_MONTH')
+    if month:
+        return month
+    today = today or date.today()
+    return f'{today.year + today.month // 12}-{today.month % 12 + 1:02d}'
+
+
+def _headers():
+    return {
+        'x-rapidapi-key': os.environ['SKYSCANNER_API_KEY'],
+        'x-rapidapi-host': HOST
+    }
+
 
 class SkyScannerGateway:
-    def __init__(self):
-        self.apikey = os.environ['SKYSCANNER_API_KEY']
-        self.headers = {
-            'x-rapidapi-key': self.apikey,
-            'x-rapidapi-host': "skyscanner-skyscanner-flight-search-v1.p.rapidapi.com"
-        }
+    def __init__(self, session=None):
+        self.session = session or get_http_session()
+        self.headers = _headers()
 
     def autosuggest_place(self, place):
-        url = "https://skyscanner-skyscanner-flight-search-v1.p.rapidapi.com/apiservices/autosuggest/v1.0/US/USD/en-US/"
         querystring = {"query": place}
-        response = requests.request("GET", url, headers=self.headers, params=querystring)
+        response = self.session.get(AUTOSUGGEST_URL, headers=self.headers, params=querystring)
 
         data = json.loads(response.content)
         return data['Places'][0]['PlaceId']
 
-    def get_flight_info(self, origin, destination):
+    def browse_quotes(self, origin_place_id, destination_place_id, month=None):
+        url = BROWSEQUOTES_URL.format(origin=origin_place_id, destination=destination_place_id, month=month or travel_month())
+        response = self.session.get(url, headers=self.headers)
+        return json.loads(response.content)
+
+    def get_flight_info(self, origin, destination, month=None):
         origin = self.autosuggest_place(origin)
         destination = self.autosuggest_place(destination)
-        url = f"https://skyscanner-skyscanner-flight-search-v1.p.rapidapi.com/apiservices/browsequotes/v1.0/US/USD/en-us/{origin}/{destination}/2021-09/2021-09"
-        response = requests.request("GET", url, headers=self.headers)
-        return json.loads(response.content)
\ No newline at end of file
+        return self.browse_quotes(origin, destination, month)
+
+
+class AsyncSkyScannerGateway:
+    def __init__(self, client=None):
+        self.client = client
+        self.headers = _headers()
+
+    async def __get(self, url, params=None):
+        client = self.client or get_async_http_client()
+        response = await client.get(url, headers=self.headers, params=params)
+        return json.loads(response.content)
+
+    async def autosuggest_place(self, place):
+        data = await self.__get(AUTOSUGGEST_URL, params={"query": place})
+        return data['Places'][0]['PlaceId']
+
+    async def browse_quotes(self, origin_place_id, destination_place_id, month=None):
+        return await self.__get(BROWSEQUOTES_URL.format(origin=origin_place_id, destination=destination_place_id,
+                                                         month=month or travel_month()))
+
+    async def get_flight_info(self, origin, destination, month=None):
+        origin, destination = await asyncio.gather(self.autosuggest_place(origin), self.autosuggest_place(destination))
+        return await self.browse_quotes(origin, destination, month)
@@ -0,0 +1,84 @@
+"""
+Synthetic stand-ins for the upstream gateways, for load testing and offline development when there
+are no recorded fixtures. Every answer is derived from the arguments alone, so runs are reproducible,
+but none of it is real: places land at a made up point in the lower 48 and prices are invented
+"""
+import hashlib
+
+from ..gas_regions import region_for
+from ..services.geo import haversine_km
+
+# lower 48, roughly
+LAT_RANGE = (30.0, 47.0)
+LNG_RANGE = (-122.0, -75.0)
+# roads are longer than the great circle, and we assume a steady highway pace
+DETOUR_FACTOR = 1.25
+DRIVING_SPEED_KMH = 90
+
+
+def _unit(text, salt=''):
+    """
+    Deterministic float in [0, 1) from a string
+    """
+    digest = hashlib.sha1(f'{salt}:{text}'.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2 ** 64
+
+
+def _place_coords(place):
+    # our own reverse geocode results are 'lat,lng', which google happily accepts as a place too
+    try:
+        lat, lng = (float(part) for part in str(place).split(','))
+        return lat, lng
+    except ValueError:
+        pass
+    key = str(place).strip().lower()
+    lat = LAT_RANGE[0] + _unit(key, 'lat') * (LAT_RANGE[1] - LAT_RANGE[0])
+    lng = LNG_RANGE[0] + _unit(key, 'lng') * (LNG_RANGE[1] - LNG_RANGE[0])
+    return round(lat, 5), round(lng, 5)
+
+
+class StubGoogleDistanceMatrixGateway:
+    def get_lat_lng(self, place):
+        return _place_coords(place)
+
+    def reverse_geocode(self, coords):
+        lat, lng = coords
+        return f'{lat:.5f},{lng:.5f}'
+
+    def get_driving_route(self, origin, destination):
+        distance_km = float(haversine_km(*_place_coords(origin), *_place_coords(destination))) * DETOUR_FACTOR
+        return int(distance_km * 1000), int(distance_km / DRIVING_SPEED_KMH * 60 * 60)
+
+    def get_driving_routes(self, origins, destinations):
+        return [[self.get_driving_route(origin, destination) for destination in destinations] for origin in origins]
+
+    def find_airport(self, airport_code):
+        return {'results': [], 'status': 'ZERO_RESULTS'}
+
+
+class StubSkyScannerGateway:
+    def autosuggest_place(self, place):
+        return f'{place.upper()}-sky'
+
+    def browse_quotes(self, origin_place_id, destination_place_id, month=None):
+        # somewhere between $60 and $460, same answer every time for the same route
+        price = 60 + round(_unit(f'{origin_place_id}|{destination_place_id}|{month}', 'fare') * 400)
+        return {'Quotes': [{'QuoteId': 1, 'MinPrice': price, 'Direct': True}]}
+
+    def get_flight_info(self, origin, destination, month=None):
+        return self.browse_quotes(self.autosuggest_place(origin), self.autosuggest_place(destination), month)
+
+
+class StubEIAGateway:
+    def get_region_price(self, region):
+        return round(3.0 + _unit(region, 'gas'), 3), 'stub'
+
+    def get_gas_prices_around_location(self, coords):
+        price, _ = self.get_region_price(region_for(coords))
+        return [price]
+
+
+class StubGoogleHotelsGateway:
+    def get_nightly_prices(self, coords_list):
+        # somewhere between $70 and $200 a night, the same for anywhere in the same town
+        return [70 + round(_unit(f'{lat:.1f},{lng:.1f}', 'hotel') * 130) for lat, lng in coords_list]
@@ -0,0 +1,158 @@
+import asyncio
+import os
+import threading
+import weakref
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .deadline import capped
+from .rate_limit import get_rate_limiter
+
+
+def _pool_size():
+    return int(os.environ.get('FLYORDRIVE_HTTP_POOL_SIZE', 32))
+
+
+def _max_retries():
+    return int(os.environ.get('FLYORDRIVE_HTTP_RETRIES', 3))
+
+
+def _timeouts():
+    """
+    (connect, read) seconds from FLYORDRIVE_HTTP_CONNECT_TIMEOUT and FLYORDRIVE_HTTP_READ_TIMEOUT
+    """
+    return (float(os.environ.get('FLYORDRIVE_HTTP_CONNECT_TIMEOUT', 3.05)),
+            float(os.environ.get('FLYORDRIVE_HTTP_READ_TIMEOUT', 10)))
+
+
+def request_timeouts(timeout, default):
+    """
+    :param timeout: what the caller asked for, seconds or (connect, read) or None
+    :param default: (connect, read) to use when the caller didn't say
+    :return: (connect, read), neither longer than the current deadline allows
+    :raise DeadlineExceeded: if the deadline has already passed
+    """
+    if timeout is None:
+        timeout = default
+    connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+    return capped(connect), capped(read)
+
+
+class UpstreamAdapter(HTTPAdapter):
+    """
+    Gives every request a timeout, so nothing can hang forever, and cuts it short to fit the current deadline.
+    With a limiter, also waits for the request's provider budget before sending it (see rate_limit)
+    """
+
+    def __init__(self, limiter=None, timeout=None, **kwargs):
+        """
+        :param timeout: (connect, read) seconds for requests that don't set their own
+        """
+        self.limiter = limiter
+        self.timeout = timeout or _timeouts()
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        timeout = request_timeouts(timeout, self.timeout)
+        if self.limiter is not None:
+            self.limiter.acquire(request.url)
+        response = super().send(request, timeout=timeout, **kwargs)
+        if self.limiter is not None and response.status_code == 429:
+            self.limiter.throttled(request.url)
+        return response
+
+
+class UpstreamAsyncTransport(httpx.AsyncBaseTransport):
+    """
+    UpstreamAdapter for httpx. Coroutines don't have a thread of their own to hold a deadline,
+    so only the default timeouts apply
+    """
+
+    def __init__(self, transport, limiter=None):
+        self.transport = transport
+        self.limiter = limiter
+
+    async def handle_async_request(self, request):
+        url = str(request.url)
+        if self.limiter is not None:
+            await self.limiter.acquire_async(url)
+        response = await self.transport.handle_async_request(request)
+        if self.limiter is not None and response.status_code == 429:
+            self.limiter.throttled(url)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def build_session(pool_size=None, max_retries=None, backoff_factor=None, limiter=None):
+    """
+    requests.Session with keep-alive connection pools, timeouts and retry/backoff on throttling and server errors.
+    Defaults come from FLYORDRIVE_HTTP_POOL_SIZE, FLYORDRIVE_HTTP_RETRIES and FLYORDRIVE_HTTP_BACKOFF
+
+    :param pool_size: connections kept open per host, should be at least the number of worker threads
+    :param max_retries: retries for idempotent requests
+    :param backoff_factor: sleeps backoff_factor * 2 ** (retry - 1) seconds between retries
+    :param limiter: rate_limit.RateLimiter to keep requests within provider budgets, None for no limits
+    """
+    if pool_size is None:
+        pool_size = _pool_size()
+    if max_retries is None:
+        max_retries = _max_retries()
+    if backoff_factor is None:
+        backoff_factor = float(os.environ.get('FLYORDRIVE_HTTP_BACKOFF', 0.5))
+
+    retry = Retry(total=max_retries,
+                  backoff_factor=backoff_factor,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=('GET',),
+                  raise_on_status=False)
+    # pool_connections is the number of distinct hosts to keep pools for
+    adapter = UpstreamAdapter(limiter, pool_connections=8, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """
+    Process-wide session shared by all the gateways, so repeat calls to a host reuse connections
+    and every request counts against the shared provider budgets
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = build_session(limiter=get_rate_limiter())
+    return _session
+
+
+# httpx async clients can't be shared between event loops, so keep one per loop
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_http_client():
+    """
+    Keep-alive httpx client for the running event loop, sized like the sync session and rate limited the same way.
+    httpx only retries failed connects, not error responses
+    """
+    loop = asyncio.get_event_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        pool_size = _pool_size()
+        transport = httpx.AsyncHTTPTransport(retries=_max_retries(),
+                                             limits=httpx.Limits(max_connections=pool_size,
+                                                                 max_keepalive_connections=pool_size))
+        connect, read = _timeouts()
+        client = httpx.AsyncClient(transport=UpstreamAsyncTransport(transport, get_rate_limiter()),
+                                   timeout=httpx.Timeout(read, connect=connect))
+        _async_clients[loop] = client
+    return client
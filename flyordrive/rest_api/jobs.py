@@ -0,0 +1,195 @@
+"""
+Background trip calculations. A job is submitted, runs on a small local pool, and its legs are written to
+sqlite as they're worked out, so the web worker that took the request is free straight away and any worker
+can answer a poll for it.
+
+Jobs only run in the process that accepted them. If that process dies the job never finishes,
+and a poll reports a running job as failed once it's gone STALLED_SECONDS without progress.
+Queued jobs aren't, they may just be waiting behind long running ones
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from .rate_limit import BULK, lane
+from .services.trip_calculator_service import get_trip_calculator_service
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_JOBS_PATH = os.path.join(BASE_DIR, '../jobs.sqlite3')
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobStore:
+    """
+    Job state and partial results, shared by every worker process on the box
+    """
+    # finished jobs are kept around this long for clients to collect
+    RETENTION_SECONDS = 24 * 60 * 60
+    STALLED_SECONDS = 10 * 60
+
+    def __init__(self, path=DEFAULT_JOBS_PATH):
+        self.con = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.con.execute('PRAGMA journal_mode=WAL;')
+            self.con.execute("""CREATE TABLE IF NOT EXISTS job
+                                (id TEXT NOT NULL PRIMARY KEY,
+                                 kind TEXT NOT NULL,
+                                 status TEXT NOT NULL,
+                                 request TEXT NOT NULL,
+                                 partial TEXT NOT NULL,
+                                 result TEXT,
+                                 error TEXT,
+                                 created_at REAL NOT NULL,
+                                 updated_at REAL NOT NULL);""")
+            self.con.execute('CREATE INDEX IF NOT EXISTS job_updated_at ON job (updated_at);')
+            self.con.commit()
+
+    def create(self, kind, request):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self.lock:
+            self.con.execute("""INSERT INTO job (id, kind, status, request, partial, created_at, updated_at)
+                                VALUES (?, ?, ?, ?, '{}', ?, ?);""",
+                             (job_id, kind, QUEUED, json.dumps(request), now, now))
+            self.con.execute('DELETE FROM job WHERE updated_at < ? AND status IN (?, ?);',
+                             (now - self.RETENTION_SECONDS, DONE, FAILED))
+            self.con.commit()
+        return job_id
+
+    def __update(self, job_id, **columns):
+        assignments = ', '.join(f'{column} = ?' for column in columns)
+        with self.lock:
+            self.con.execute(f'UPDATE job SET {assignments}, updated_at = ? WHERE id = ?;',
+                             (*columns.values(), time.time(), job_id))
+            self.con.commit()
+
+    def start(self, job_id):
+        self.__update(job_id, status=RUNNING)
+
+    def add_partial(self, job_id, leg, result):
+        # only the running job writes its partials, so read-modify-write is safe under our lock
+        with self.lock:
+            row = self.con.execute('SELECT partial FROM job WHERE id = ?;', (job_id,)).fetchone()
+            partial = json.loads(row[0])
+            partial[leg] = result
+            self.con.execute('UPDATE job SET partial = ?, updated_at = ? WHERE id = ?;',
+                             (json.dumps(partial), time.time(), job_id))
+            self.con.commit()
+
+    def finish(self, job_id, result):
+        self.__update(job_id, status=DONE, result=json.dumps(result))
+
+    def fail(self, job_id, error):
+        self.__update(job_id, status=FAILED, error=error)
+
+    def recent_requests(self, since):
+        """
+        :param since: unix time
+        :return: [(kind, request dict)] for the jobs submitted since then, newest first
+        """
+        with self.lock:
+            rows = self.con.execute('SELECT kind, request FROM job WHERE created_at >= ? ORDER BY created_at DESC;',
+                                    (since,)).fetchall()
+        return [(kind, json.loads(request)) for kind, request in rows]
+
+    def get(self, job_id):
+        """
+        :return: {'id', 'kind', 'status', 'partial', 'result', 'error'}, or None for an unknown job
+        """
+        with self.lock:
+            row = self.con.execute("""SELECT kind, status, partial, result, error, updated_at
+                                      FROM job WHERE id = ?;""", (job_id,)).fetchone()
+        if row is None:
+            return None
+        kind, status, partial, result, error, updated_at = row
+        # a queued job hasn't had a chance to make progress yet, only a running one can stall
+        if status == RUNNING and updated_at < time.time() - self.STALLED_SECONDS:
+            status, error = FAILED, 'stalled, the worker running it probably went away'
+        return {
+            'id': job_id,
+            'kind': kind,
+            'status': status,
+            'partial': json.loads(partial),
+            'result': json.loads(result) if result is not None else None,
+            'error': error
+        }
+
+
+class JobRunner:
+    """
+    Runs trip, matrix and itinerary calculations in the background, recording each leg (or matrix row) as it finishes
+    """
+
+    def __init__(self, store, service, max_workers=4):
+        self.store = store
+        self.service = service
+        # jobs wait on the shared upstream pool themselves, so they get their own threads
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='flyordrive-job')
+
+    def submit_trip(self, origin, destination, **kwargs):
+        job_id = self.store.create('trip', {'origin': origin, 'destination': destination, **kwargs})
+        self.executor.submit(self.__run, job_id, lambda: self.service.calculate_trip(
+            origin, destination, on_progress=lambda leg, result: self.store.add_partial(job_id, leg, result), **kwargs))
+        return job_id
+
+    def submit_matrix(self, origins, destinations, **kwargs):
+        job_id = self.store.create('matrix', {'origins': origins, 'destinations': destinations, **kwargs})
+
+        def calculate():
+            rows = []
+            # nobody's waiting on a whole matrix, let single trips go first
+            with lane(BULK):
+                for row in self.service.calculate_matrix(origins, destinations, **kwargs):
+                    self.store.add_partial(job_id, row['origin'], row['columns'] if 'columns' in row else row['trips'])
+                    rows.append(row)
+            return rows
+
+        self.executor.submit(self.__run, job_id, calculate)
+        return job_id
+
+    def submit_itinerary(self, stops, round_trip=False, **kwargs):
+        job_id = self.store.create('itinerary', {'stops': stops, 'round_trip': round_trip, **kwargs})
+        self.executor.submit(self.__run, job_id, lambda: self.service.calculate_itinerary(
+            stops, round_trip, on_progress=lambda i, leg: self.store.add_partial(job_id, f'leg_{i}', leg), **kwargs))
+        return job_id
+
+    def __run(self, job_id, calculate):
+        self.store.start(job_id)
+        try:
+            result = calculate()
+        except Exception as e:
+            logger.warning("Job %s failed: %r", job_id, e)
+            self.store.fail(job_id, repr(e))
+            return
+        self.store.finish(job_id, result)
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_job_runner():
+    """
+    FLYORDRIVE_JOBS_DB overrides the sqlite file (an empty string keeps jobs in memory, only for single process
+    deployments), FLYORDRIVE_JOB_WORKERS is how many jobs run at once (default 4)
+    """
+    global _runner
+    if _runner is None:
+        with _runner_lock:
+            if _runner is None:
+                path = os.environ.get('FLYORDRIVE_JOBS_DB', DEFAULT_JOBS_PATH) or ':memory:'
+                max_workers = int(os.environ.get('FLYORDRIVE_JOB_WORKERS', 4))
+                _runner = JobRunner(JobStore(path), get_trip_calculator_service(), max_workers)
+    return _runner
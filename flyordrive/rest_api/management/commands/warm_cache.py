@@ -0,0 +1,161 @@
+from collections import Counter
+from datetime import datetime
+import re
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from ...cache import get_response_cache
+from ...executor import TracingThreadPoolExecutor
+from ...jobs import DEFAULT_JOBS_PATH, JobStore
+from ...metrics import gateway_calls
+from ...rate_limit import BULK, lane
+from ...services.trip_calculator_service import TripCalculatorService
+
+# what TripCalculatorService.calculate_trip logs, under the settings.LOGGING format
+TRIP_LOG_LINE = re.compile(r'^(?:(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)\S* )?.*calculating trip for (.+?) to (.+)$')
+
+
+def read_pairs(path):
+    """
+    :return: [(origin, destination)] from a file of `origin<TAB>destination` lines
+    """
+    pairs = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            try:
+                origin, destination = line.rstrip('\n').split('\t')
+            except ValueError:
+                raise CommandError(f"{path}: expected origin<TAB>destination, got {line.strip()!r}")
+            pairs.append((origin.strip(), destination.strip()))
+    return pairs
+
+
+def read_places(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+
+def job_pairs(requests):
+    """
+    Every trip asked for by background jobs, matrices and itineraries included
+
+    :param requests: [(kind, request dict)] see JobStore.recent_requests
+    """
+    for kind, request in requests:
+        if kind == 'trip':
+            yield request['origin'], request['destination']
+        elif kind == 'matrix':
+            for origin in request['origins']:
+                for destination in request['destinations']:
+                    if origin != destination:
+                        yield origin, destination
+        elif kind == 'itinerary':
+            stops = request['stops'] + (request['stops'][:1] if request.get('round_trip') else [])
+            yield from zip(stops, stops[1:])
+
+
+def log_pairs(path, since):
+    """
+    Trips calculated according to a server log, counting lines without a timestamp whatever since says
+
+    :param since: unix time
+    """
+    with open(path, errors='replace') as f:
+        for line in f:
+            match = TRIP_LOG_LINE.match(line.rstrip('\n'))
+            if match is None:
+                continue
+            logged_at, origin, destination = match.groups()
+            if logged_at is not None and datetime.strptime(logged_at, '%Y-%m-%d %H:%M:%S').timestamp() < since:
+                continue
+            yield origin, destination
+
+
+class Command(BaseCommand):
+    help = ("Work out popular trips ahead of time (geocodes, airport drives, SkyScanner places and quotes, and the trip itself) "
+            "into the shared cache, so the first users after a deploy don't wait on upstreams")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pairs', action='append', default=[], metavar='FILE',
+                            help='origin<TAB>destination per line')
+        parser.add_argument('--places', action='append', default=[], metavar='FILE',
+                            help='a place per line, every trip between them is warmed')
+        parser.add_argument('--from-jobs', action='store_true', help='mine recent background job requests')
+        parser.add_argument('--jobs-db', default=DEFAULT_JOBS_PATH)
+        parser.add_argument('--from-log', action='append', default=[], metavar='FILE',
+                            help='mine the trips a server log says were calculated')
+        parser.add_argument('--since-hours', type=float, default=7 * 24, help='how far back to mine')
+        parser.add_argument('--top', type=int, default=200, help='only warm the N most asked for trips')
+        parser.add_argument('--both-ways', action='store_true', help='warm the way back too, it only costs a quote')
+        parser.add_argument('--airports', type=int, default=0,
+                            help='also look up the SkyScanner places of the N most popular airports, '
+                                 'see warm_skyscanner_places')
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--rate', type=float, default=1.0,
+                            help='trips started per second, upstreams are rate limited on top of this (see rate_limit)')
+        parser.add_argument('--budget-seconds', type=float, default=60,
+                            help="how long each trip gets, longer than a live request's so less of it is estimated")
+
+    def handle(self, *args, **options):
+        counts = self.__count_pairs(options)
+        pairs = [pair for pair, _ in counts.most_common(options['top'])]
+        if options['both_ways']:
+            # the way back goes straight after the way out, so it's turned around from the cached trip
+            pairs = [way for origin, destination in pairs for way in ((origin, destination), (destination, origin))]
+        if not pairs and not options['airports']:
+            raise CommandError("Nothing to warm, give --pairs, --places, --from-jobs, --from-log or --airports")
+
+        # warm real routes rather than estimates, the estimator learns from them too
+        service = TripCalculatorService(road_estimates='fallback', budget_seconds=options['budget_seconds'])
+        calls_before = sum(gateway_calls.values.values())
+        start = time.monotonic()
+        if options['airports']:
+            call_command('warm_skyscanner_places', limit=options['airports'], workers=options['workers'],
+                         stdout=self.stdout, stderr=self.stderr)
+        # the warm-up's upstream calls wait behind live traffic's
+        with lane(BULK), TracingThreadPoolExecutor(max_workers=options['workers'],
+                                                   thread_name_prefix='flyordrive-warm') as pool:
+            failures = self.__warm_trips(service, pool, pairs, options['rate'], options['verbosity'])
+
+        calls = sum(gateway_calls.values.values()) - calls_before
+        stats = get_response_cache().stats.to_dict()
+        self.stdout.write(f"Warmed {len(pairs) - failures} of {len(pairs)} trips in {time.monotonic() - start:.1f}s "
+                          f"with {calls} upstream calls")
+        for namespace, counts in stats.items():
+            self.stdout.write(f"  {namespace:<20} {counts['hits']} hits {counts['misses']} misses")
+
+    def __count_pairs(self, options):
+        counts = Counter()
+        for path in options['pairs']:
+            counts.update(read_pairs(path))
+        for path in options['places']:
+            places = read_places(path)
+            counts.update((origin, destination) for origin in places for destination in places if origin != destination)
+        since = time.time() - options['since_hours'] * 60 * 60
+        if options['from_jobs']:
+            counts.update(job_pairs(JobStore(options['jobs_db']).recent_requests(since)))
+        for path in options['from_log']:
+            counts.update(log_pairs(path, since))
+        return counts
+
+    def __warm_trips(self, service, pool, pairs, rate, verbosity):
+        futures = []
+        start = time.monotonic()
+        for i, (origin, destination) in enumerate(pairs):
+            if rate > 0:
+                # spread the trips out rather than start them all at once
+                time.sleep(max(0.0, start + i / rate - time.monotonic()))
+            futures.append(((origin, destination), pool.submit(service.calculate_trip, origin, destination)))
+
+        failures = 0
+        for (origin, destination), future in futures:
+            if future.exception() is not None:
+                failures += 1
+                self.stderr.write(f'{origin} -> {destination}: {future.exception()!r}')
+            elif verbosity > 1:
+                self.stdout.write(f'{origin} -> {destination}')
+        return failures
@@ -0,0 +1,39 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from ...cache import get_response_cache
+from ...gateways.backends import build_gateway
+from ...gateways.cached_skyscanner_gateway import CachedSkyScannerGateway
+from ...gateways.skyscanner_gateway import SkyScannerGateway
+from ...rate_limit import BULK, lane
+from ...services.airport_index import get_airport_index
+
+
+class Command(BaseCommand):
+    help = "Look up the SkyScanner PlaceId of every known airport ahead of time, so trips don't have to"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=None, help='only warm the N most popular airports')
+        parser.add_argument('--workers', type=int, default=4)
+
+    def handle(self, *args, **options):
+        sky = CachedSkyScannerGateway(build_gateway('skyscanner', SkyScannerGateway), get_response_cache())
+        airports = sorted(get_airport_index().airports, key=lambda a: a.rank)[:options['limit']]
+
+        def warm(airport):
+            try:
+                # background warmup, live trips get the skyscanner budget first
+                with lane(BULK):
+                    return airport.code, sky.autosuggest_place(airport.code)
+            except Exception as e:
+                return airport.code, e
+
+        failures = 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            for code, place_id in pool.map(warm, airports):
+                if isinstance(place_id, Exception):
+                    failures += 1
+                    self.stderr.write(f'{code}: {place_id!r}')
+
+        self.stdout.write(f'Warmed {len(airports) - failures} of {len(airports)} airports')
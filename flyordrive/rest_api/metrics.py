@@ -0,0 +1,286 @@
+"""
+In-process metrics and trip tracing, rendered in the Prometheus text format by the /metrics view.
+
+- span(stage) times a stage of a trip calculation into flyordrive_stage_seconds and logs it
+- InstrumentedGateway counts and times every real upstream call (cache misses only, since it sits under the caches)
+- trace() groups the upstream calls made on behalf of one trip, so we know what each trip costs
+
+Each process keeps its own numbers, scrape every worker
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CALLS_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+
+
+def _labels(labelnames, values):
+    if not labelnames:
+        return ''
+    pairs = ','.join(f'{name}="{value}"' for name, value in zip(labelnames, values))
+    return '{' + pairs + '}'
+
+
+def _number(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for labels, value in sorted(values.items()):
+            yield f'{self.name}{_labels(self.labelnames, labels)} {_number(value)}'
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # labels -> [per bucket counts (last one is +Inf), sum, count]
+        self.values = {}
+
+    def observe(self, value, *labels):
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self.lock:
+            values = {labels: ([*counts], total, count) for labels, (counts, total, count) in self.values.items()}
+        for labels, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip([*self.buckets, '+Inf'], counts):
+                cumulative += bucket_count
+                le = bound if bound == '+Inf' else _number(bound)
+                yield f'{self.name}_bucket{_labels((*self.labelnames, "le"), (*labels, le))} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}'
+            yield f'{self.name}_count{_labels(self.labelnames, labels)} {count}'
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, help_text, labelnames=()):
+        metric = Counter(name, help_text, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect):
+        """
+        :param collect: called on every scrape, returns a list of (name, kind, help, [(labels dict, value), ...])
+        """
+        self.collectors.append(collect)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        for collect in self.collectors:
+            for name, kind, help_text, samples in collect():
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in samples:
+                    lines.append(f'{name}{_labels(tuple(labels), tuple(labels.values()))} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+gateway_calls = registry.counter('flyordrive_gateway_calls_total',
+                                 'Upstream API calls', ('gateway', 'method'))
+gateway_errors = registry.counter('flyordrive_gateway_errors_total',
+                                  'Upstream API calls that raised', ('gateway', 'method'))
+gateway_latency = registry.histogram('flyordrive_gateway_latency_seconds',
+                                     'Upstream API call latency', ('gateway', 'method'))
+stage_latency = registry.histogram('flyordrive_stage_seconds',
+                                   'Time spent in each stage of a trip calculation, cache hits included', ('stage',))
+stage_errors = registry.counter('flyordrive_stage_errors_total',
+                                'Trip calculation stages that raised', ('stage',))
+trip_calls = registry.histogram('flyordrive_trip_upstream_calls',
+                                'Upstream API calls made for one trip calculation', ('kind',), buckets=CALLS_BUCKETS)
+
+
+class TripTrace:
+    """
+    Upstream calls made on behalf of one trip (or matrix), by gateway
+    """
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def record_call(self, gateway):
+        with self.lock:
+            self.calls[gateway] = self.calls.get(gateway, 0) + 1
+
+    @property
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+
+_local = threading.local()
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+def set_current_trace(trip_trace):
+    _local.trace = trip_trace
+
+
+@contextmanager
+def trace(kind, **fields):
+    """
+    Trace one trip calculation: the whole thing is a span, and calls made by gateways on this thread
+    (or on pool threads it submitted to, see executor.get_executor) are counted against it
+    """
+    trip_trace = TripTrace(kind)
+    previous = current_trace()
+    set_current_trace(trip_trace)
+    try:
+        with span(kind, **fields):
+            yield trip_trace
+    finally:
+        set_current_trace(previous)
+        trip_calls.observe(trip_trace.total_calls, kind)
+        logger.info('%s upstream calls=%d %s', kind, trip_trace.total_calls,
+                    ' '.join(f'{gateway}={n}' for gateway, n in sorted(trip_trace.calls.items())))
+
+
+@contextmanager
+def span(stage, **fields):
+    """
+    Time a stage into flyordrive_stage_seconds and log it, e.g. with span('geocode', place=place): ...
+    Yields the fields, so anything worked out inside the stage can be added to the log line
+    """
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield fields
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        stage_latency.observe(seconds, stage)
+        if failed:
+            stage_errors.inc(stage)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('span stage=%s ms=%.1f failed=%s %s', stage, seconds * 1000, failed,
+                         ' '.join(f'{key}={value!r}' for key, value in fields.items()))
+
+
+def _record_call(name, method, start, failed):
+    gateway_calls.inc(name, method)
+    gateway_latency.observe(time.perf_counter() - start, name, method)
+    if failed:
+        gateway_errors.inc(name, method)
+
+
+class InstrumentedGateway:
+    """
+    Counts and times every call into a raw gateway, and charges it to the current trip trace
+    """
+
+    def __init__(self, name, gateway):
+        self.name = name
+        self.gateway = gateway
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        fn = getattr(self.gateway, method)
+
+        def call(*args, **kwargs):
+            trip_trace = current_trace()
+            if trip_trace is not None:
+                trip_trace.record_call(self.name)
+            start = time.perf_counter()
+            failed = True
+            try:
+                result = fn(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                _record_call(self.name, method, start, failed)
+
+        return call
+
+
+class AsyncInstrumentedGateway(InstrumentedGateway):
+    """
+    InstrumentedGateway for the async gateways. Coroutines don't have a thread of their own,
+    so calls are counted and timed but not charged to a trip trace
+    """
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        fn = getattr(self.gateway, method)
+
+        async def call(*args, **kwargs):
+            start = time.perf_counter()
+            failed = True
+            try:
+                result = await fn(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                _record_call(self.name, method, start, failed)
+
+        return call
+
+
+def cache_collector(cache):
+    """
+    Exposes a TieredCache's per namespace hit/miss counts
+    """
+    def collect():
+        stats = cache.stats.to_dict()
+        return [
+            ('flyordrive_cache_hits_total', 'counter', 'Response cache hits',
+             [({'namespace': ns}, counts['hits']) for ns, counts in stats.items()]),
+            ('flyordrive_cache_misses_total', 'counter', 'Response cache misses',
+             [({'namespace': ns}, counts['misses']) for ns, counts in stats.items()]),
+        ]
+    return collect
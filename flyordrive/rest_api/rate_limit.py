@@ -0,0 +1,370 @@
+"""
+Keeps upstream requests within each provider's rate limits, across every worker process on the box.
+
+Each provider has a token bucket (rate per second, burst) kept in a small sqlite db, and every http request
+the gateways make takes its cost out of its provider's bucket first, waiting for the refill if it's empty.
+Requests are matched to providers by url (see PROVIDERS), so one gateway method making several requests
+pays for each of them.
+
+Work runs in one of two lanes, set per thread with `with lane(BULK): ...` and carried over to the upstream pool
+by executor.TracingThreadPoolExecutor. Interactive work (the default) goes first: bulk requests wait while
+anything interactive is waiting on the same provider in this process, and leave the last BULK_RESERVE of
+each bucket to interactive requests from other processes.
+
+FLYORDRIVE_RATE_LIMITS overrides budgets, e.g. `skyscanner=2/10,eia=1` (per second, then optional burst),
+FLYORDRIVE_RATE_LIMIT_DB overrides the sqlite file (an empty string keeps the buckets per process)
+"""
+import asyncio
+from contextlib import contextmanager
+import logging
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from .deadline import remaining
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_RATE_LIMIT_PATH = os.path.join(BASE_DIR, '../rate_limit.sqlite3')
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+LANES = (INTERACTIVE, BULK)
+
+# share of each bucket only interactive requests can take
+BULK_RESERVE = 0.2
+# how long a request will wait for its turn before giving up
+DEFAULT_MAX_WAIT_SECONDS = 30
+# longest single sleep between tries, so waiters notice when a bucket is drained or interactive work shows up
+MAX_SLEEP_SECONDS = 0.25
+
+
+def _elements(query):
+    # distance matrix is billed and limited per origin x destination
+    params = parse_qs(query)
+    origins = params.get('origins', [''])[0].split('|')
+    destinations = params.get('destinations', [''])[0].split('|')
+    return max(1, len(origins) * len(destinations))
+
+
+# (provider, url prefix without the scheme, cost of one request from its query string), first match wins
+PROVIDERS = (
+    ('distance_matrix', 'maps.googleapis.com/maps/api/distancematrix/', _elements),
+    ('places', 'maps.googleapis.com/maps/api/place/', None),
+    ('geocoding', 'maps.googleapis.com/maps/api/geocode/', None),
+    ('skyscanner', 'skyscanner-skyscanner-flight-search-v1.p.rapidapi.com/', None),
+    ('eia', 'api.eia.gov/', None),
+)
+
+# (per second, burst)
+DEFAULT_BUDGETS = {
+    # https://developers.google.com/maps/documentation/distance-matrix/usage-and-billing#other-usage-limits
+    'distance_matrix': (1000, 1000),
+    'places': (50, 50),
+    'geocoding': (50, 50),
+    # rapidapi's basic plan
+    'skyscanner': (5, 10),
+    # EIA allows around 5000 an hour
+    'eia': (1, 10),
+}
+
+waits = registry.histogram('flyordrive_rate_limit_wait_seconds',
+                           'Time requests that found their provider budget used up spent waiting', ('provider', 'lane'))
+rejected = registry.counter('flyordrive_rate_limit_rejected_total',
+                            'Requests that gave up waiting for their provider budget', ('provider', 'lane'))
+throttled = registry.counter('flyordrive_upstream_throttled_total',
+                             'Upstream responses that said we were over their rate limit (429)', ('provider',))
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+_local = threading.local()
+
+
+def current_lane():
+    return getattr(_local, 'lane', INTERACTIVE)
+
+
+def set_current_lane(name):
+    _local.lane = name
+
+
+@contextmanager
+def lane(name):
+    """
+    Run the block's upstream requests in a lane, INTERACTIVE or BULK
+    """
+    if name not in LANES:
+        raise ValueError(f"lane must be one of {LANES}, got {name!r}")
+    previous = current_lane()
+    set_current_lane(name)
+    try:
+        yield
+    finally:
+        set_current_lane(previous)
+
+
+def iterate_in_lane(name, iterable):
+    """
+    Lazily iterate in a lane, e.g. for a streamed response. The lane is only set while the next item
+    is being worked out, so it never leaks into whatever the consumer does in between
+    """
+    items = iter(iterable)
+    while True:
+        with lane(name):
+            item = next(items, _DONE)
+        if item is _DONE:
+            return
+        yield item
+
+
+_DONE = object()
+
+
+def provider_for(url):
+    """
+    :return: (provider, cost) of a request to url, provider is None for hosts we don't limit
+    """
+    parts = urlsplit(url)
+    location = parts.netloc + parts.path
+    for provider, prefix, cost in PROVIDERS:
+        if location.startswith(prefix):
+            return provider, cost(parts.query) if cost is not None else 1
+    return None, 0
+
+
+def parse_budgets(spec):
+    """
+    :param spec: e.g. 'skyscanner=2/10,eia=1', per second then optional burst (defaults to a second's worth)
+    :return: {provider: (rate, burst)}
+    """
+    budgets = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        try:
+            provider, budget = item.split('=')
+            rate, _, burst = budget.partition('/')
+            rate = float(rate)
+            burst = float(burst) if burst else max(rate, 1)
+        except ValueError:
+            raise ValueError(f"FLYORDRIVE_RATE_LIMITS entries look like provider=rate[/burst], got {item!r}")
+        if rate <= 0 or burst < 1:
+            raise ValueError(f"FLYORDRIVE_RATE_LIMITS needs a positive rate and a burst of at least 1, got {item!r}")
+        budgets[provider.strip()] = (rate, burst)
+    return budgets
+
+
+class MemoryBuckets:
+    """
+    Token buckets for this process only
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # provider -> [tokens, updated_at]
+        self.buckets = {}
+
+    def take(self, provider, rate, burst, cost, keep):
+        """
+        Take cost tokens if that leaves at least keep behind
+
+        :return: 0 if they were taken, otherwise roughly how many seconds until they could be
+        """
+        now = time.time()
+        with self.lock:
+            bucket = self.buckets.setdefault(provider, [burst, now])
+            return _take(bucket, now, rate, burst, cost, keep)
+
+    def drain(self, provider):
+        with self.lock:
+            self.buckets[provider] = [0.0, time.time()]
+
+
+def _take(bucket, now, rate, burst, cost, keep):
+    tokens, updated_at = bucket
+    # wall clock, so buckets mean the same in every process. a clock going backwards only refills nothing
+    tokens = min(burst, tokens + max(0.0, now - updated_at) * rate)
+    # a request costing more than the whole bucket can still go once it's full
+    need = min(cost, burst) + keep
+    if tokens >= need:
+        bucket[:] = [tokens - cost, now]
+        return 0
+    bucket[:] = [tokens, now]
+    return (need - tokens) / rate
+
+
+class SqliteBuckets:
+    """
+    Token buckets shared by every worker process on the box. Each take is one short write transaction
+    """
+
+    def __init__(self, path=DEFAULT_RATE_LIMIT_PATH):
+        # autocommit mode, take manages its own transactions
+        self.con = sqlite3.connect(path, check_same_thread=False, timeout=5, isolation_level=None)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.con.execute('PRAGMA journal_mode=WAL;')
+            # losing the last few takes in a power cut doesn't matter, syncing every one would
+            self.con.execute('PRAGMA synchronous=OFF;')
+            self.con.execute("""CREATE TABLE IF NOT EXISTS bucket
+                                (provider TEXT NOT NULL PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL);""")
+
+    def take(self, provider, rate, burst, cost, keep):
+        now = time.time()
+        with self.lock:
+            # IMMEDIATE takes the write lock up front, so two processes can't both read the same tokens
+            self.con.execute('BEGIN IMMEDIATE;')
+            try:
+                row = self.con.execute('SELECT tokens, updated_at FROM bucket WHERE provider = ?;', (provider,)).fetchone()
+                bucket = list(row) if row is not None else [burst, now]
+                wait = _take(bucket, now, rate, burst, cost, keep)
+                self.con.execute('INSERT OR REPLACE INTO bucket (provider, tokens, updated_at) VALUES (?, ?, ?);',
+                                 (provider, *bucket))
+                self.con.execute('COMMIT;')
+            except BaseException:
+                self.con.execute('ROLLBACK;')
+                raise
+        return wait
+
+    def drain(self, provider):
+        with self.lock:
+            self.con.execute('INSERT OR REPLACE INTO bucket (provider, tokens, updated_at) VALUES (?, 0, ?);',
+                             (provider, time.time()))
+
+
+class RateLimiter:
+    def __init__(self, buckets, budgets=None, max_wait_seconds=DEFAULT_MAX_WAIT_SECONDS):
+        """
+        :param buckets: MemoryBuckets or SqliteBuckets
+        :param budgets: {provider: (per second, burst)}, providers without one aren't limited
+        :param max_wait_seconds: give up with RateLimitExceeded after waiting this long
+        """
+        self.buckets = buckets
+        self.budgets = dict(DEFAULT_BUDGETS if budgets is None else budgets)
+        self.max_wait_seconds = max_wait_seconds
+        self.lock = threading.Lock()
+        # (provider, lane) -> requests waiting in this process
+        self.waiting = {}
+
+    def __enter(self, provider, lane_name, amount):
+        with self.lock:
+            key = (provider, lane_name)
+            self.waiting[key] = self.waiting.get(key, 0) + amount
+
+    def __try(self, provider, lane_name, cost):
+        """
+        :return: 0 if the request can go now, otherwise how long to wait before trying again
+        """
+        rate, burst = self.budgets[provider]
+        if lane_name == BULK:
+            with self.lock:
+                if self.waiting.get((provider, INTERACTIVE)):
+                    return MAX_SLEEP_SECONDS
+            # a bucket too small to hold the reserve on top of the request keeps what it can,
+            # otherwise bulk requests could never go at all
+            keep = min(burst * BULK_RESERVE, burst - min(cost, burst))
+        else:
+            keep = 0
+        return self.buckets.take(provider, rate, burst, cost, keep)
+
+    def __check(self, provider, lane_name, start, wait):
+        left = remaining()
+        max_wait = self.max_wait_seconds if left is None else min(self.max_wait_seconds, time.perf_counter() - start + left)
+        if time.perf_counter() - start + wait > max_wait:
+            rejected.inc(provider, lane_name)
+            raise RateLimitExceeded(f"{provider} budget of {self.budgets[provider][0]}/s is used up, "
+                                    f"gave up waiting after {time.perf_counter() - start:.1f}s")
+        return min(wait, MAX_SLEEP_SECONDS)
+
+    def acquire(self, url):
+        """
+        Wait until a request to url is within its provider's budget
+
+        :raise RateLimitExceeded: if that would take longer than max_wait_seconds, or than the deadline allows
+        """
+        provider, cost = provider_for(url)
+        if provider not in self.budgets:
+            return
+        lane_name = current_lane()
+        start = time.perf_counter()
+        wait = self.__try(provider, lane_name, cost)
+        if not wait:
+            return
+        self.__enter(provider, lane_name, 1)
+        try:
+            while wait:
+                time.sleep(self.__check(provider, lane_name, start, wait))
+                wait = self.__try(provider, lane_name, cost)
+        finally:
+            self.__enter(provider, lane_name, -1)
+            waits.observe(time.perf_counter() - start, provider, lane_name)
+
+    async def acquire_async(self, url):
+        """
+        acquire without blocking the event loop. Coroutines don't have a thread of their own, so always interactive.
+        Taking from the bucket can wait on a lock and a sqlite write, so that happens on the loop's default executor
+        """
+        provider, cost = provider_for(url)
+        if provider not in self.budgets:
+            return
+        loop = asyncio.get_event_loop()
+        start = time.perf_counter()
+        wait = await loop.run_in_executor(None, self.__try, provider, INTERACTIVE, cost)
+        if not wait:
+            return
+        self.__enter(provider, INTERACTIVE, 1)
+        try:
+            while wait:
+                await asyncio.sleep(self.__check(provider, INTERACTIVE, start, wait))
+                wait = await loop.run_in_executor(None, self.__try, provider, INTERACTIVE, cost)
+        finally:
+            self.__enter(provider, INTERACTIVE, -1)
+            waits.observe(time.perf_counter() - start, provider, INTERACTIVE)
+
+    def throttled(self, url):
+        """
+        The provider said we're over its limit anyway (e.g. someone else is using the same key),
+        empty the bucket so every process backs off rather than piling on retries
+        """
+        provider, _ = provider_for(url)
+        if provider is None:
+            return
+        throttled.inc(provider)
+        if provider in self.budgets:
+            logger.warning("%s is throttling us, backing off", provider)
+            self.buckets.drain(provider)
+
+    def collect(self):
+        """
+        Queue depth for the /metrics view
+        """
+        with self.lock:
+            waiting = dict(self.waiting)
+        return [('flyordrive_rate_limit_waiting', 'gauge', 'Requests in this process waiting for their provider budget',
+                 [({'provider': provider, 'lane': lane_name}, count)
+                  for (provider, lane_name), count in sorted(waiting.items())])]
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """
+    Process-wide limiter, see the module docstring for configuration
+    """
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                path = os.environ.get('FLYORDRIVE_RATE_LIMIT_DB', DEFAULT_RATE_LIMIT_PATH)
+                budgets = {**DEFAULT_BUDGETS, **parse_budgets(os.environ.get('FLYORDRIVE_RATE_LIMITS', ''))}
+                max_wait_seconds = float(os.environ.get('FLYORDRIVE_RATE_LIMIT_MAX_WAIT', DEFAULT_MAX_WAIT_SECONDS))
+                _limiter = RateLimiter(SqliteBuckets(path) if path else MemoryBuckets(), budgets, max_wait_seconds)
+                registry.add_collector(_limiter.collect)
+    return _limiter
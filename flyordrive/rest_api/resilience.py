@@ -0,0 +1,316 @@
+"""
+Keeps slow or failing upstreams from dragging trips down with them, wrapped around every gateway by gateways.backends:
+
+- circuit breakers: after FAILURES_TO_OPEN failures in a row a gateway's calls fail straight away for OPEN_SECONDS,
+  so trips fall back to cached or estimated data at once instead of waiting on it. Then one call is let through
+  to see if it's back
+- hedged requests: an interactive call that's taking longer than the gateway method's usual p95 is sent again,
+  and whichever answer comes first is used. Hedges are capped at HEDGE_RATIO of calls so a slow upstream
+  doesn't get twice the load
+- deadlines: calls give up when the trip's deadline (see deadline.py) passes, even if the upstream hasn't
+
+Breakers are per process
+"""
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+import asyncio
+import logging
+import threading
+import time
+
+from .deadline import DeadlineExceeded, remaining
+from .executor import TracingThreadPoolExecutor
+from .metrics import registry
+from .rate_limit import BULK, RateLimitExceeded, current_lane
+
+logger = logging.getLogger(__name__)
+
+FAILURES_TO_OPEN = 5
+OPEN_SECONDS = 30
+# calls to a method before its p95 is trusted enough to hedge on
+MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+HEDGE_RATIO = 0.05
+# never hedge sooner than this, a few ms of scheduling noise isn't worth a second request
+MIN_HEDGE_DELAY_SECONDS = 0.02
+# errors about the request rather than the upstream: no result for a place, no fixture,
+# our own rate limits, or the trip running out of time before the call could be made.
+# they don't count for or against the upstream (but see UpstreamTimeout)
+NOT_UPSTREAM_FAILURES = (LookupError, RateLimitExceeded, DeadlineExceeded)
+
+hedges = registry.counter('flyordrive_hedged_calls_total',
+                          'Upstream calls sent a second time because the first was slower than usual', ('gateway', 'method'))
+hedge_wins = registry.counter('flyordrive_hedge_wins_total',
+                              'Hedged calls where the second request answered first', ('gateway', 'method'))
+circuit_rejected = registry.counter('flyordrive_circuit_rejected_total',
+                                    'Upstream calls failed straight away because the circuit was open', ('gateway',))
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class UpstreamTimeout(DeadlineExceeded):
+    """
+    The call was made but the upstream didn't answer before the deadline. That one's on the upstream,
+    unlike a DeadlineExceeded from running out of time before the call
+    """
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failures_to_open=FAILURES_TO_OPEN, open_seconds=OPEN_SECONDS):
+        self.name = name
+        self.failures_to_open = failures_to_open
+        self.open_seconds = open_seconds
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def before_call(self):
+        """
+        :raise CircuitOpen: if the call shouldn't be made
+        """
+        with self.lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.open_seconds:
+                self.state = self.HALF_OPEN
+            if self.state == self.CLOSED:
+                return
+            # half open lets a single call through to find out if the upstream is back
+            if self.state == self.HALF_OPEN and not self.trial_running:
+                self.trial_running = True
+                return
+        circuit_rejected.inc(self.name)
+        raise CircuitOpen(f"{self.name} is failing, not calling it for now")
+
+    def abandon(self):
+        """
+        The call was cancelled, so it says nothing either way
+        """
+        with self.lock:
+            self.trial_running = False
+
+    def record(self, error):
+        """
+        :param error: what the call raised, None if it worked
+        """
+        with self.lock:
+            self.trial_running = False
+            if isinstance(error, NOT_UPSTREAM_FAILURES) and not isinstance(error, UpstreamTimeout):
+                # says nothing about the upstream either way, a half open circuit tries again with the next call
+                return
+            if error is None:
+                if self.state != self.CLOSED:
+                    logger.warning("%s is answering again, closing its circuit", self.name)
+                self.state = self.CLOSED
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failures_to_open:
+                if self.state != self.OPEN:
+                    logger.warning("Opening %s's circuit after %d failures, last %r", self.name, self.failures, error)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """
+    Recent latencies of one gateway method, for picking when to hedge
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=LATENCY_WINDOW)
+        self.p95 = None
+        self.calls = 0
+        self.hedged = 0
+
+    def observe(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+            # sorting the window on every call would cost more than it's worth
+            if len(self.samples) >= MIN_SAMPLES and (self.p95 is None or len(self.samples) % 10 == 0):
+                ordered = sorted(self.samples)
+                self.p95 = ordered[int(len(ordered) * 0.95) - 1]
+
+    def hedge_delay(self):
+        """
+        :return: how long to wait before hedging a call, None if it shouldn't be
+        """
+        with self.lock:
+            self.calls += 1
+            if self.p95 is None or self.hedged >= self.calls * HEDGE_RATIO:
+                return None
+            return max(self.p95, MIN_HEDGE_DELAY_SECONDS)
+
+    def hedging(self):
+        with self.lock:
+            self.hedged += 1
+
+
+class ResilientGateway:
+    """
+    Circuit breaker, hedging and deadlines around a sync gateway, by method name
+    """
+    _pool = None
+    _pool_lock = threading.Lock()
+
+    def __init__(self, name, gateway, breaker=None):
+        self.name = name
+        self.gateway = gateway
+        self.breaker = breaker or get_circuit_breaker(name)
+        self.latencies = {}
+
+    @classmethod
+    def pool(cls):
+        # calls wait on the pool rather than make the request themselves, so they can stop waiting when they need to.
+        # gateway methods never submit work of their own, so a busy pool can't deadlock
+        if cls._pool is None:
+            with cls._pool_lock:
+                if cls._pool is None:
+                    cls._pool = TracingThreadPoolExecutor(max_workers=64, thread_name_prefix='flyordrive-hedge')
+        return cls._pool
+
+    def latency(self, method):
+        tracker = self.latencies.get(method)
+        if tracker is None:
+            tracker = self.latencies.setdefault(method, LatencyTracker())
+        return tracker
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        fn = getattr(self.gateway, method)
+
+        def call(*args, **kwargs):
+            self.breaker.before_call()
+            try:
+                result = self.__call(method, fn, args, kwargs)
+            except Exception as e:
+                self.breaker.record(e)
+                raise
+            self.breaker.record(None)
+            return result
+
+        return call
+
+    def __call(self, method, fn, args, kwargs):
+        tracker = self.latency(method)
+        # background work isn't waiting on anyone, a second request isn't worth it
+        delay = tracker.hedge_delay() if current_lane() != BULK else None
+        left = remaining()
+        if delay is None and left is None:
+            start = time.perf_counter()
+            result = fn(*args, **kwargs)
+            tracker.observe(time.perf_counter() - start)
+            return result
+
+        start = time.perf_counter()
+        futures = [self.pool().submit(fn, *args, **kwargs)]
+        if delay is not None and (left is None or left > delay):
+            done, _ = wait(futures, timeout=delay)
+            if not done:
+                tracker.hedging()
+                hedges.inc(self.name, method)
+                futures.append(self.pool().submit(fn, *args, **kwargs))
+
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=remaining(), return_when=FIRST_COMPLETED)
+            if not done:
+                raise UpstreamTimeout(f"{self.name}.{method} didn't answer in time")
+            for future in done:
+                if future.exception() is None:
+                    tracker.observe(time.perf_counter() - start)
+                    if future is not futures[0]:
+                        hedge_wins.inc(self.name, method)
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+
+class AsyncResilientGateway(ResilientGateway):
+    """
+    ResilientGateway for the async gateways. Coroutines don't have a deadline of their own,
+    the async service bounds each call with asyncio.wait_for instead
+    """
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        fn = getattr(self.gateway, method)
+
+        async def call(*args, **kwargs):
+            self.breaker.before_call()
+            try:
+                result = await self.__call(method, fn, args, kwargs)
+            except asyncio.CancelledError:
+                self.breaker.abandon()
+                raise
+            except Exception as e:
+                self.breaker.record(e)
+                raise
+            self.breaker.record(None)
+            return result
+
+        return call
+
+    async def __call(self, method, fn, args, kwargs):
+        tracker = self.latency(method)
+        delay = tracker.hedge_delay()
+        start = time.perf_counter()
+        tasks = [asyncio.ensure_future(fn(*args, **kwargs))]
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    tracker.hedging()
+                    hedges.inc(self.name, method)
+                    tasks.append(asyncio.ensure_future(fn(*args, **kwargs)))
+
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        tracker.observe(time.perf_counter() - start)
+                        if task is not tasks[0]:
+                            hedge_wins.inc(self.name, method)
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name):
+    """
+    The process-wide breaker for an upstream, shared by the sync and async gateways
+    """
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(name)
+        return breaker
+
+
+def _collect_breakers():
+    with _breakers_lock:
+        breakers = sorted(_breakers.items())
+    return [('flyordrive_circuit_open', 'gauge', 'Whether calls to an upstream are failing fast (1) or going through (0)',
+             [({'gateway': name}, int(breaker.state != CircuitBreaker.CLOSED)) for name, breaker in breakers])]
+
+
+registry.add_collector(_collect_breakers)
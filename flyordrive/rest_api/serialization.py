@@ -0,0 +1,37 @@
+"""
+JSON for responses. orjson is used when it's installed (pip install orjson), it's several times faster
+than the standard library on big matrix and itinerary responses. Either way the output is compact
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(value):
+    """
+    :return: the json as bytes with orjson, otherwise as str. HttpResponse takes either
+    """
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(',', ':'))
+
+
+def dumps_str(value):
+    """
+    :return: the json as str either way, for callers that want text rather than a response body
+    """
+    if orjson is not None:
+        return orjson.dumps(value).decode()
+    return json.dumps(value, separators=(',', ':'))
+
+
+def dumps_line(value):
+    """
+    One line of newline delimited json
+    """
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_APPEND_NEWLINE)
+    return json.dumps(value, separators=(',', ':')) + '\n'
@@ -0,0 +1,321 @@
+import heapq
+import logging
+from math import radians, cos, sin, asin, sqrt, pi
+import os.path
+import sqlite3
+import threading
+
+import numpy as np
+
+from .domain import Airport
+from .geo import k_smallest, pairwise_haversine_km
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371
+# bound the (queries x airports) distance matrix built per batch
+MAX_BATCH_ELEMENTS = 4 * 1024 * 1024
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DB_PATH = os.path.join(BASE_DIR, '../../db.sqlite3')
+DEFAULT_AIRPORTS_FILE = os.path.join(BASE_DIR, '../../major_airport_locations.txt')
+# written by scripts/populate_sqlite.py next to the db
+DEFAULT_SNAPSHOT_PATH = os.path.join(BASE_DIR, '../../airport_index.npz')
+SNAPSHOT_VERSION = 1
+
+
+def to_unit_vector(lat, lng):
+    lat, lng = radians(lat), radians(lng)
+    return cos(lat) * cos(lng), cos(lat) * sin(lng), sin(lat)
+
+
+def unit_vectors(coords):
+    """
+    :param coords: (n, 2) array of lat, lng
+    :return: (n, 3) array, the rows match to_unit_vector
+    """
+    lat, lng = np.radians(coords[:, 0]), np.radians(coords[:, 1])
+    return np.stack((np.cos(lat) * np.cos(lng), np.cos(lat) * np.sin(lng), np.sin(lat)), axis=1)
+
+
+def chord_to_km(chord):
+    # straight line through the sphere -> great circle distance
+    return 2 * asin(min(1.0, chord / 2)) * EARTH_RADIUS_KM
+
+
+def km_to_chord(km):
+    return 2 * sin(min(km / EARTH_RADIUS_KM, pi) / 2)
+
+
+class AirportIndex:
+    """
+    k-d tree over airports projected onto the unit sphere.
+
+    Euclidean (chord) distance between unit vectors is monotonic in great circle distance,
+    so nearest-by-chord is nearest-by-haversine and we never have to deal with the antimeridian.
+    """
+
+    def __init__(self, airports, tree=None):
+        """
+        :param airports: Airport list, in popularity order
+        :param tree: (index, axis, left, right) node lists from a snapshot, built from scratch if None
+        """
+        self.airports = list(airports)
+        self.coords = np.array([a.coords() for a in self.airports], dtype=float).reshape(-1, 2)
+        self.points = unit_vectors(self.coords).tolist()
+        if tree is None:
+            tree = self.__build()
+        # node n is airport index[n] split on axis[n], children are node numbers or -1. the root is the middle node
+        self.index, self.axis, self.left, self.right = tree
+        self.__by_code = None
+
+    def __len__(self):
+        return len(self.airports)
+
+    def airport(self, code):
+        """
+        :return: the Airport with that code, or None
+        """
+        if self.__by_code is None:
+            # only fare estimates need this, most processes never build it
+            self.__by_code = {airport.code: airport for airport in self.airports}
+        return self.__by_code.get(code)
+
+    def __build(self):
+        """
+        Median split one level at a time, all of a level's subtrees at once with a single lexsort,
+        which is a lot quicker than recursing in python on big tables. Each subtree keeps to its own
+        slice of the ordering, with its median in the middle, so that position is the node number
+        and its children are the middles of the slices either side
+        """
+        n = len(self.airports)
+        points = np.array(self.points).reshape(-1, 3)
+        order = np.arange(n)
+        axis = np.zeros(n, dtype=np.int64)
+        left = np.full(n, -1, dtype=np.int64)
+        right = np.full(n, -1, dtype=np.int64)
+        # marks where a slice starts, medians are slices of their own once placed
+        starts_mask = np.zeros(n + 1, dtype=bool)
+        starts, ends = np.array([0]), np.array([n])
+        depth = 0
+        while n and len(starts):
+            slice_ids = np.cumsum(starts_mask[:n])
+            order = order[np.lexsort((points[order, depth % 3], slice_ids))]
+            mids = (starts + ends) // 2
+            axis[mids] = depth % 3
+            has_left, has_right = mids > starts, ends > mids + 1
+            left[mids[has_left]] = ((starts + mids) // 2)[has_left]
+            right[mids[has_right]] = ((mids + 1 + ends) // 2)[has_right]
+            starts_mask[mids] = True
+            starts_mask[mids + 1] = True
+            starts, ends = np.concatenate((starts[has_left], mids[has_right] + 1)), \
+                np.concatenate((mids[has_left], ends[has_right]))
+            depth += 1
+        return order.tolist(), axis.tolist(), left.tolist(), right.tolist()
+
+    def __dist2(self, i, point):
+        p = self.points[i]
+        return (p[0] - point[0]) ** 2 + (p[1] - point[1]) ** 2 + (p[2] - point[2]) ** 2
+
+    def nearest(self, coords, k=1):
+        """
+        :param coords: (lat, lng)
+        :param k: number of airports to return
+        :return: list of (Airport, distance_km), closest first
+        """
+        point = to_unit_vector(*coords)
+        # max-heap of the best k so far, stored as (-dist2, -index)
+        # so that ties go to the more popular (earlier) airport
+        best = []
+
+        def visit(node):
+            if node < 0:
+                return
+            i = self.index[node]
+            d2 = self.__dist2(i, point)
+            item = (-d2, -i)
+            if len(best) < k:
+                heapq.heappush(best, item)
+            elif item > best[0]:
+                heapq.heapreplace(best, item)
+
+            axis = self.axis[node]
+            diff = point[axis] - self.points[i][axis]
+            near, far = (self.left[node], self.right[node]) if diff < 0 else (self.right[node], self.left[node])
+            visit(near)
+            if len(best) < k or diff ** 2 <= -best[0][0]:
+                visit(far)
+
+        visit(len(self.index) // 2 if self.index else -1)
+        return [(self.airports[-i], chord_to_km(sqrt(-d2))) for d2, i in sorted(best, reverse=True)]
+
+    def within_radius(self, coords, radius_km):
+        """
+        :param coords: (lat, lng)
+        :param radius_km: great circle search radius
+        :return: list of (Airport, distance_km), closest first
+        """
+        point = to_unit_vector(*coords)
+        max_d2 = km_to_chord(radius_km) ** 2
+        found = []
+
+        def visit(node):
+            if node < 0:
+                return
+            i = self.index[node]
+            d2 = self.__dist2(i, point)
+            if d2 <= max_d2:
+                found.append((d2, i))
+
+            axis = self.axis[node]
+            diff = point[axis] - self.points[i][axis]
+            near, far = (self.left[node], self.right[node]) if diff < 0 else (self.right[node], self.left[node])
+            visit(near)
+            if diff ** 2 <= max_d2:
+                visit(far)
+
+        visit(len(self.index) // 2 if self.index else -1)
+        return [(self.airports[i], chord_to_km(sqrt(d2))) for d2, i in sorted(found)]
+
+    def distances_from(self, coords_list):
+        """
+        :param coords_list: (lat, lng) of each query point
+        :return: (queries, airports) array of great circle distances in km
+        """
+        return pairwise_haversine_km(coords_list, self.coords)
+
+    def nearest_many(self, coords_list, k=1):
+        """
+        nearest by brute force, ranking the whole table for many query points with array operations.
+        Only quicker per query than nearest on tables of a hundred or so airports, where either takes microseconds,
+        and far slower on big ones (see scripts/benchmark.py nearest), so the service doesn't use it.
+        It's the reference the k-d tree is checked against
+
+        :param coords_list: list of (lat, lng)
+        :param k: number of airports per query point
+        :return: list with a [(Airport, distance_km), ...] list for each query point, closest first
+        """
+        results = []
+        batch_size = max(1, MAX_BATCH_ELEMENTS // max(1, len(self.airports)))
+        for start in range(0, len(coords_list), batch_size):
+            distances = self.distances_from(coords_list[start:start + batch_size])
+            for row, nearest in zip(distances, k_smallest(distances, k)):
+                results.append([(self.airports[i], float(row[i])) for i in nearest])
+        return results
+
+    @classmethod
+    def from_db(cls, db_path=DEFAULT_DB_PATH):
+        con = sqlite3.connect(db_path)
+        try:
+            columns = [row[1] for row in con.execute('PRAGMA table_info(airport);')]
+            if 'popularity_rank' in columns:
+                rows = con.execute("""SELECT aita_code, lat, lng, popularity_rank, place_name, place_id
+                                      FROM airport ORDER BY popularity_rank;""").fetchall()
+            else:
+                # db from before scripts/populate_sqlite.py typed the columns, insertion order is popularity
+                rows = con.execute('SELECT aita_code, lat, lng, id, NULL, NULL FROM airport ORDER BY id;').fetchall()
+        finally:
+            con.close()
+        return cls(Airport(code, float(lat), float(lng), rank, place_name, place_id)
+                   for code, lat, lng, rank, place_name, place_id in rows)
+
+    @classmethod
+    def from_file(cls, path=DEFAULT_AIRPORTS_FILE):
+        """
+        Load from a `CODE;lat,lng` file. Line order is taken as popularity order
+        """
+        airports = []
+        seen = set()
+        with open(path, 'r') as f:
+            for rank, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                code, coords = line.split(';')
+                # the lists repeat some airports, the first (most popular) position wins
+                if code in seen:
+                    continue
+                seen.add(code)
+                lat, lng = coords.split(',')
+                airports.append(Airport(code, float(lat), float(lng), rank))
+        return cls(airports)
+
+    def save(self, path=DEFAULT_SNAPSHOT_PATH):
+        """
+        Write the airports and the built tree as plain arrays, so loading skips the build.
+        Written to a temporary file first, a running service never sees half a snapshot
+        """
+        airports = self.airports
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f,
+                     version=np.array(SNAPSHOT_VERSION),
+                     codes=np.array([a.code for a in airports], dtype=str),
+                     coords=self.coords,
+                     ranks=np.array([a.rank for a in airports], dtype=np.int64),
+                     # npz can't hold None without pickling, '' stands in for it
+                     place_names=np.array([a.place_name or '' for a in airports], dtype=str),
+                     place_ids=np.array([a.place_id or '' for a in airports], dtype=str),
+                     tree=np.array([self.index, self.axis, self.left, self.right], dtype=np.int32).reshape(4, -1))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def from_snapshot(cls, path=DEFAULT_SNAPSHOT_PATH):
+        """
+        Load what save wrote
+
+        :raise ValueError: if the file isn't a snapshot this version can read
+        """
+        with np.load(path, allow_pickle=False) as snapshot:
+            if 'version' not in snapshot or int(snapshot['version']) != SNAPSHOT_VERSION:
+                raise ValueError(f"{path} is not a version {SNAPSHOT_VERSION} airport index snapshot")
+            coords = snapshot['coords'].tolist()
+            airports = [Airport(code, lat, lng, rank, place_name or None, place_id or None)
+                        for code, (lat, lng), rank, place_name, place_id
+                        in zip(snapshot['codes'].tolist(), coords, snapshot['ranks'].tolist(),
+                               snapshot['place_names'].tolist(), snapshot['place_ids'].tolist())]
+            tree = tuple(snapshot['tree'].tolist())
+        if len(tree[0]) != len(airports):
+            raise ValueError(f"{path} is not a version {SNAPSHOT_VERSION} airport index snapshot")
+        return cls(airports, tree)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def load_airport_index():
+    """
+    Prefer the snapshot scripts/populate_sqlite.py writes alongside the sqlite db, then the db itself,
+    falling back to the bundled airport list so the service still works on a fresh checkout.
+    The snapshot is skipped if the db has changed since (e.g. scripts/enrich_airports.py ran after it).
+    Set FLYORDRIVE_AIRPORTS_FILE to index a different `CODE;lat,lng` file, e.g. airport_locs.txt,
+    or FLYORDRIVE_AIRPORT_INDEX to load a snapshot from somewhere else
+    """
+    airports_file = os.environ.get('FLYORDRIVE_AIRPORTS_FILE')
+    if airports_file:
+        return AirportIndex.from_file(airports_file)
+    snapshot_path = os.environ.get('FLYORDRIVE_AIRPORT_INDEX', DEFAULT_SNAPSHOT_PATH)
+    has_db = os.path.exists(DEFAULT_DB_PATH)
+    if os.path.exists(snapshot_path) and (not has_db or os.path.getmtime(snapshot_path) >= os.path.getmtime(DEFAULT_DB_PATH)):
+        try:
+            return AirportIndex.from_snapshot(snapshot_path)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Ignoring airport index snapshot %s: %r", snapshot_path, e)
+    if has_db:
+        try:
+            return AirportIndex.from_db()
+        except sqlite3.Error:
+            pass
+    return AirportIndex.from_file()
+
+
+def get_airport_index():
+    """
+    Process-wide airport index, built on first use
+    """
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = load_airport_index()
+    return _index
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+
+from .domain import FlyingTripInfo
+from .trip_calculator_service import AirportPairSearch, TripCalculatorBase
+from ..cache import get_response_cache
+from ..deadline import DeadlineExceeded
+from ..gateways.backends import build_async_gateway
+from ..gateways.cached_google_distance_matrix_gateway import AsyncCachedGoogleDistanceMatrixGateway
+from ..gateways.cached_google_hotels_gateway import AsyncCachedGoogleHotelsGateway
+from ..gateways.cached_skyscanner_gateway import AsyncCachedSkyScannerGateway
+from ..gateways.google_distance_matrix_gateway import AsyncGoogleDistanceMatrixGateway
+from ..gateways.google_hotels_gateway import AsyncGoogleHotelsGateway
+from ..gateways.skyscanner_gateway import AsyncSkyScannerGateway
+from ..metrics import span
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTripCalculatorService(TripCalculatorBase):
+    """
+    TripCalculatorService.calculate_trip for the event loop. Waiting on upstreams doesn't hold a thread,
+    so one worker can serve many trips at once. The trip math is shared through TripCalculatorBase
+    and the upstream calls are cached the same way, but it's a plainer take on the sync service:
+
+    - no trip result cache, so no stale-while-revalidate and no turning a trip around from the other direction
+    - no RoadEstimator, a drive google can't route fails the trip rather than being estimated
+    - no progress reporting, itineraries or matrices
+
+    Flight quotes fall back on the cache or an estimate and hotel prices on the default, like the sync service.
+
+    Coroutines share a thread, so the trip's deadline can't live in deadline.py's thread local.
+    Instead it's handed down to every call as `until`, a time.monotonic() the trip has to be done by
+    """
+
+    def __init__(self, call_timeout_seconds=15, budget_seconds=None):
+        """
+        :param budget_seconds: see TripCalculatorService
+        """
+        super().__init__()
+        if budget_seconds is None:
+            budget_seconds = float(os.environ.get('FLYORDRIVE_TRIP_BUDGET_SECONDS', 10))
+        self.budget_seconds = budget_seconds
+        self.call_timeout_seconds = call_timeout_seconds
+        self.gdm = AsyncCachedGoogleDistanceMatrixGateway(build_async_gateway('google', AsyncGoogleDistanceMatrixGateway),
+                                                          get_response_cache())
+        self.sky = AsyncCachedSkyScannerGateway(build_async_gateway('skyscanner', AsyncSkyScannerGateway),
+                                                get_response_cache(), fares=self.fares)
+        self.hotels = AsyncCachedGoogleHotelsGateway(build_async_gateway('hotels', AsyncGoogleHotelsGateway),
+                                                     get_response_cache())
+
+    async def __call(self, awaitable, until):
+        """
+        :param until: the trip's deadline, the call gets whatever's left of it (at most call_timeout_seconds)
+        :raise DeadlineExceeded: if the trip runs out of time first
+        """
+        left = until - time.monotonic()
+        if left <= 0:
+            awaitable.close()
+            raise DeadlineExceeded("out of time")
+        try:
+            return await asyncio.wait_for(awaitable, min(self.call_timeout_seconds, left))
+        except asyncio.TimeoutError:
+            if left < self.call_timeout_seconds:
+                raise DeadlineExceeded("out of time waiting on an upstream")
+            raise
+
+    async def __calculate_drive(self, origin, destination, max_one_day_driving_minutes, car_mpg, until):
+        with span('drive', origin=origin, destination=destination):
+            driving_route, origin_coords, destination_coords = await asyncio.gather(
+                self.__call(self.gdm.get_driving_route(origin, destination), until),
+                self.__call(self.gdm.get_lat_lng(origin), until),
+                self.__call(self.gdm.get_lat_lng(destination), until))
+            gas_price = self._gas_price(origin_coords, destination_coords)
+            points = self._overnight_points(driving_route, (origin_coords, destination_coords), max_one_day_driving_minutes)
+            stops = self._overnight_stops(points, await self.__nightly_prices(points, until))
+            return self._price_drive(driving_route, max_one_day_driving_minutes, car_mpg, gas_price,
+                                     overnight_stops=stops)
+
+    async def __nightly_prices(self, points, until):
+        """
+        See TripCalculatorService.__nightly_prices
+        """
+        if not points:
+            return []
+        try:
+            return await self.__call(self.hotels.get_nightly_prices(points), until)
+        except Exception as e:
+            logger.warning("Pricing %d nights at the default, hotel lookup failed: %r", len(points), e)
+            return [None] * len(points)
+
+    async def __calculate_flight(self, origin, destination, until, flight_duration_minutes=None):
+        with span('flight', origin=origin.code, destination=destination.code):
+            flight_info = await self.__call(self.sky.get_flight_info(origin.code, destination.code), until)
+            return self._flight_info(origin, destination, flight_info['Quotes'], flight_duration_minutes)
+
+    def __cached_flight(self, origin, destination):
+        quotes = self.sky.cached_flight_info(origin.code, destination.code)
+        return self._flight_info(origin, destination, quotes['Quotes']) if quotes is not None else None
+
+    async def __quoted_or_cached(self, origin, destination, flight_duration_minutes, until):
+        """
+        See TripCalculatorService.__quoted_or_cached
+        """
+        try:
+            return await self.__calculate_flight(origin, destination, until, flight_duration_minutes)
+        except Exception as e:
+            logger.warning("Quoting %s to %s failed, falling back on the cache: %r", origin.code, destination.code, e)
+            cached = self.__cached_flight(origin, destination)
+            return cached if cached is not None else self._flight_info(origin, destination, [], flight_duration_minutes)
+
+    async def __airport_place(self, airport, until):
+        return self._airport_place(airport) or await self.__call(self.gdm.reverse_geocode(airport.coords()), until)
+
+    async def __airport_drives(self, place, airports, to_or_from, until):
+        with span('airport_drive', place=place, to_or_from=to_or_from, airports=[port.code for port in airports]):
+            port_places = await asyncio.gather(*[self.__airport_place(port, until) for port in airports])
+            if to_or_from == 'to':
+                routes = (await self.__call(self.gdm.get_driving_routes([place], port_places), until))[0]
+            else:
+                routes = [row[0] for row in await self.__call(self.gdm.get_driving_routes(port_places, [place]), until)]
+
+            return self._airport_legs_priced(airports, routes)
+
+    async def __nearest_airports_to_place(self, place, until):
+        coords = await self.__call(self.gdm.get_lat_lng(place), until)
+        with span('nearest_airport', place=place):
+            return self._find_nearest_airport(coords)
+
+    async def __search_airport_pairs(self, drives_to_airport, drives_from_airport, until):
+        """
+        See TripCalculatorService.__search_airport_pairs
+        """
+        pairs = self._airport_pairs(drives_to_airport, drives_from_airport, self.__cached_flight)
+        search = AirportPairSearch(self, pairs)
+        with span('airport_pairs', pairs=len(pairs)) as fields:
+            batch = search.next_batch()
+            while batch:
+                search.add_quotes(batch, await asyncio.gather(*[
+                    self.__quoted_or_cached(origin_leg[0], destination_leg[0], minutes, until)
+                    for _, origin_leg, destination_leg, minutes in batch]))
+                batch = search.next_batch()
+            fields['quoted'] = search.quoted
+        return search.best
+
+    async def __calculate_flying_trip(self, origin, destination, until):
+        origin_airports, destination_airports = await asyncio.gather(self.__nearest_airports_to_place(origin, until),
+                                                                     self.__nearest_airports_to_place(destination, until))
+
+        # the closest airport on each side usually has the cheapest drive, so speculatively quote that pair.
+        # the search's quote for it shares the upstream call
+        flight_info_task = asyncio.ensure_future(self.__calculate_flight(origin_airports[0], destination_airports[0],
+                                                                         until))
+        try:
+            drives_to_airport, drives_from_airport = await asyncio.gather(
+                self.__airport_drives(origin, origin_airports, 'to', until),
+                self.__airport_drives(destination, destination_airports, 'from', until))
+            best = await self.__search_airport_pairs(drives_to_airport, drives_from_airport, until)
+        finally:
+            flight_info_task.cancel()
+            # let it wind down before the trip returns, and retrieve whatever it raised,
+            # the search quoted the pair itself
+            try:
+                await flight_info_task
+            except (asyncio.CancelledError, Exception):
+                pass
+
+        # TODO fail gracefully
+        if best is None:
+            return None
+
+        (_, drive_to_airport), (_, drive_from_airport), flight_info = best
+        return FlyingTripInfo(flight_info, drive_to_airport.combine(drive_from_airport))
+
+    async def calculate_trip(self, origin, destination, max_one_day_driving_minutes=8 * 60, car_mpg=20):
+        """
+        See TripCalculatorService.calculate_trip
+        """
+        logger.info("calculating trip for %s to %s", origin, destination)
+
+        until = time.monotonic() + self.budget_seconds
+        # a span rather than a trace, coroutines share the thread a trace would be tracked on
+        with span('trip', origin=origin, destination=destination):
+            driving_info, flying_info = await asyncio.gather(
+                self.__calculate_drive(origin, destination, max_one_day_driving_minutes, car_mpg, until),
+                self.__calculate_flying_trip(origin, destination, until))
+
+        return {
+            'driving': driving_info.to_dict(),
+            'flying': flying_info.to_dict() if flying_info is not None else None
+        }
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_async_trip_calculator_service():
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = AsyncTripCalculatorService()
+    return _service
@@ -0,0 +1,280 @@
+import dataclasses
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+from ..serialization import dumps_str
+
+
+def slotted(cls):
+    """
+    Rebuild a dataclass with __slots__, so instances carry no __dict__.
+    dataclass(slots=True) does the same from python 3.10, but we still support older versions.
+    Defaults are already baked into the generated __init__, so they can go from the class.
+    Like dataclass(slots=True), pickle and copy get state methods that restore through object.__setattr__,
+    the default restore would trip over frozen=True
+    """
+    names = tuple(f.name for f in dataclasses.fields(cls))
+    namespace = {key: value for key, value in cls.__dict__.items()
+                 if key not in names and key not in ('__dict__', '__weakref__')}
+    namespace['__slots__'] = names
+    namespace['__getstate__'] = _slotted_getstate
+    namespace['__setstate__'] = _slotted_setstate
+    return type(cls)(cls.__name__, cls.__bases__, namespace)
+
+
+def _slotted_getstate(self):
+    return [getattr(self, name) for name in self.__slots__]
+
+
+def _slotted_setstate(self, state):
+    for name, value in zip(self.__slots__, state):
+        object.__setattr__(self, name, value)
+
+
+@slotted
+@dataclass(frozen=True)
+class Airport:
+    code: str
+    lat: float
+    lng: float
+    # position in the popularity-ordered source list, lower is busier
+    rank: int = 0
+    # filled in offline by scripts/enrich_airports.py
+    place_name: Optional[str] = None
+    place_id: Optional[str] = None
+
+    def coords(self):
+        return self.lat, self.lng
+
+    def to_dict(self):
+        return {
+            'code': self.code,
+            'lat': self.lat,
+            'lng': self.lng,
+            'rank': self.rank,
+            'place_name': self.place_name,
+            'place_id': self.place_id
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**d)
+
+
+@slotted
+@dataclass(frozen=True)
+class OvernightStop:
+    lat: float
+    lng: float
+    # $ for a night somewhere around here
+    nightly_price: float
+
+    def to_dict(self):
+        return {'lat': self.lat, 'lng': self.lng, 'nightly_price': self.nightly_price}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['lat'], d['lng'], d['nightly_price'])
+
+
+@slotted
+@dataclass(frozen=True)
+class DrivingInfo:
+    distance_miles: float
+    driving_duration_seconds: int  # TODO use minutes instead
+    hotel_total_price: float
+    gas_total_price: float
+    # distance and duration are RoadEstimator guesses rather than a real route
+    estimated: bool = False
+    # where each night of a multi-day drive is spent, in order
+    overnight_stops: Tuple[OvernightStop, ...] = ()
+
+    def total_price(self):
+        return self.hotel_total_price + self.gas_total_price
+
+    def combine(self, other):
+        return DrivingInfo(
+            distance_miles=self.distance_miles + other.distance_miles,
+            driving_duration_seconds=self.driving_duration_seconds + other.driving_duration_seconds,
+            hotel_total_price=self.hotel_total_price + other.hotel_total_price,
+            gas_total_price=self.gas_total_price + other.gas_total_price,
+            estimated=self.estimated or other.estimated,
+            overnight_stops=self.overnight_stops + other.overnight_stops
+        )
+
+    def to_dict(self):
+        return {
+            'distance_miles': self.distance_miles,
+            'driving_duration_seconds': self.driving_duration_seconds,
+            'hotel_total_price': self.hotel_total_price,
+            'gas_total_price': self.gas_total_price,
+            'estimated': self.estimated,
+            'overnight_stops': [stop.to_dict() for stop in self.overnight_stops],
+            'total_price': self.total_price()
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['distance_miles'], d['driving_duration_seconds'], d['hotel_total_price'], d['gas_total_price'],
+                   d.get('estimated', False),
+                   tuple(OvernightStop.from_dict(stop) for stop in d.get('overnight_stops', ())))
+
+    def to_json(self):
+        return dumps_str(self.to_dict())
+
+
+@slotted
+@dataclass(frozen=True)
+class FlightInfo:
+    flight_duration_minutes: float
+    estimated_price: float
+    # the price is a FareEstimator guess rather than SkyScanner's quotes
+    estimated: bool = False
+
+    def to_dict(self):
+        return {'flight_duration_minutes': self.flight_duration_minutes, 'estimated_price': self.estimated_price,
+                'estimated': self.estimated}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['flight_duration_minutes'], d['estimated_price'], d.get('estimated', False))
+
+    def to_json(self):
+        return dumps_str(self.to_dict())
+
+
+@slotted
+@dataclass(frozen=True)
+class FlyingTripInfo:
+    flight_info: FlightInfo
+    driving_info: DrivingInfo
+
+    def total_price(self):
+        return self.flight_info.estimated_price + self.driving_info.total_price()
+
+    def total_duration_minutes(self):
+        return self.flight_info.flight_duration_minutes + self.driving_info.driving_duration_seconds / 60
+
+    def compute_total(self):
+        return {
+            'total_price': self.total_price(),
+            'total_duration_minutes': self.total_duration_minutes()
+        }
+
+    def to_dict(self):
+        return {
+            'driving_info': self.driving_info.to_dict(),
+            'flying_info': self.flight_info.to_dict(),
+            'total_info': self.compute_total()
+        }
+
+    def to_json(self):
+        return dumps_str(self.to_dict())
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(FlightInfo.from_dict(d['flying_info']), DrivingInfo.from_dict(d['driving_info']))
+
+
+@slotted
+@dataclass(frozen=True)
+class TripSkeleton:
+    """
+    Everything about a trip that has to come from upstreams. Turning it into prices for a given
+    daily driving limit and mpg is cheap, so this is what gets cached rather than the priced trip.
+    The airport drives are always priced at the defaults (they only decide which airport to use),
+    so the flying side is kept already priced
+    """
+    origin_coords: Tuple[float, float]
+    destination_coords: Tuple[float, float]
+    # (distance_meters, duration_seconds) of the direct drive
+    driving_route: Tuple[int, int]
+    flying_info: Optional[FlyingTripInfo]
+    # driving_route came from the RoadEstimator
+    driving_route_estimated: bool = False
+    # the (origin side, destination side) airports flying_info flies between
+    airports: Optional[Tuple[Airport, Airport]] = None
+
+    def to_dict(self):
+        return {
+            'origin_coords': list(self.origin_coords),
+            'destination_coords': list(self.destination_coords),
+            'driving_route': list(self.driving_route),
+            'flying_info': self.flying_info.to_dict() if self.flying_info is not None else None,
+            'driving_route_estimated': self.driving_route_estimated,
+            'airports': [airport.to_dict() for airport in self.airports] if self.airports is not None else None
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(tuple(d['origin_coords']),
+                   tuple(d['destination_coords']),
+                   tuple(d['driving_route']),
+                   FlyingTripInfo.from_dict(d['flying_info']) if d['flying_info'] is not None else None,
+                   d.get('driving_route_estimated', False),
+                   tuple(Airport.from_dict(airport) for airport in d['airports']) if d.get('airports') else None)
+
+    def reversed(self, flight_info):
+        """
+        The same trip the other way. Routes are taken to be symmetric, fares aren't,
+        so the flight has to be quoted for the new direction
+
+        :param flight_info: FlightInfo from the destination side airport back to the origin side one
+        """
+        flying_info = None
+        if self.flying_info is not None:
+            driving_info = self.flying_info.driving_info
+            # the stops on the airport drives come back in reverse order
+            flying_info = FlyingTripInfo(flight_info, dataclasses.replace(
+                driving_info, overnight_stops=tuple(reversed(driving_info.overnight_stops))))
+        return TripSkeleton(self.destination_coords,
+                            self.origin_coords,
+                            self.driving_route,
+                            flying_info,
+                            self.driving_route_estimated,
+                            tuple(reversed(self.airports)) if self.airports is not None else None)
+
+
+class TripColumns:
+    """
+    Columnar form of many trips, e.g. a matrix row: one list per field instead of a dict per trip,
+    so big batches don't pay for the same keys over and over. Trips that couldn't be worked out are None
+    in every column of their side
+    """
+    DRIVING_COLUMNS = ('distance_miles', 'driving_duration_seconds', 'hotel_total_price', 'gas_total_price',
+                       'total_price', 'estimated')
+    FLYING_COLUMNS = ('flight_duration_minutes', 'estimated_price', 'airport_driving_duration_seconds',
+                      'total_price', 'total_duration_minutes', 'estimated')
+
+    def __init__(self, destinations, driving_infos, flying_infos):
+        """
+        :param destinations: where each trip goes
+        :param driving_infos: DrivingInfo or None for each trip
+        :param flying_infos: FlyingTripInfo or None for each trip
+        """
+        self.destinations = destinations
+        self.driving_infos = driving_infos
+        self.flying_infos = flying_infos
+
+    @staticmethod
+    def __driving_row(driving_info):
+        return (driving_info.distance_miles, driving_info.driving_duration_seconds, driving_info.hotel_total_price,
+                driving_info.gas_total_price, driving_info.total_price(), driving_info.estimated)
+
+    @staticmethod
+    def __flying_row(flying_info):
+        return (flying_info.flight_info.flight_duration_minutes, flying_info.flight_info.estimated_price,
+                flying_info.driving_info.driving_duration_seconds, flying_info.total_price(),
+                flying_info.total_duration_minutes(), flying_info.flight_info.estimated or flying_info.driving_info.estimated)
+
+    @staticmethod
+    def __columns(names, infos, row):
+        rows = [row(info) if info is not None else None for info in infos]
+        return {name: [r[i] if r is not None else None for r in rows] for i, name in enumerate(names)}
+
+    def to_dict(self):
+        return {
+            'destinations': list(self.destinations),
+            'driving': self.__columns(self.DRIVING_COLUMNS, self.driving_infos, self.__driving_row),
+            'flying': self.__columns(self.FLYING_COLUMNS, self.flying_infos, self.__flying_row)
+        }
@@ -0,0 +1,272 @@
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from .airport_index import get_airport_index
+from .geo import haversine_km
+from ..gateways.skyscanner_gateway import travel_month
+from ..metrics import registry
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_FARE_HISTORY_PATH = os.path.join(BASE_DIR, '../fare_history.sqlite3')
+DAY_SECONDS = 24 * 60 * 60
+# no quote has ever come in under this. it's the floor for estimates,
+# and the fare bound for airport pairs we haven't quoted yet (see TripCalculatorBase._airport_pairs)
+MIN_FARE = 40
+
+fare_estimates = registry.counter('flyordrive_fare_estimates_total',
+                                  'Fares answered from the fare history instead of a SkyScanner quote', ('basis',))
+fare_observations = registry.counter('flyordrive_fare_observations_total',
+                                     'Quoted fares recorded in the fare history')
+
+
+class FareHistory:
+    """
+    Every fare SkyScanner has quoted us, shared by all the worker processes on the box and kept for good.
+    Quotes are summed up per route, travel month and the day they were seen, so a route costs at most a row a day
+    """
+
+    def __init__(self, path=DEFAULT_FARE_HISTORY_PATH):
+        self.con = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.con.execute('PRAGMA journal_mode=WAL;')
+            self.con.execute("""CREATE TABLE IF NOT EXISTS fare
+                                (origin TEXT NOT NULL,
+                                 destination TEXT NOT NULL,
+                                 month TEXT NOT NULL,
+                                 day INTEGER NOT NULL,
+                                 quotes INTEGER NOT NULL,
+                                 total REAL NOT NULL,
+                                 lowest REAL NOT NULL,
+                                 PRIMARY KEY (origin, destination, month, day)) WITHOUT ROWID;""")
+            self.con.commit()
+
+    def add(self, origin, destination, month, prices, now=None):
+        """
+        :param origin: airport code
+        :param destination: airport code
+        :param month: travel month the fares are for, e.g. 2024-09
+        :param prices: $ of each quote
+        """
+        day = int((now or time.time()) // DAY_SECONDS)
+        with self.lock:
+            self.con.execute("""INSERT INTO fare (origin, destination, month, day, quotes, total, lowest)
+                                VALUES (?, ?, ?, ?, ?, ?, ?)
+                                ON CONFLICT (origin, destination, month, day) DO UPDATE
+                                SET quotes = quotes + excluded.quotes,
+                                    total = total + excluded.total,
+                                    lowest = MIN(lowest, excluded.lowest);""",
+                             (origin, destination, month, day, len(prices), sum(prices), min(prices)))
+            self.con.commit()
+
+    def route(self, origin, destination):
+        """
+        Fares this way only, the way back can cost quite differently
+
+        :return: [(month, day, quotes, total)]
+        """
+        with self.lock:
+            return self.con.execute("""SELECT month, day, quotes, total FROM fare
+                                       WHERE origin = ? AND destination = ?;""",
+                                    (origin, destination)).fetchall()
+
+    def routes(self):
+        """
+        :return: [(origin, destination, month, quotes, total)] for every route and travel month we've seen
+        """
+        with self.lock:
+            return self.con.execute("""SELECT origin, destination, month, SUM(quotes), SUM(total) FROM fare
+                                       GROUP BY origin, destination, month;""").fetchall()
+
+
+class FareEstimator:
+    """
+    Answers fares between two airports from the FareHistory. recent() is for work that doesn't need a fresh quote,
+    estimate() for when SkyScanner has no quotes or isn't answering. In order of preference, estimate() uses:
+
+    - the route's own fares for the travel month, recent ones counting most
+    - the route's fares for other months, adjusted for the season, with the way back's fares counting
+      for REVERSE_WEIGHT as much, since fares aren't the same both ways but are usually close
+    - a fare for the distance, a base fare plus a rate per km fit to every route we know, adjusted for the season
+
+    A month's seasonal factor is how far that calendar month's fares run above their routes' averages.
+    The distance fit and the seasonal factors are refit from the history every REFIT_SECONDS,
+    the priors below stand in until there are MIN_ROUTES routes to fit
+    """
+    DEFAULT_BASE_FARE = 90
+    DEFAULT_FARE_PER_KM = 0.06
+    HALF_LIFE_DAYS = 30
+    # how much a fare the other way counts for, next to one this way
+    REVERSE_WEIGHT = 0.25
+    # how old a route's fares can be for recent() to stand in for a fresh quote
+    RECENT_DAYS = 1
+    MIN_ROUTES = 10
+    # a calendar month needs this many quotes before its own fares count as much as no seasonality at all
+    SEASON_PRIOR_QUOTES = 20
+    REFIT_SECONDS = 10 * 60
+
+    def __init__(self, history, airports=None):
+        """
+        :param airports: AirportIndex to look up routes' distances in, the process-wide one if None
+        """
+        self.history = history
+        self.airports = airports
+        self.fit_lock = threading.Lock()
+        self.base_fare = self.DEFAULT_BASE_FARE
+        self.fare_per_km = self.DEFAULT_FARE_PER_KM
+        # calendar month ('01'..'12') -> factor, missing months are 1
+        self.season = {}
+        self.fitted_at = None
+
+    def observe(self, origin, destination, month, prices):
+        """
+        Record quoted fares, see CachedSkyScannerGateway
+
+        :param origin: airport code
+        :param destination: airport code
+        """
+        prices = [float(price) for price in prices if price is not None and 0 < price < math.inf]
+        if not prices:
+            return
+        self.history.add(origin, destination, month, prices)
+        fare_observations.inc(amount=len(prices))
+
+    def season_factor(self, month):
+        return self.season.get(month[5:7], 1.0)
+
+    def recent(self, origin, destination, month=None):
+        """
+        The route's average fare for the month over the last RECENT_DAYS, this way only,
+        close enough to a fresh quote for background work
+
+        :param origin: Airport
+        :param destination: Airport
+        :return: $, or None if the route hasn't been quoted that lately
+        """
+        month = month or travel_month()
+        since = time.time() // DAY_SECONDS - self.RECENT_DAYS
+        quotes = total = 0
+        for seen_month, day, day_quotes, day_total in self.history.route(origin.code, destination.code):
+            if seen_month == month and day >= since:
+                quotes += day_quotes
+                total += day_total
+        if not quotes:
+            return None
+        fare_estimates.inc('recent')
+        return total / quotes
+
+    def estimate(self, origin, destination, month=None):
+        """
+        :param origin: Airport
+        :param destination: Airport
+        :param month: travel month, the one quotes are asked for if None
+        :return: $
+        """
+        month = month or travel_month()
+        self.__refit_if_stale()
+        today = time.time() // DAY_SECONDS
+        same_weight = same_total = other_weight = other_total = reverse_weight = reverse_total = 0.0
+        for reverse, rows in ((False, self.history.route(origin.code, destination.code)),
+                              (True, self.history.route(destination.code, origin.code))):
+            for seen_month, day, quotes, total in rows:
+                weight = quotes * 0.5 ** (max(0, today - day) / self.HALF_LIFE_DAYS)
+                price = total / quotes
+                if seen_month == month and not reverse:
+                    same_weight += weight
+                    same_total += weight * price
+                    continue
+                price *= self.season_factor(month) / self.season_factor(seen_month)
+                if reverse:
+                    reverse_weight += weight * self.REVERSE_WEIGHT
+                    reverse_total += weight * self.REVERSE_WEIGHT * price
+                else:
+                    other_weight += weight
+                    other_total += weight * price
+
+        if same_weight:
+            basis, fare = 'route_month', same_total / same_weight
+        elif other_weight or reverse_weight:
+            basis = 'route' if other_weight else 'reverse'
+            fare = (other_total + reverse_total) / (other_weight + reverse_weight)
+        else:
+            km = float(haversine_km(*origin.coords(), *destination.coords()))
+            basis, fare = 'distance', (self.base_fare + self.fare_per_km * km) * self.season_factor(month)
+        fare_estimates.inc(basis)
+        return max(MIN_FARE, fare)
+
+    def __refit_if_stale(self):
+        if self.fitted_at is not None and time.monotonic() - self.fitted_at < self.REFIT_SECONDS:
+            return
+        # one thread refits, the rest carry on with what's there
+        if not self.fit_lock.acquire(blocking=False):
+            return
+        try:
+            self.fit()
+        except Exception as e:
+            logger.warning("Couldn't refit fare estimates, keeping the last ones: %r", e)
+        finally:
+            self.fitted_at = time.monotonic()
+            self.fit_lock.release()
+
+    def fit(self):
+        rows = self.history.routes()
+        # route -> [quotes, total] over all months
+        routes = {}
+        for origin, destination, _, quotes, total in rows:
+            route = routes.setdefault((origin, destination), [0, 0.0])
+            route[0] += quotes
+            route[1] += total
+
+        # calendar month -> [quotes, quotes * (month's average / route's average)]
+        months = {}
+        for origin, destination, month, quotes, total in rows:
+            route_quotes, route_total = routes[(origin, destination)]
+            seen = months.setdefault(month[5:7], [0, 0.0])
+            seen[0] += quotes
+            seen[1] += quotes * (total / quotes) / (route_total / route_quotes)
+        self.season = {month: (ratios + self.SEASON_PRIOR_QUOTES) / (quotes + self.SEASON_PRIOR_QUOTES)
+                       for month, (quotes, ratios) in months.items()}
+
+        airports = self.airports or get_airport_index()
+        kms, fares, weights = [], [], []
+        for (origin, destination), (quotes, total) in routes.items():
+            origin, destination = airports.airport(origin), airports.airport(destination)
+            if origin is None or destination is None:
+                continue
+            kms.append(float(haversine_km(*origin.coords(), *destination.coords())))
+            fares.append(total / quotes)
+            weights.append(math.sqrt(quotes))
+        if len(kms) < self.MIN_ROUTES:
+            return
+        fare_per_km, base_fare = np.polyfit(kms, fares, 1, w=weights)
+        # too few or too similar routes can fit nonsense, the priors are better than that
+        if fare_per_km <= 0 or base_fare < 0:
+            logger.info("Ignoring fare fit over %d routes, %.2f + %.4f/km", len(kms), base_fare, fare_per_km)
+            return
+        self.base_fare, self.fare_per_km = float(base_fare), float(fare_per_km)
+
+
+_estimator = None
+_estimator_lock = threading.Lock()
+
+
+def get_fare_estimator():
+    """
+    Process-wide estimator. FLYORDRIVE_FARE_HISTORY_DB overrides the sqlite file,
+    set it to an empty string to keep the history in memory
+    """
+    global _estimator
+    if _estimator is None:
+        with _estimator_lock:
+            if _estimator is None:
+                path = os.environ.get('FLYORDRIVE_FARE_HISTORY_DB', DEFAULT_FARE_HISTORY_PATH) or ':memory:'
+                _estimator = FareEstimator(FareHistory(path))
+    return _estimator
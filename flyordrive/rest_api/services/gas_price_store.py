@@ -0,0 +1,114 @@
+import logging
+import os
+import threading
+import time
+
+from ..cache import MISSING, get_response_cache
+from ..gas_regions import region_for
+from ..gateways.backends import build_gateway
+from ..gateways.eia_gateway import EIAGateway
+from ..rate_limit import BULK, set_current_lane
+
+logger = logging.getLogger(__name__)
+
+# used until the first refresh succeeds
+DEFAULT_GAS_PRICE = 3.3
+
+
+class GasPriceStore:
+    """
+    Latest EIA price for every region, held in memory so the request path never waits on EIA.
+    Prices only change weekly, so a background thread refreshes them every few hours, and they're
+    mirrored into the shared cache so other workers and restarts start out with real prices
+    """
+    CACHE_NAMESPACE = 'gas_price'
+    # after a refresh where EIA didn't answer for any region, try again this soon rather than a whole interval later
+    RETRY_SECONDS = 5 * 60
+
+    def __init__(self, eia, cache=None):
+        self.eia = eia
+        self.cache = cache
+        self.prices = {}
+        self.refreshed_at = None
+        self.stopped = threading.Event()
+        if cache is not None:
+            self.__load_cached()
+
+    def __load_cached(self):
+        for region in EIAGateway.region_series:
+            entry = self.cache.get(self.CACHE_NAMESPACE, region)
+            if entry is not MISSING:
+                self.prices[region] = entry['price']
+                self.refreshed_at = max(self.refreshed_at or 0, entry['fetched_at'])
+
+    def price_for(self, coords):
+        """
+        $/gal around a point, falling back to the national average
+        """
+        return self.prices.get(region_for(coords)) or self.national_price()
+
+    def national_price(self):
+        return self.prices.get('us') or DEFAULT_GAS_PRICE
+
+    def refresh(self):
+        """
+        :return: whether any region's price was refreshed
+        """
+        prices = dict(self.prices)
+        now = time.time()
+        refreshed = False
+        for region in EIAGateway.region_series:
+            try:
+                price, period = self.eia.get_region_price(region)
+            except Exception as e:
+                logger.warning("Failed to refresh gas price for %s: %r", region, e)
+                continue
+            prices[region] = price
+            refreshed = True
+            if self.cache is not None:
+                self.cache.set(self.CACHE_NAMESPACE, region, {'price': price, 'period': period, 'fetched_at': now})
+        # swap the whole dict so readers never see a half refreshed set of prices
+        self.prices = prices
+        if refreshed:
+            self.refreshed_at = now
+        return refreshed
+
+    def start_refreshing(self, interval_seconds):
+        thread = threading.Thread(target=self.__refresh_forever,
+                                  args=(interval_seconds,),
+                                  name='gas-price-refresh',
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def stop_refreshing(self):
+        self.stopped.set()
+
+    def __refresh_forever(self, interval_seconds):
+        # this thread only ever refreshes, trips get the EIA budget first
+        set_current_lane(BULK)
+        while not self.stopped.is_set():
+            # another worker may have refreshed the shared cache recently
+            wait = interval_seconds - (time.time() - self.refreshed_at) if self.refreshed_at is not None else 0
+            if wait <= 0:
+                wait = interval_seconds if self.refresh() else min(self.RETRY_SECONDS, interval_seconds)
+            self.stopped.wait(wait)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_gas_price_store():
+    """
+    Process-wide store, refreshed every FLYORDRIVE_GAS_REFRESH_SECONDS (default 6 hours, 0 disables refreshing)
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = GasPriceStore(build_gateway('eia', EIAGateway), get_response_cache())
+                interval_seconds = int(os.environ.get('FLYORDRIVE_GAS_REFRESH_SECONDS', 6 * 60 * 60))
+                if interval_seconds > 0:
+                    _store.start_refreshing(interval_seconds)
+    return _store
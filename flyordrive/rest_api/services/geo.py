@@ -0,0 +1,63 @@
+import numpy as np
+
+EARTH_RADIUS_KM = 6371
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """
+    Great circle distance in kilometers between points given in decimal degrees.
+    Takes scalars or numpy arrays and broadcasts like any other ufunc
+    """
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def interpolate_great_circle(origin, destination, fraction):
+    """
+    The point fraction of the way from origin to destination along the great circle
+
+    :param origin: (lat, lng)
+    :param destination: (lat, lng)
+    :param fraction: 0 is the origin, 1 the destination
+    :return: (lat, lng)
+    """
+    lat1, lng1, lat2, lng2 = map(np.radians, (*origin, *destination))
+    delta = float(haversine_km(*origin, *destination)) / EARTH_RADIUS_KM
+    if delta == 0:
+        return tuple(origin)
+    a = np.sin((1 - fraction) * delta) / np.sin(delta)
+    b = np.sin(fraction * delta) / np.sin(delta)
+    x = a * np.cos(lat1) * np.cos(lng1) + b * np.cos(lat2) * np.cos(lng2)
+    y = a * np.cos(lat1) * np.sin(lng1) + b * np.cos(lat2) * np.sin(lng2)
+    z = a * np.sin(lat1) + b * np.sin(lat2)
+    return float(np.degrees(np.arctan2(z, np.hypot(x, y)))), float(np.degrees(np.arctan2(y, x)))
+
+
+def pairwise_haversine_km(points_a, points_b):
+    """
+    :param points_a: array-like of (lat, lng), shape (n, 2)
+    :param points_b: array-like of (lat, lng), shape (m, 2)
+    :return: (n, m) array of distances from every point in a to every point in b
+    """
+    a = np.asarray(points_a, dtype=float).reshape(-1, 2)
+    b = np.asarray(points_b, dtype=float).reshape(-1, 2)
+    return haversine_km(a[:, 0, None], a[:, 1, None], b[None, :, 0], b[None, :, 1])
+
+
+def k_smallest(distances, k):
+    """
+    Column indices of the k smallest values in each row, smallest first.
+    Equal values are ordered by index, which for the airport table puts the more popular airport first
+
+    :param distances: (n, m) array
+    :return: (n, min(k, m)) array of indices
+    """
+    k = min(k, distances.shape[1])
+    if k == 0:
+        return np.empty((distances.shape[0], 0), dtype=int)
+    candidates = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    candidate_distances = np.take_along_axis(distances, candidates, axis=1)
+    # lexsort sorts by the last key first
+    order = np.lexsort((candidates, candidate_distances), axis=1)
+    return np.take_along_axis(candidates, order, axis=1)
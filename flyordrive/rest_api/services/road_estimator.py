@@ -0,0 +1,127 @@
+from bisect import bisect_right
+import threading
+
+from .geo import haversine_km
+from ..cache import MISSING, get_response_cache
+from ..gas_regions import region_for
+from ..metrics import registry
+
+road_estimates = registry.counter('flyordrive_road_estimates_total',
+                                  'Drives estimated locally instead of asking google', ('use',))
+road_observations = registry.counter('flyordrive_road_observations_total',
+                                     'Real routes the road estimator has learned from')
+
+
+class RoadEstimator:
+    """
+    Guesses a drive from the great circle distance: times a detour factor for the distance,
+    divided by a typical speed for the time. Both are learned from real routes as we fetch them,
+    separately for each gas price region (rough proxy for terrain and road network)
+    and distance band (short hops are slower than interstate drives).
+
+    A guess is only offered once a region and band has MIN_SAMPLES real routes behind it,
+    until then the priors below are only used as a last resort when google is failing
+    """
+    DEFAULT_DETOUR_FACTOR = 1.3
+    # km/h for each distance band
+    DEFAULT_SPEEDS_KMH = (50, 80, 95)
+    # great circle km separating the short, medium and long bands
+    BAND_EDGES_KM = (50, 300)
+    MIN_SAMPLES = 20
+    # too short for the ratio to mean anything
+    MIN_OBSERVED_KM = 1
+    CACHE_NAMESPACE = 'road_estimator'
+    SAVE_EVERY = 25
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.lock = threading.Lock()
+        # (region, band) -> [samples, sum of detour ratios, sum of road km, sum of hours]
+        self.stats = {}
+        self.unsaved = 0
+        if cache is not None:
+            self.__load()
+
+    def __load(self):
+        saved = self.cache.get(self.CACHE_NAMESPACE, 'stats')
+        if saved is not MISSING:
+            self.stats = {tuple(key.split('|')): values for key, values in saved.items()}
+
+    def __save(self):
+        with self.lock:
+            saved = {'|'.join(key): list(values) for key, values in self.stats.items()}
+        self.cache.set(self.CACHE_NAMESPACE, 'stats', saved)
+
+    def band(self, great_circle_km):
+        return str(bisect_right(self.BAND_EDGES_KM, great_circle_km))
+
+    @staticmethod
+    def region(origin_coords, destination_coords):
+        return region_for(((origin_coords[0] + destination_coords[0]) / 2, (origin_coords[1] + destination_coords[1]) / 2))
+
+    def observe(self, origin_coords, destination_coords, route):
+        """
+        Learn from a real (distance_meters, duration_seconds) route between two points
+        """
+        if route is None:
+            return
+        great_circle_km = float(haversine_km(*origin_coords, *destination_coords))
+        distance_meters, duration_seconds = route
+        if great_circle_km < self.MIN_OBSERVED_KM or duration_seconds <= 0:
+            return
+        key = (self.region(origin_coords, destination_coords), self.band(great_circle_km))
+        with self.lock:
+            samples = self.stats.setdefault(key, [0, 0.0, 0.0, 0.0])
+            samples[0] += 1
+            samples[1] += distance_meters / 1000 / great_circle_km
+            samples[2] += distance_meters / 1000
+            samples[3] += duration_seconds / 3600
+            self.unsaved += 1
+            save = self.cache is not None and self.unsaved >= self.SAVE_EVERY
+            if save:
+                self.unsaved = 0
+        road_observations.inc()
+        if save:
+            self.__save()
+
+    def estimate(self, origin_coords, destination_coords, use='drive', require_calibration=True):
+        """
+        :param use: what the estimate is for, only used to label the metric
+        :param require_calibration: False to fall back on the priors, for when there's nothing better
+        :return: (distance_meters, duration_seconds) like a real route, or None if we haven't learned enough
+        """
+        great_circle_km = float(haversine_km(*origin_coords, *destination_coords))
+        band = self.band(great_circle_km)
+        with self.lock:
+            samples = self.stats.get((self.region(origin_coords, destination_coords), band))
+            samples = list(samples) if samples is not None else None
+
+        if samples is not None and samples[0] >= self.MIN_SAMPLES:
+            count, ratio_sum, road_km, hours = samples
+            detour_factor = ratio_sum / count
+            speed_kmh = road_km / hours
+        elif require_calibration:
+            return None
+        else:
+            detour_factor = self.DEFAULT_DETOUR_FACTOR
+            speed_kmh = self.DEFAULT_SPEEDS_KMH[int(band)]
+
+        road_estimates.inc(use)
+        road_km = great_circle_km * detour_factor
+        return int(road_km * 1000), int(road_km / speed_kmh * 3600)
+
+
+_estimator = None
+_estimator_lock = threading.Lock()
+
+
+def get_road_estimator():
+    """
+    Process-wide estimator, its calibration is kept in the response cache so restarts don't start from scratch
+    """
+    global _estimator
+    if _estimator is None:
+        with _estimator_lock:
+            if _estimator is None:
+                _estimator = RoadEstimator(get_response_cache())
+    return _estimator
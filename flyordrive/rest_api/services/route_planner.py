@@ -0,0 +1,35 @@
+"""
+Splits a drive into days and works out roughly where each night is spent.
+Distance matrix routes come without the road's geometry, so the drive is assumed to follow
+the great circle at a steady pace, which is close enough to pick a town to price a hotel in
+"""
+from .geo import interpolate_great_circle
+
+# with this little left to go people push on to the destination rather than stop for the night
+FINAL_STRETCH_MINUTES = 60
+
+
+def day_leg_ends(duration_seconds, max_one_day_driving_minutes):
+    """
+    Where each day's driving ends, as fractions of the whole drive
+
+    :return: one fraction per night on the road, empty if the drive is done in a day
+    """
+    if max_one_day_driving_minutes <= 0:
+        raise ValueError(f"max_one_day_driving_minutes must be positive, got {max_one_day_driving_minutes}")
+    day_seconds = max_one_day_driving_minutes * 60
+    ends = []
+    driven = day_seconds
+    # no hotel on the last day of the trip, since you'll be at the destination
+    while duration_seconds - driven > FINAL_STRETCH_MINUTES * 60:
+        ends.append(driven / duration_seconds)
+        driven += day_seconds
+    return ends
+
+
+def overnight_points(origin_coords, destination_coords, duration_seconds, max_one_day_driving_minutes):
+    """
+    :return: (lat, lng) of each night's stop, in order
+    """
+    return [interpolate_great_circle(origin_coords, destination_coords, fraction)
+            for fraction in day_leg_ends(duration_seconds, max_one_day_driving_minutes)]
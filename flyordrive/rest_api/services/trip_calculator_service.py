@@ -1,104 +1,398 @@
-import json
-from math import radians, cos, sin, asin, sqrt
-import os.path
-import sqlite3
-
-import dataclasses
-from dataclasses import dataclass
-
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+import logging
+import os
+import threading
+
+from .airport_index import get_airport_index
+from .gas_price_store import get_gas_price_store
+from .domain import DrivingInfo, FlightInfo, FlyingTripInfo, OvernightStop, TripColumns, TripSkeleton
+from .fare_history import MIN_FARE, get_fare_estimator
+from .geo import haversine_km, pairwise_haversine_km
+from .road_estimator import get_road_estimator
+from .route_planner import day_leg_ends, overnight_points
+from ..cache import get_response_cache
+from ..deadline import deadline, remaining
+from ..executor import InlineExecutor, TracingThreadPoolExecutor, get_executor
+from ..gateways.backends import build_gateway
+from ..gateways.cached_google_distance_matrix_gateway import CachedGoogleDistanceMatrixGateway
+from ..gateways.cached_google_hotels_gateway import CachedGoogleHotelsGateway
+from ..gateways.cached_skyscanner_gateway import CachedSkyScannerGateway
 from ..gateways.google_distance_matrix_gateway import GoogleDistanceMatrixGateway
+from ..gateways.google_hotels_gateway import GoogleHotelsGateway
 from ..gateways.eia_gateway import EIAGateway
 from ..gateways.skyscanner_gateway import SkyScannerGateway
+from ..metrics import span, trace
+from ..rate_limit import BULK, current_lane
+
+logger = logging.getLogger(__name__)
+
+
+class TripCalculatorBase:
+    """
+    The trip math shared by the sync and async services, none of it talks to the network
+    """
+    # what an hour behind the wheel is worth when comparing otherwise similar drives
+    VALUE_OF_TIME_PER_HOUR = 20
+    # how far apart (relative to the cheaper one) driving and flying have to be
+    # before an estimated drive is good enough to tell them apart
+    ESTIMATE_DECISION_MARGIN = 0.3
+    # airports considered on each side of a flying trip
+    AIRPORT_CANDIDATES = 3
+    # the most airport pairs the search quotes for one trip, whatever the bounds say
+    MAX_FLIGHT_QUOTES = 3
+    # $ a night when we don't know what hotels cost where the night is spent
+    DEFAULT_HOTEL_NIGHTLY = 150
 
+    def __init__(self):
+        self.airports = get_airport_index()
+        self.gas_prices = get_gas_price_store()
+        self.road = get_road_estimator()
+        self.fares = get_fare_estimator()
 
-@dataclass
-class Airport:
-    code: str
-    lat: float
-    lng: float
+    def haversine_coords(self, origin, destination):
+        """
+        Great circle distance in kilometers, see geo.pairwise_haversine_km for many points at once
+        """
+        lat1, lng1 = origin
+        lat2, lng2 = destination
+        return float(haversine_km(lat1, lng1, lat2, lng2))
 
-    def coords(self):
-        return self.lat, self.lng
+    def _gas_price(self, *coords):
+        """
+        Average $/gal over some points, e.g. both ends of a drive
+        """
+        with span('gas_price'):
+            prices = [self.gas_prices.price_for(c) for c in coords]
+            return sum(prices) / len(prices)
 
+    def _price_drive(self, driving_route, max_one_day_driving_minutes, car_mpg, gas_price, estimated=False,
+                     overnight_stops=None):
+        """
+        :param driving_route: (distance_meters, duration_seconds)
+        :param gas_price: $/gal
+        :param estimated: driving_route is a RoadEstimator guess
+        :param overnight_stops: where the nights are spent, see _overnight_stops.
+            Without them every night is DEFAULT_HOTEL_NIGHTLY
+        """
+        distance_miles = (driving_route[0] / 1000) * 0.62
+        driving_duration_seconds = driving_route[1]
 
-@dataclass
-class DrivingInfo:
-    distance_miles: float
-    driving_duration_seconds: int  # TODO use minutes instead
-    hotel_total_price: float
-    gas_total_price: float
+        if overnight_stops is None:
+            hotel_total_price = self.DEFAULT_HOTEL_NIGHTLY * len(
+                day_leg_ends(driving_duration_seconds, max_one_day_driving_minutes))
+            overnight_stops = ()
+        else:
+            hotel_total_price = sum(stop.nightly_price for stop in overnight_stops)
 
-    def total_price(self):
-        return self.hotel_total_price + self.gas_total_price
+        # assume you run car dry each time, then you're refilling gas_price * tank_size
+        # and you do that when you run out, which is mpg * tank_size miles
+        # but tank_size cancels out, so you don't need it
+        num_gas_stops = distance_miles / car_mpg
+        gas_total_price = num_gas_stops * gas_price
 
-    def combine(self, other):
-        return DrivingInfo(
-            distance_miles=self.distance_miles + other.distance_miles,
-            driving_duration_seconds=self.driving_duration_seconds + other.driving_duration_seconds,
-            hotel_total_price=self.hotel_total_price + other.hotel_total_price,
-            gas_total_price=self.gas_total_price + other.gas_total_price
-        )
+        return DrivingInfo(distance_miles, driving_duration_seconds, hotel_total_price, gas_total_price, estimated,
+                           overnight_stops)
 
-    def to_dict(self):
-        return {**dataclasses.asdict(self), **{'total_price': self.total_price()}}
+    def _overnight_points(self, driving_route, coords, max_one_day_driving_minutes):
+        """
+        :param coords: (origin coords, destination coords)
+        :return: (lat, lng) of each night on the road
+        """
+        return overnight_points(*coords, driving_route[1], max_one_day_driving_minutes)
 
-    def to_json(self):
-        return json.dumps(self.to_dict())
+    def _overnight_stops(self, points, nightly_prices):
+        """
+        :param nightly_prices: from the hotel gateway, None where it had nothing to go on
+        """
+        return tuple(OvernightStop(lat, lng, price if price is not None else self.DEFAULT_HOTEL_NIGHTLY)
+                     for (lat, lng), price in zip(points, nightly_prices))
 
+    def _flight_duration_minutes(self, flight_distance_km):
+        """
+        Works on a single distance or an array of them
+        """
+        flight_distance_miles = flight_distance_km * 0.60
+        # +30 minutes for gate waiting
+        return (flight_distance_miles / 550) * 60 + 30
 
-@dataclass
-class FlightInfo:
-    flight_duration_minutes: float
-    estimated_price: float
+    def _flight_info(self, origin, destination, quotes, flight_duration_minutes=None):
+        """
 
-    def to_dict(self):
-        return dataclasses.asdict(self)
+        :param origin: Airport
+        :param destination: Airport
+        :param quotes: skyscanner browsequotes Quotes, the fare is estimated if there are none
+        :param flight_duration_minutes: if it was already worked out in bulk
+        :return:
+        """
+        if flight_duration_minutes is None:
+            flight_duration_minutes = self._flight_duration_minutes(
+                self.haversine_coords(origin.coords(), destination.coords()))
 
-    def to_json(self):
-        return json.dumps(self.to_dict())
+        if len(quotes) == 0:
+            return FlightInfo(flight_duration_minutes, self.fares.estimate(origin, destination), estimated=True)
 
+        avg_price = sum([q['MinPrice'] for q in quotes]) / len(quotes)
+        return FlightInfo(flight_duration_minutes, avg_price)
 
-@dataclass
-class FlyingTripInfo:
-    flight_info: FlightInfo
-    driving_info: DrivingInfo
+    def _pick_airport(self, legs):
+        """
+        Pick the airport with the cheapest drive, counting time spent driving as money
 
-    def compute_total(self):
-        return {
-            'total_price': self.flight_info.estimated_price + self.driving_info.total_price(),
-            'total_duration_minutes': self.flight_info.flight_duration_minutes + self.driving_info.driving_duration_seconds / 60
-        }
+        :param legs: [(airport, DrivingInfo)] see _airport_legs_priced
+        :return: (airport, DrivingInfo), or (None, None) if none of the airports could be reached
+        """
+        if not legs:
+            return None, None
+        return min(legs, key=lambda leg: (self._generalized_cost(leg[1]), leg[0].rank))
 
-    def to_dict(self):
-        return {
-            'driving_info': self.driving_info.to_dict(),
-            'flying_info': self.flight_info.to_dict(),
-            'total_info': self.compute_total()
-        }
+    def _airport_legs_priced(self, airports, routes, estimated=False):
+        """
+        :param airports: candidate airports
+        :param routes: (distance_meters, duration_seconds) to/from each airport, None if it couldn't be routed
+        :param estimated: the routes are RoadEstimator guesses
+        :return: [(airport, DrivingInfo)] for each airport that could be reached, priced at the defaults
+        """
+        # the candidates are all close together, so they share a gas price
+        gas_price = self._gas_price(airports[0].coords()) if airports else None
+        return [
+            (port, self._price_drive(route, max_one_day_driving_minutes=480, car_mpg=20, gas_price=gas_price,
+                                     estimated=estimated))
+            for port, route in zip(airports, routes)
+            if route is not None
+        ]
 
-    def to_json(self):
-        return json.dumps(self.to_dict())
+    def _generalized_cost(self, driving_info):
+        return driving_info.total_price() + driving_info.driving_duration_seconds / 3600 * self.VALUE_OF_TIME_PER_HOUR
 
+    def _flight_cost(self, flight_info):
+        return flight_info.estimated_price + flight_info.flight_duration_minutes / 60 * self.VALUE_OF_TIME_PER_HOUR
 
-class TripCalculatorService:
-    def __init__(self):
-        self.gdm = GoogleDistanceMatrixGateway()
-        self.eia = EIAGateway()
-        self.sky = SkyScannerGateway()
+    def _flying_cost(self, flying_info):
+        return self._flight_cost(flying_info.flight_info) + self._generalized_cost(flying_info.driving_info)
 
-    def haversine_coords(self, origin, destination):
-        lat1, lng1 = origin
-        lat2, lng2 = destination
-        # convert decimal degrees to radians
-        lng1, lat1, lng2, lat2 = map(radians, [lng1, lat1, lng2, lat2])
+    def _itinerary_total(self, legs):
+        """
+        :param legs: a DrivingInfo or FlyingTripInfo for each leg
+        :return: {'total_price', 'total_duration_minutes', 'modes'}
+        """
+        total = {'total_price': 0, 'total_duration_minutes': 0, 'modes': []}
+        for leg in legs:
+            if isinstance(leg, DrivingInfo):
+                total['total_price'] += leg.total_price()
+                total['total_duration_minutes'] += leg.driving_duration_seconds / 60
+                total['modes'].append('driving')
+            else:
+                total['total_price'] += leg.total_price()
+                total['total_duration_minutes'] += leg.total_duration_minutes()
+                total['modes'].append('flying')
+        return total
+
+    def _airport_pairs(self, origin_legs, destination_legs, cached_flight_info):
+        """
+        Every combination of an origin airport and a destination airport, cheapest lower bound first.
+        A pair's bound is exact except for the fare, which is the cached one if we have it and MIN_FARE otherwise,
+        so once the best quoted pair costs less than the next bound nothing after it can win
+
+        :param origin_legs: [(airport, DrivingInfo)] drives to the origin side airports
+        :param destination_legs: [(airport, DrivingInfo)] drives from the destination side airports
+        :param cached_flight_info: cached_flight_info(origin airport, destination airport) -> FlightInfo or None,
+            must not go upstream
+        :return: [(lower bound, (origin airport, drive to it), (destination airport, drive from it), flight minutes)]
+        """
+        if not origin_legs or not destination_legs:
+            return []
+        origin_ports = [port for port, _ in origin_legs]
+        destination_ports = [port for port, _ in destination_legs]
+        flight_minutes = self._flight_duration_minutes(
+            pairwise_haversine_km([port.coords() for port in origin_ports],
+                                  [port.coords() for port in destination_ports]))
+
+        pairs = []
+        for i, origin_leg in enumerate(origin_legs):
+            for j, destination_leg in enumerate(destination_legs):
+                minutes = float(flight_minutes[i][j])
+                cached = cached_flight_info(origin_ports[i], destination_ports[j])
+                fare = cached.estimated_price if cached is not None else MIN_FARE
+                bound = (self._generalized_cost(origin_leg[1]) + self._generalized_cost(destination_leg[1])
+                         + self._flight_cost(FlightInfo(minutes, fare)))
+                pairs.append((bound, origin_ports[i].rank + destination_ports[j].rank, origin_leg, destination_leg, minutes))
+        pairs.sort(key=lambda pair: pair[:2])
+        return [(bound, origin_leg, destination_leg, minutes) for bound, _, origin_leg, destination_leg, minutes in pairs]
+
+    def _clear_cut(self, driving_route, flying_info):
+        """
+        Whether a direct drive is so far from the flying option, either way, that the error in an estimated
+        route couldn't change which one wins. Compared at the default trip parameters
+        """
+        if flying_info is None:
+            return True
+        drive = self._price_drive(driving_route, 8 * 60, 20, self.gas_prices.national_price())
+        drive_cost = self._generalized_cost(drive)
+        fly_cost = self._flying_cost(flying_info)
+        return abs(drive_cost - fly_cost) > self.ESTIMATE_DECISION_MARGIN * min(drive_cost, fly_cost)
+
+    def _airport_legs(self, place_coords, airports, to_or_from, require_calibration=True):
+        """
+        Estimated routes between a place and each of its candidate airports, or None unless all of them can be estimated
+        """
+        routes = []
+        for port in airports:
+            ends = (place_coords, port.coords()) if to_or_from == 'to' else (port.coords(), place_coords)
+            route = self.road.estimate(*ends, use='airport_leg', require_calibration=require_calibration)
+            if route is None:
+                return None
+            routes.append(route)
+        return routes
+
+    def _airport_place(self, airport):
+        """
+        Something the distance matrix can route to for an airport, if we have it stored.
+        Otherwise the caller has to reverse geocode the airport's coordinates
+        """
+        if airport.place_id:
+            return f'place_id:{airport.place_id}'
+        return airport.place_name
 
-        # haversine formula
-        dlng = lng2 - lng1
-        dlat = lat2 - lat1
-        a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlng / 2) ** 2
-        c = 2 * asin(sqrt(a))
-        r = 6371  # Radius of earth in kilometers. Use 3956 for miles. Determines return value units.
-        return c * r
+    def _find_nearest_airport(self, coords):
+        # closest first. which one we actually use is decided by the drive to/from it
+        return [airport for airport, _ in self.airports.nearest(coords, k=self.AIRPORT_CANDIDATES)]
+
+
+class TripProgress:
+    """
+    Hands each leg of a trip to on_progress(leg, result) as soon as it's worked out,
+    for callers that want to show partial results (see jobs.py)
+    """
+
+    def __init__(self, on_progress=None, price_drive=None):
+        """
+        :param price_drive: price_drive(route, endpoint coords, estimated) prices the direct drive as a DrivingInfo
+        """
+        self.on_progress = on_progress
+        self.price_drive = price_drive
+
+    def __report(self, leg, result):
+        if self.on_progress is not None:
+            self.on_progress(leg, result)
+
+    def driving_route(self, route, coords, estimated=False):
+        # pricing looks up hotels, don't bother if nobody's listening
+        if self.on_progress is not None:
+            self.__report('driving', self.price_drive(route, coords, estimated).to_dict())
+
+    def airport_drive(self, to_or_from, airport, driving_info):
+        if driving_info is not None:
+            self.__report(f'drive_{to_or_from}_airport', {'airport': airport.code, **driving_info.to_dict()})
+
+    def flight(self, origin, destination, flight_info):
+        self.__report('flight', {'origin': origin.code, 'destination': destination.code, **flight_info.to_dict()})
+
+    def flying(self, flying_info):
+        self.__report('flying', flying_info.to_dict() if flying_info is not None else None)
+
+
+NO_PROGRESS = TripProgress()
+
+
+class AirportPairSearch:
+    """
+    Best-first search over airport pairs (see TripCalculatorBase._airport_pairs), with the quoting left to the caller.
+    The cheapest bound is quoted on its own first, since it usually wins outright. After that,
+    every pair whose bound is still under the best quoted cost is quoted at once, so a trip waits on
+    at most two rounds of flight lookups
+    """
+
+    def __init__(self, calculator, pairs):
+        self.calculator = calculator
+        self.pairs = pairs
+        self.position = 0
+        self.quoted = 0
+        self.best = None
+        self.best_cost = float('inf')
+
+    def next_batch(self):
+        """
+        :return: the pairs to quote next, empty when the search is done
+        """
+        size = 1 if self.quoted == 0 else self.calculator.MAX_FLIGHT_QUOTES - self.quoted
+        batch = []
+        while self.position < len(self.pairs) and len(batch) < size:
+            pair = self.pairs[self.position]
+            if pair[0] >= self.best_cost:
+                break
+            batch.append(pair)
+            self.position += 1
+        return batch
+
+    def add_quotes(self, batch, flight_infos):
+        """
+        :param flight_infos: FlightInfo for each pair in the batch, None for pairs that couldn't be quoted
+        """
+        for (_, origin_leg, destination_leg, _), flight_info in zip(batch, flight_infos):
+            self.quoted += 1
+            if flight_info is None:
+                continue
+            cost = (self.calculator._generalized_cost(origin_leg[1]) + self.calculator._generalized_cost(destination_leg[1])
+                    + self.calculator._flight_cost(flight_info))
+            if self.best is None or cost < self.best_cost:
+                self.best, self.best_cost = (origin_leg, destination_leg, flight_info), cost
+
+
+class TripCalculatorService(TripCalculatorBase):
+    # a trip is served from the result cache as is for TRIP_TTL_SECONDS (in line with the route cache),
+    # then for up to TRIP_STALE_SECONDS more while it's recalculated in the background
+    TRIP_TTL_SECONDS = 15 * 60
+    TRIP_STALE_SECONDS = 24 * 60 * 60
+    # a call that runs out the deadline gets this long to hand back its fallback before we stop waiting on it
+    FALLBACK_GRACE_SECONDS = 0.5
+
+    def __init__(self, concurrent=True, call_timeout_seconds=15, road_estimates=None, budget_seconds=None):
+        """
+        :param concurrent: run independent upstream calls in parallel on the shared pool,
+            otherwise everything runs one after another on the calling thread
+        :param call_timeout_seconds: how long to wait on any single scheduled call
+        :param road_estimates: when to use RoadEstimator guesses instead of google routes (FLYORDRIVE_ROAD_ESTIMATES):
+            'on' for airport legs and clear-cut direct drives, and whenever google fails,
+            'fallback' only when google fails, 'off' never
+        :param budget_seconds: how long a trip or itinerary gets to ask upstreams (FLYORDRIVE_TRIP_BUDGET_SECONDS,
+            default 10). Whatever hasn't answered by then is estimated, or left out if it can't be
+        """
+        super().__init__()
+        if budget_seconds is None:
+            budget_seconds = float(os.environ.get('FLYORDRIVE_TRIP_BUDGET_SECONDS', 10))
+        self.budget_seconds = budget_seconds
+        self.road_estimates = road_estimates or os.environ.get('FLYORDRIVE_ROAD_ESTIMATES', 'on')
+        if self.road_estimates not in ('on', 'fallback', 'off'):
+            raise ValueError(f"road_estimates must be 'on', 'fallback' or 'off', got {self.road_estimates!r}")
+        self.executor = get_executor() if concurrent else InlineExecutor()
+        self.call_timeout_seconds = call_timeout_seconds
+        self.gdm = CachedGoogleDistanceMatrixGateway(build_gateway('google', GoogleDistanceMatrixGateway),
+                                                     get_response_cache())
+        self.eia = build_gateway('eia', EIAGateway)
+        self.sky = CachedSkyScannerGateway(build_gateway('skyscanner', SkyScannerGateway), get_response_cache(),
+                                           fares=self.fares)
+        self.hotels = CachedGoogleHotelsGateway(build_gateway('hotels', GoogleHotelsGateway), get_response_cache())
+        self.results = get_response_cache()
+        # refreshes wait on the shared pool themselves, so they can't run on it
+        self.refresh_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='flyordrive-refresh')
+        # same for the legs of an itinerary
+        self.leg_executor = (TracingThreadPoolExecutor(max_workers=8, thread_name_prefix='flyordrive-leg')
+                             if concurrent else InlineExecutor())
+
+    def __result(self, future):
+        # note a timed out call keeps running in the background, we just stop waiting on it
+        left = remaining()
+        if left is None:
+            return future.result(timeout=self.call_timeout_seconds)
+        return future.result(timeout=min(self.call_timeout_seconds, left + self.FALLBACK_GRACE_SECONDS))
+
+    def __result_or_none(self, future):
+        try:
+            return self.__result(future)
+        except Exception as e:
+            logger.warning("Upstream call failed %r", e)
+            return None
 
     def haversine_places(self, origin, destination):
         """
@@ -111,152 +405,535 @@ class TripCalculatorService:
 
         return self.haversine_coords((lat1, lng1), (lat2, lng2))
 
-    def __calculate_drive(self, origin, destination, max_one_day_driving_minutes, car_mpg):
-        print("Calculating drive", origin, destination)
-        driving_route = self.gdm.get_driving_route(origin, destination)
-        distance_miles = (driving_route[0] / 1000) * 0.62
-        driving_duration_seconds = driving_route[1]
-
-        # assume that you don't need a hotel on last day of trip, since you'll be at destination
-        num_stops = max(0, driving_duration_seconds / (max_one_day_driving_minutes * 60) - 1)
-        hotel_total_price = 150 * num_stops
-
-        # assume you run car dry each time, then you're refilling gas_price * tank_size
-        # and you do that when you run out, which is mpg * tank_size miles
-        # but tank_size cancels out, so you don't need it
-        num_gas_stops = distance_miles / car_mpg
-        gas_total_price = num_gas_stops * 3.3
-
-        return DrivingInfo(distance_miles, driving_duration_seconds, hotel_total_price, gas_total_price)
-
-    def __calculate_flight(self, origin, destination):
+    def __driving_route(self, origin, destination, origin_coords, destination_coords):
+        """
+        :return: (route, estimated). The route is only estimated if google failed
+        """
+        with span('drive', origin=origin, destination=destination):
+            try:
+                route = self.gdm.get_driving_route(origin, destination)
+            except Exception as e:
+                if self.road_estimates == 'off':
+                    raise
+                logger.warning("Estimating drive from %s to %s, google failed: %r", origin, destination, e)
+                return self.road.estimate(origin_coords, destination_coords, use='fallback', require_calibration=False), True
+        self.road.observe(origin_coords, destination_coords, route)
+        return route, False
+
+    def __nightly_prices(self, points):
+        """
+        Hotel prices are a refinement, if they can't be had the nights are priced at the default
         """
+        if not points:
+            return []
+        try:
+            return self.hotels.get_nightly_prices(points)
+        except Exception as e:
+            logger.warning("Pricing %d nights at the default, hotel lookup failed: %r", len(points), e)
+            return [None] * len(points)
+
+    def __calculate_flight(self, origin, destination, flight_duration_minutes=None):
+        with span('flight', origin=origin.code, destination=destination.code):
+            # matrices, refreshes and warm-ups can make do with a route quoted in the last day or so
+            # rather than spend SkyScanner's budget on it again, unless there's a cached quote to be had for free
+            fare = None
+            if current_lane() == BULK and self.sky.cached_flight_info(origin.code, destination.code) is None:
+                fare = self.fares.recent(origin, destination)
+            if fare is not None:
+                if flight_duration_minutes is None:
+                    flight_duration_minutes = self._flight_duration_minutes(
+                        self.haversine_coords(origin.coords(), destination.coords()))
+                return FlightInfo(flight_duration_minutes, fare, estimated=True)
+            flight_info = self.sky.get_flight_info(origin.code, destination.code)
+            return self._flight_info(origin, destination, flight_info['Quotes'], flight_duration_minutes)
+
+    def __quoted_or_cached(self, flight_f, origin, destination):
+        """
+        The quote flight_f went for, or if it failed the last one we had, or failing that an estimate
 
-        :param origin: Airport
-        :param destination: Airport
-        :return:
+        :return: FlightInfo
         """
-        flight_distance_miles = self.haversine_coords(origin.coords(), destination.coords()) * 0.60
-        # +30 minutes for gate waiting
-        flight_duration_minutes = (flight_distance_miles / 550) * 60 + 30
+        try:
+            return self.__result(flight_f)
+        except Exception as e:
+            logger.warning("Quoting %s to %s failed, falling back on the cache: %r", origin.code, destination.code, e)
+            return self.__cached_or_estimated_flight(origin, destination)
 
-        flight_info = self.sky.get_flight_info(origin.code, destination.code)
-        quotes = flight_info['Quotes']
-        if len(quotes) == 0:
-            avg_price = float('inf')
-        else:
-            avg_price = sum([q['MinPrice'] for q in quotes]) / len(quotes)
+    def __attempt_to_find_airports(self, place, airports, to_or_from, place_coords):
+        """
+        Given a place near a list of candidate airports, pick the airport with the cheapest drive,
+        counting time spent driving as money
 
-        return FlightInfo(flight_duration_minutes, avg_price)
+        :return: (airport, DrivingInfo), or (None, None) if none of the airports could be reached
+        """
+        return self._pick_airport(self.__airport_drives(place, airports, to_or_from, place_coords))
 
-    def __attempt_to_find_airports(self, place, airports, to_or_from):
+    def __airport_drives(self, place, airports, to_or_from, place_coords):
         """
-        Given a place near a list of candidate airports,
-        try to find a route from the place to/from any of the airports
+        Route from the place to/from all of the airports in one distance matrix request.
+        These drives are short and only decide between nearby airports, so once the road estimator
+        knows the area they're estimated instead
 
         :param place:
         :param airports:
         :param to_or_from: 'to' or 'from'
-        :return:
+        :param place_coords: where place geocodes to
+        :return: [(airport, DrivingInfo)] for the airports that could be reached
         """
-        airport_drive = None
-        airport = None
-        for port in airports:
-            # TODO unfortunate workaround for now
-            # we only have the AITA codes for airports which aren't reliable for geocoding
-            # the website I used to get the AITA codes no longer works :) so it'll be manual to get the names
-            # honestly, could just run this once for each airport and save it to db :shrug:
-            port_place = self.gdm.reverse_geocode(port.coords())
-            if to_or_from == 'to':
-                origin = place
-                destination = port_place
-            else:
-                origin = port_place
-                destination = place
+        with span('airport_drive', place=place, to_or_from=to_or_from, airports=[port.code for port in airports]):
+            if self.road_estimates == 'on':
+                routes = self._airport_legs(place_coords, airports, to_or_from)
+                if routes is not None:
+                    return self._airport_legs_priced(airports, routes, estimated=True)
+
             try:
-                airport_drive = self.__calculate_drive(origin,
-                                                       destination,
-                                                       max_one_day_driving_minutes=480,
-                                                       car_mpg=20)
-                airport = port
-                break
-            except:
-                pass
+                routes = self.__airport_routes(place, airports, to_or_from)
+            except Exception as e:
+                if self.road_estimates == 'off':
+                    raise
+                logger.warning("Estimating drives %s %s's airports, google failed: %r", to_or_from, place, e)
+                routes = self._airport_legs(place_coords, airports, to_or_from, require_calibration=False)
+                return self._airport_legs_priced(airports, routes, estimated=True)
+
+            for port, route in zip(airports, routes):
+                ends = (place_coords, port.coords()) if to_or_from == 'to' else (port.coords(), place_coords)
+                self.road.observe(*ends, route)
+            return self._airport_legs_priced(airports, routes)
+
+    def __airport_routes(self, place, airports, to_or_from):
+        # AITA codes aren't reliable for geocoding, so airports are routed to by their stored place
+        # (see scripts/enrich_airports.py), only falling back to reverse geocoding for airports that haven't been enriched
+        port_places = [self._airport_place(port) or self.gdm.reverse_geocode(port.coords()) for port in airports]
+        if to_or_from == 'to':
+            return self.gdm.get_driving_routes([place], port_places)[0]
+        return [row[0] for row in self.gdm.get_driving_routes(port_places, [place])]
+
+    def __nearest_airports_to_place(self, place):
+        """
+        :return: (place coords, candidate airports)
+        """
+        coords = self.gdm.get_lat_lng(place)
+        with span('nearest_airport', place=place):
+            return coords, self._find_nearest_airport(coords)
 
-        return airport, airport_drive
+    def __cached_flight(self, origin, destination):
+        quotes = self.sky.cached_flight_info(origin.code, destination.code)
+        return self._flight_info(origin, destination, quotes['Quotes']) if quotes is not None else None
 
-    def __calculate_flying_trip(self, origin, destination):
+    def __cached_or_estimated_flight(self, origin, destination, flight_duration_minutes=None):
+        cached = self.__cached_flight(origin, destination)
+        return cached if cached is not None else self._flight_info(origin, destination, [], flight_duration_minutes)
+
+    def __calculate_flying_trip(self, origin, destination, progress=NO_PROGRESS):
         """
         For cases when the origin or destination are a non-trivial distance from nearest airport
 
-        Geocode the places and determine nearest airports. Calculate flight between them and then
-        calculate driving routes to origin airport and from destination airport
+        Geocode the places and find the nearest few airports on each side, then route the drives to/from all of them
+        (one request a side). Every pairing of those airports could be the best way to fly, but quoting them all
+        is k^2 flight lookups, so pairs are tried cheapest lower bound first and the search stops as soon as
+        no remaining pair could beat the best one quoted so far
+
+        The flight quote for the closest airport pair, which is usually the one we end up with,
+        is fetched while the airport drives are still in flight
 
         :param origin:
         :param destination:
-        :return:
+        :return: (FlyingTripInfo, (origin side airport, destination side airport)),
+            or (None, None) if no airport on one of the sides can be reached
         """
 
-        origin_latlng = self.gdm.get_lat_lng(origin)
-        origin_airports = self.__find_nearest_airport(origin_latlng)
+        origin_airports_f = self.executor.submit(self.__nearest_airports_to_place, origin)
+        destination_airports_f = self.executor.submit(self.__nearest_airports_to_place, destination)
+        origin_coords, origin_airports = self.__result(origin_airports_f)
+        destination_coords, destination_airports = self.__result(destination_airports_f)
+
+        drives_to_airport_f = self.executor.submit(self.__airport_drives, origin, origin_airports, 'to', origin_coords)
+        drives_from_airport_f = self.executor.submit(self.__airport_drives,
+                                                     destination, destination_airports, 'from', destination_coords)
 
-        destination_latlng = self.gdm.get_lat_lng(destination)
-        destination_airports = self.__find_nearest_airport(destination_latlng)
+        if not (drives_to_airport_f.done() and drives_from_airport_f.done()):
+            # shares its upstream call with the search's quote for the pair, if it gets that far
+            self.executor.submit(self.__calculate_flight, origin_airports[0], destination_airports[0])
 
-        origin_airport, drive_to_airport = self.__attempt_to_find_airports(origin, origin_airports, 'to')
-        destination_airport, drive_from_airport = self.__attempt_to_find_airports(destination, destination_airports, 'from')
+        drives_to_airport = self.__result(drives_to_airport_f)
+        drives_from_airport = self.__result(drives_from_airport_f)
 
         # TODO fail gracefully
-        if drive_to_airport is None or drive_from_airport is None:
-            return None
+        best = self.__search_airport_pairs(drives_to_airport, drives_from_airport)
+        if best is None:
+            return None, None
 
-        flight_info = self.__calculate_flight(origin_airport, destination_airport)
+        (origin_airport, drive_to_airport), (destination_airport, drive_from_airport), flight_info = best
+        progress.airport_drive('to', origin_airport, drive_to_airport)
+        progress.airport_drive('from', destination_airport, drive_from_airport)
+        progress.flight(origin_airport, destination_airport, flight_info)
 
         flying_trip_info = FlyingTripInfo(flight_info, drive_to_airport.combine(drive_from_airport))
 
-        return flying_trip_info
-
-    def __find_nearest_airport(self, coords):
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        db_path = os.path.join(base_dir, '../../db.sqlite3')
-        con = sqlite3.connect(db_path)
-        cur = con.cursor()
-        cur.execute('SELECT * FROM airport;')
-        airport_rows = cur.fetchall()
-        # the below is a bad hack to sort by airport popularity
-        # the list we got the airports from was sorted by descending popularity
-        # so we can first trim the list down to nearby airports
-        # and then sort those remainders on the primary key as a proxy for most popular
-        # (because the data was inserted in desc popular order)
-        airports = [
-            (row[0], Airport(row[1], float(row[2]), float(row[3])))
-            for row in airport_rows
-        ]
+        return flying_trip_info, (origin_airport, destination_airport)
 
-        dists = [(airport, self.haversine_coords(coords, airport[1].coords())) for airport in airports]
-        nearest_airport = sorted(sorted(dists, key=lambda d: d[1])[:3], key=lambda d: d[0][0])
-        return [port[0][1] for port in nearest_airport]
+    def __search_airport_pairs(self, drives_to_airport, drives_from_airport):
+        """
+        :return: ((origin airport, drive to it), (destination airport, drive from it), FlightInfo) for the cheapest
+            pair quoted, or None if there's no pair to fly
+        """
+        pairs = self._airport_pairs(drives_to_airport, drives_from_airport, self.__cached_flight)
+        search = AirportPairSearch(self, pairs)
+        with span('airport_pairs', pairs=len(pairs)) as fields:
+            batch = search.next_batch()
+            while batch:
+                flights = [self.executor.submit(self.__calculate_flight, origin_leg[0], destination_leg[0], minutes)
+                           for _, origin_leg, destination_leg, minutes in batch]
+                search.add_quotes(batch, [self.__quoted_or_cached(flight, origin_leg[0], destination_leg[0])
+                                          for flight, (_, origin_leg, destination_leg, _) in zip(flights, batch)])
+                batch = search.next_batch()
+            fields['quoted'] = search.quoted
+        return search.best
+
+    @staticmethod
+    def trip_key(origin_coords, destination_coords):
+        # ~10m, so different spellings of the same place share a result
+        return '|'.join(f'{lat:.4f},{lng:.4f}' for lat, lng in (origin_coords, destination_coords))
+
+    def __calculate_skeleton(self, origin, destination, origin_coords, destination_coords, progress=NO_PROGRESS):
+        coords = (origin_coords, destination_coords)
+        estimate = self.road.estimate(*coords) if self.road_estimates == 'on' else None
+        if estimate is None:
+            driving_route_f = self.executor.submit(self.__driving_route, origin, destination, *coords)
+            # the direct drive is usually done long before the flying side
+            driving_route_f.add_done_callback(
+                lambda f: f.exception() is None and progress.driving_route(f.result()[0], coords, f.result()[1]))
+        with span('flying_trip', origin=origin, destination=destination):
+            flying_info, airports = self.__calculate_flying_trip(origin, destination, progress)
+
+        if estimate is None:
+            try:
+                driving_route, estimated = self.__result(driving_route_f)
+            except TimeoutError:
+                if self.road_estimates == 'off':
+                    raise
+                logger.warning("Estimating drive from %s to %s, google timed out", origin, destination)
+                driving_route, estimated = self.road.estimate(*coords, use='fallback', require_calibration=False), True
+        elif self._clear_cut(estimate, flying_info):
+            driving_route, estimated = estimate, True
+            progress.driving_route(driving_route, coords, estimated)
+        else:
+            # close call, the real route might change the answer
+            driving_route, estimated = self.__driving_route(origin, destination, *coords)
+            progress.driving_route(driving_route, coords, estimated)
+        return TripSkeleton(origin_coords, destination_coords, driving_route, flying_info, estimated, airports)
+
+    def __trip_skeleton(self, origin, destination, progress=NO_PROGRESS):
+        origin_coords_f = self.executor.submit(self.gdm.get_lat_lng, origin)
+        destination_coords = self.gdm.get_lat_lng(destination)
+        origin_coords = self.__result(origin_coords_f)
+        return self.__leg_skeleton(origin, destination, origin_coords, destination_coords, progress)
+
+    def __leg_skeleton(self, origin, destination, origin_coords, destination_coords, progress=NO_PROGRESS):
+        """
+        The trip's upstream data, from the result cache if we've seen this pair of places recently.
+        Identical trips requested at the same time are only calculated once, and a trip we've seen
+        the other way round recently is worked out from that one, which only costs a flight quote.
+        Refreshes always recalculate, otherwise two directions turned around from each other would never
+        see the routes again
+        """
+        def compute():
+            reverse = self.results.get('trip', self.trip_key(destination_coords, origin_coords))
+            if self.results.is_fresh(reverse):
+                reverse = TripSkeleton.from_dict(reverse['value'])
+                # skeletons cached before they kept their airports can't be turned around
+                if reverse.flying_info is None or reverse.airports is not None:
+                    return self.__reversed_skeleton(reverse)
+            return self.__calculate_skeleton(origin, destination, origin_coords, destination_coords, progress)
+
+        skeleton = self.results.get_or_refresh(
+            'trip',
+            self.trip_key(origin_coords, destination_coords),
+            lambda: compute().to_dict(),
+            ttl=self.TRIP_TTL_SECONDS,
+            stale_ttl=self.TRIP_STALE_SECONDS,
+            executor=self.refresh_executor,
+            # whoever asked first has had their answer by the time a refresh runs, it mustn't report to them
+            refresh=lambda: self.__calculate_skeleton(origin, destination, origin_coords, destination_coords,
+                                                      NO_PROGRESS).to_dict())
+        return TripSkeleton.from_dict(skeleton)
+
+    def __reversed_skeleton(self, skeleton):
+        flight_info = None
+        if skeleton.flying_info is not None:
+            origin_airport, destination_airport = skeleton.airports
+            minutes = skeleton.flying_info.flight_info.flight_duration_minutes
+            try:
+                flight_info = self.__calculate_flight(destination_airport, origin_airport, minutes)
+            except Exception as e:
+                logger.warning("Quoting %s to %s failed, falling back on the cache: %r",
+                               destination_airport.code, origin_airport.code, e)
+                flight_info = self.__cached_or_estimated_flight(destination_airport, origin_airport, minutes)
+        return skeleton.reversed(flight_info)
+
+    def __drive_pricer(self, max_one_day_driving_minutes, car_mpg):
+        """
+        :return: price_drive(route, endpoint coords, estimated) -> DrivingInfo, with each night priced where it's spent
+        """
+        def price_drive(route, coords, estimated=False):
+            points = self._overnight_points(route, coords, max_one_day_driving_minutes)
+            stops = self._overnight_stops(points, self.__nightly_prices(points))
+            return self._price_drive(route, max_one_day_driving_minutes, car_mpg, self._gas_price(*coords), estimated, stops)
 
-    def calculate_trip(self, origin, destination, max_one_day_driving_minutes=8 * 60, car_mpg=20):
+        return price_drive
+
+    def calculate_trip(self, origin, destination, max_one_day_driving_minutes=8 * 60, car_mpg=20, on_progress=None):
         """
         Given origin and destination, determine relevant trip information,
         e.g time to drive, cost of driving + hotels, flight length and price
 
         :param origin: name of origin city
         :param destination: name of destination city
+        :param on_progress: optional on_progress(leg, result), called as each leg is worked out.
+            Legs are driving, drive_to_airport, drive_from_airport, flight and flying,
+            a trip served from the result cache only reports driving and flying
         :return: TripInfoView
         """
 
-        print(f"calculating trip for {origin} to {destination}")
+        logger.info("calculating trip for %s to %s", origin, destination)
+
+        price_drive = self.__drive_pricer(max_one_day_driving_minutes, car_mpg)
+        progress = TripProgress(on_progress, price_drive)
+        with trace('trip', origin=origin, destination=destination), deadline(self.budget_seconds):
+            skeleton = self.__trip_skeleton(origin, destination, progress)
 
-        driving_info = self.__calculate_drive(origin, destination, max_one_day_driving_minutes, car_mpg)
-        flying_info = self.__calculate_flying_trip(origin, destination)
+            coords = (skeleton.origin_coords, skeleton.destination_coords)
+            # the hotel lookups are upstream calls like any other, they get what's left of the budget
+            driving_info = price_drive(skeleton.driving_route, coords, skeleton.driving_route_estimated)
+            # everything is known now, whether or not it came from the cache
+            progress.driving_route(skeleton.driving_route, coords, skeleton.driving_route_estimated)
+            progress.flying(skeleton.flying_info)
+
+        return {
+            'driving': driving_info.to_dict(),
+            'flying': skeleton.flying_info.to_dict() if skeleton.flying_info is not None else None
+        }
 
-        # TODO remember about return leg of driving too
+    def calculate_itinerary(self, stops, round_trip=False, max_one_day_driving_minutes=8 * 60, car_mpg=20,
+                            on_progress=None):
+        """
+        Fly-or-drive for every leg of a multi-stop trip, e.g. A -> B -> C and back to A, and for the trip as a whole:
+        driving all of it, flying all of it, or the best way to do each leg (drive out and fly back, say).
+        Each distinct leg is calculated once, and a leg back the way an earlier one came reuses its routes
+        and airports, only the flight is quoted again
+
+        :param stops: place names in the order they're visited, at least two
+        :param round_trip: come back to the first stop at the end
+        :param on_progress: optional on_progress(index, leg), called as each leg is worked out
+        :return: {'legs': [{'origin', 'destination', 'driving', 'flying', 'best'}],
+            'total': {'driving', 'flying', 'best'}}, where a total is {'total_price', 'total_duration_minutes', 'modes'}
+            and the flying total is None if some leg can't be flown
+        """
+        places = list(stops) + ([stops[0]] if round_trip and stops else [])
+        if len(places) < 2:
+            raise ValueError("an itinerary needs at least two stops")
+        legs = list(zip(places, places[1:]))
+        logger.info("calculating %d leg itinerary through %s", len(legs), ', '.join(places))
+        price_drive = self.__drive_pricer(max_one_day_driving_minutes, car_mpg)
+
+        with trace('itinerary', legs=len(legs)), deadline(self.budget_seconds):
+            distinct_places = list(OrderedDict.fromkeys(places))
+            geocodes = [self.executor.submit(self.gdm.get_lat_lng, place) for place in distinct_places]
+            place_coords = dict(zip(distinct_places, map(self.__result, geocodes)))
+
+            # both directions between two places are worked out by the same task, one after the other,
+            # so the second is turned around from the first rather than calculated again
+            pairs = OrderedDict()
+            for origin, destination in OrderedDict.fromkeys(legs):
+                key = frozenset((place_coords[origin], place_coords[destination]))
+                pairs.setdefault(key, []).append((origin, destination))
+            pair_fs = [self.leg_executor.submit(self.__pair_skeletons, directions, place_coords)
+                       for directions in pairs.values()]
+
+            priced = {}
+            for pair_f in as_completed(pair_fs):
+                for (origin, destination), skeleton in pair_f.result().items():
+                    priced[(origin, destination)] = self.__price_leg(origin, destination, skeleton, price_drive)
+                    for i, leg in enumerate(legs):
+                        if on_progress is not None and leg == (origin, destination):
+                            on_progress(i, priced[leg][0])
+
+        results = [priced[leg] for leg in legs]
+        return {
+            'legs': [leg for leg, _, _ in results],
+            'total': {
+                'driving': self._itinerary_total([driving_info for _, driving_info, _ in results]),
+                'flying': (self._itinerary_total([flying_info for _, _, flying_info in results])
+                           if all(flying_info is not None for _, _, flying_info in results) else None),
+                'best': self._itinerary_total([
+                    flying_info if leg['best'] == 'flying' else driving_info
+                    for leg, driving_info, flying_info in results
+                ])
+            }
+        }
 
-        print("Finished calculations")
+    def __pair_skeletons(self, directions, place_coords):
+        """
+        :param directions: one or both of (a, b) and (b, a)
+        :return: {(origin, destination): TripSkeleton}
+        """
+        return {(origin, destination): self.__leg_skeleton(origin, destination, place_coords[origin], place_coords[destination])
+                for origin, destination in directions}
 
+    def __price_leg(self, origin, destination, skeleton, price_drive):
+        """
+        :return: (leg dict, DrivingInfo, FlyingTripInfo or None)
+        """
+        driving_info = price_drive(skeleton.driving_route, (skeleton.origin_coords, skeleton.destination_coords),
+                                   skeleton.driving_route_estimated)
+        flying_info = skeleton.flying_info
+        fly = flying_info is not None and self._flying_cost(flying_info) < self._generalized_cost(driving_info)
         return {
+            'origin': origin,
+            'destination': destination,
             'driving': driving_info.to_dict(),
-            'flying': flying_info.to_dict()
+            'flying': flying_info.to_dict() if flying_info is not None else None,
+            'best': 'flying' if fly else 'driving'
+        }, driving_info, flying_info
+
+    def calculate_matrix(self, origins, destinations, max_one_day_driving_minutes=8 * 60, car_mpg=20, columnar=False):
+        """
+        Fly-or-drive for every origin/destination pair, yielded one origin row at a time as rows finish
+
+        Work is shared across the batch: each distinct place is geocoded and matched to an airport once,
+        each airport pair is quoted once, and each row's direct drives are a single distance matrix request.
+        A pair that can't be routed comes back as None rather than failing the whole batch
+
+        :param origins: list of place names
+        :param destinations: list of place names
+        :param columnar: rows as {'origin': ..., 'columns': TripColumns dict} rather than a dict per trip,
+            much smaller for wide matrices
+        :return: generator of {'origin': ..., 'trips': [{'destination': ..., 'driving': ..., 'flying': ...}]}
+        """
+        logger.info("calculating %dx%d trip matrix", len(origins), len(destinations))
+        with trace('matrix', origins=len(origins), destinations=len(destinations)):
+            for origin, driving_infos, flying_infos in self.__matrix_rows(origins, destinations,
+                                                                          max_one_day_driving_minutes, car_mpg):
+                if columnar:
+                    yield {'origin': origin, 'columns': TripColumns(destinations, driving_infos, flying_infos).to_dict()}
+                    continue
+                yield {'origin': origin, 'trips': [
+                    {
+                        'destination': destination,
+                        'driving': driving_info.to_dict() if driving_info is not None else None,
+                        'flying': flying_info.to_dict() if flying_info is not None else None
+                    }
+                    for destination, driving_info, flying_info in zip(destinations, driving_infos, flying_infos)
+                ]}
+
+    def __matrix_rows(self, origins, destinations, max_one_day_driving_minutes, car_mpg):
+        """
+        :return: generator of (origin, [DrivingInfo or None], [FlyingTripInfo or None]), one per origin
+        """
+
+        direct_routes = {
+            place: self.executor.submit(self.gdm.get_driving_routes, [place], destinations)
+            for place in OrderedDict.fromkeys(origins)
+        }
+
+        # geocode everything, then find each place's airports once
+        places = list(OrderedDict.fromkeys(list(origins) + list(destinations)))
+        geocodes = [self.executor.submit(self.gdm.get_lat_lng, place) for place in places]
+        place_coords = OrderedDict((place, coords) for place, coords in zip(places, map(self.__result_or_none, geocodes))
+                                   if coords is not None)
+        with span('nearest_airport', places=len(place_coords)):
+            # down the k-d tree one place at a time, ranking the whole table for a batch only pays off for tiny tables
+            nearest = {place: self._find_nearest_airport(coords) for place, coords in place_coords.items()}
+
+        destination_sides = {
+            place: self.executor.submit(self.__attempt_to_find_airports, place, nearest[place], 'from', place_coords[place])
+            for place in OrderedDict.fromkeys(destinations) if place in nearest
+        }
+        origin_sides = {
+            place: self.executor.submit(self.__attempt_to_find_airports, place, nearest[place], 'to', place_coords[place])
+            for place in OrderedDict.fromkeys(origins) if place in nearest
         }
+        flights = {}
+
+        def side(sides, place):
+            if place not in sides:
+                return None, None
+            return self.__result_or_none(sides[place]) or (None, None)
+
+        for origin in origins:
+            origin_airport, drive_to_airport = side(origin_sides, origin)
+            destination_sides_for_row = [side(destination_sides, destination) for destination in destinations]
+
+            flight_durations = []
+            if origin_airport is not None:
+                destination_coords = [airport.coords() if airport is not None else origin_airport.coords()
+                                      for airport, _ in destination_sides_for_row]
+                flight_distances = pairwise_haversine_km([origin_airport.coords()], destination_coords)[0]
+                flight_durations = self._flight_duration_minutes(flight_distances)
+
+            # kick off every flight quote the row needs before waiting on any of them
+            flying_legs = []
+            for j, (destination_airport, drive_from_airport) in enumerate(destination_sides_for_row):
+                if drive_to_airport is None or drive_from_airport is None:
+                    flying_legs.append(None)
+                    continue
+                key = (origin_airport.code, destination_airport.code)
+                if key not in flights:
+                    flights[key] = self.executor.submit(self.__calculate_flight, origin_airport, destination_airport,
+                                                        float(flight_durations[j]))
+                flying_legs.append((flights[key], drive_to_airport.combine(drive_from_airport)))
+
+            routes = self.__result_or_none(direct_routes[origin])
+            routes = routes[0] if routes is not None else [None] * len(destinations)
+
+            # every night on the road in the whole row is priced in one hotel lookup
+            row_points = []
+            for destination, route in zip(destinations, routes):
+                if route is not None and origin in place_coords and destination in place_coords:
+                    coords = (place_coords[origin], place_coords[destination])
+                    row_points.append(self._overnight_points(route, coords, max_one_day_driving_minutes))
+                else:
+                    row_points.append(None)
+            nightly_prices = iter(self.__nightly_prices([point for points in row_points if points for point in points]))
+
+            driving_infos = []
+            flying_infos = []
+            for destination, route, points, flying_leg in zip(destinations, routes, row_points, flying_legs):
+                driving_info = None
+                if route is not None:
+                    endpoints = [place_coords[p] for p in (origin, destination) if p in place_coords]
+                    if len(endpoints) == 2:
+                        self.road.observe(*endpoints, route)
+                    gas_price = self._gas_price(*endpoints) if endpoints else self.gas_prices.national_price()
+                    stops = None
+                    if points is not None:
+                        stops = self._overnight_stops(points, [next(nightly_prices) for _ in points])
+                    driving_info = self._price_drive(route, max_one_day_driving_minutes, car_mpg, gas_price,
+                                                     overnight_stops=stops)
+                flying_info = None
+                if flying_leg is not None:
+                    flight_f, airport_drives = flying_leg
+                    flight_info = self.__result_or_none(flight_f)
+                    if flight_info is not None:
+                        flying_info = FlyingTripInfo(flight_info, airport_drives)
+                driving_infos.append(driving_info)
+                flying_infos.append(flying_info)
+
+            yield origin, driving_infos, flying_infos
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_trip_calculator_service():
+    """
+    The service and its gateways hold no per-request state, so the whole process shares one instance
+    and with it the gateways' pooled connections
+    """
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = TripCalculatorService()
+    return _service
@@ -1,3 +1,1149 @@
-from django.test import TestCase
+import asyncio
+import copy
+import gc
+import importlib.util
+import io
+import json
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+# no upstreams, API keys or sqlite files in the tree, whatever the environment says.
+# the process-wide services read these the first time they're used
+os.environ.update({
+    'FLYORDRIVE_GATEWAY_MODE': 'stub',
+    'FLYORDRIVE_GATEWAY_LATENCY_MS': '0',
+    'FLYORDRIVE_CACHE_DB': '',
+    'FLYORDRIVE_JOBS_DB': '',
+    'FLYORDRIVE_FARE_HISTORY_DB': '',
+    'FLYORDRIVE_RATE_LIMIT_DB': '',
+    'FLYORDRIVE_GAS_REFRESH_SECONDS': '0',
+})
+
+import numpy as np  # noqa: E402
+from django.core.management import CommandError, call_command  # noqa: E402
+from django.test import SimpleTestCase  # noqa: E402
+
+from .cache import MISSING, SingleFlight, TieredCache  # noqa: E402
+from .deadline import DeadlineExceeded  # noqa: E402
+from .executor import InlineExecutor  # noqa: E402
+from .gateways.backends import build_async_gateway, build_gateway  # noqa: E402
+from .gateways.cached_google_distance_matrix_gateway import (  # noqa: E402
+    AsyncCachedGoogleDistanceMatrixGateway, CachedGoogleDistanceMatrixGateway,
+)
+from .gateways.eia_gateway import EIAGateway  # noqa: E402
+from .gateways.replay_gateway import DelayedGateway, FixtureNotFound, InjectedLatency, ReplayGateway  # noqa: E402
+from .gas_regions import region_for  # noqa: E402
+from .jobs import DONE, FAILED, QUEUED, JobStore  # noqa: E402
+from .management.commands.warm_cache import job_pairs, log_pairs, read_pairs  # noqa: E402
+from .rate_limit import (BULK, INTERACTIVE, MemoryBuckets, RateLimiter, RateLimitExceeded, current_lane, lane,  # noqa: E402
+                         parse_budgets)
+from .resilience import (  # noqa: E402
+    MIN_HEDGE_DELAY_SECONDS, AsyncResilientGateway, CircuitBreaker, CircuitOpen, LatencyTracker, ResilientGateway,
+    UpstreamTimeout,
+)
+from .services.airport_index import AirportIndex  # noqa: E402
+from .services.async_trip_calculator_service import AsyncTripCalculatorService  # noqa: E402
+from .services.domain import Airport, DrivingInfo, FlightInfo, FlyingTripInfo, OvernightStop, TripSkeleton  # noqa: E402
+from .services.fare_history import MIN_FARE, FareEstimator, FareHistory  # noqa: E402
+from .services.gas_price_store import DEFAULT_GAS_PRICE, GasPriceStore  # noqa: E402
+from .services.road_estimator import RoadEstimator  # noqa: E402
+from .services.route_planner import FINAL_STRETCH_MINUTES, day_leg_ends, overnight_points  # noqa: E402
+from .services.trip_calculator_service import AirportPairSearch, TripCalculatorBase  # noqa: E402
+from .services.geo import haversine_km  # noqa: E402
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+SKYSCANNER_URL = 'https://skyscanner-skyscanner-flight-search-v1.p.rapidapi.com/apiservices/browsequotes/v1.0/US'
+EIA_URL = 'https://api.eia.gov/series/'
+DISTANCE_MATRIX_URL = 'https://maps.googleapis.com/maps/api/distancematrix/json'
+
+
+def load_script(name):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(REPO_DIR, 'scripts', f'{name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def random_airports(n, seed=0):
+    rng = np.random.RandomState(seed)
+    lats = np.degrees(np.arcsin(rng.uniform(-1, 1, n)))
+    lngs = rng.uniform(-180, 180, n)
+    return [Airport(f'A{i}', float(lat), float(lng), rank=i) for i, (lat, lng) in enumerate(zip(lats, lngs))]
+
+
+class AirportIndexTest(SimpleTestCase):
+    def setUp(self):
+        self.airports = random_airports(2000)
+        self.index = AirportIndex(self.airports)
+        rng = np.random.RandomState(1)
+        # a few on the antimeridian and the poles, where a lat/lng grid would go wrong
+        self.queries = [(float(lat), float(lng)) for lat, lng in zip(rng.uniform(-90, 90, 50), rng.uniform(-180, 180, 50))]
+        self.queries += [(0.0, 179.9), (0.0, -179.9), (89.9, 0.0), (-89.9, 45.0)]
+
+    def brute_force(self, coords):
+        return sorted((float(haversine_km(*coords, *airport.coords())), airport.rank) for airport in self.airports)
+
+    def test_nearest_matches_brute_force(self):
+        for coords in self.queries:
+            expected = self.brute_force(coords)[:5]
+            found = self.index.nearest(coords, k=5)
+            self.assertEqual([rank for _, rank in expected], [airport.rank for airport, _ in found])
+            for (km, _), (_, found_km) in zip(expected, found):
+                self.assertAlmostEqual(km, found_km, places=3)
+
+    def test_nearest_many_matches_nearest(self):
+        for coords, many in zip(self.queries, self.index.nearest_many(self.queries, k=3)):
+            self.assertEqual([airport.code for airport, _ in self.index.nearest(coords, k=3)],
+                             [airport.code for airport, _ in many])
+
+    def test_within_radius_matches_brute_force(self):
+        for coords in self.queries:
+            expected = [rank for km, rank in self.brute_force(coords) if km <= 1500]
+            self.assertEqual(expected, [airport.rank for airport, _ in self.index.within_radius(coords, 1500)])
+
+    def test_ties_go_to_the_busier_airport(self):
+        index = AirportIndex([Airport('BUSY', 10.0, 10.0, rank=0), Airport('QUIET', 10.0, 10.0, rank=1)])
+        self.assertEqual('BUSY', index.nearest((11.0, 11.0))[0][0].code)
+
+    def test_airport_by_code(self):
+        self.assertEqual(self.airports[7], self.index.airport('A7'))
+        self.assertIsNone(self.index.airport('NOPE'))
+
+    def test_empty(self):
+        self.assertEqual([], AirportIndex([]).nearest((0.0, 0.0), k=3))
+
+
+class TieredCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.cache = TieredCache()
+        self.computed = 0
+
+    def compute(self):
+        self.computed += 1
+        return self.computed
+
+    def test_get_or_set(self):
+        self.assertIs(MISSING, self.cache.get('ns', 'key'))
+        self.assertEqual(1, self.cache.get_or_set('ns', 'key', self.compute))
+        self.assertEqual(1, self.cache.get_or_set('ns', 'key', self.compute))
+        self.assertEqual(1, self.computed)
+        self.assertEqual({'ns': {'hits': 1, 'misses': 2}}, self.cache.stats.to_dict())
+
+    def test_expiry(self):
+        self.cache.set('ns', 'key', 'value', ttl=-1)
+        self.assertIs(MISSING, self.cache.get('ns', 'key'))
+
+    def test_get_or_refresh_serves_fresh_entries_as_is(self):
+        for _ in range(3):
+            self.assertEqual(1, self.cache.get_or_refresh('ns', 'key', self.compute, 60, 60, InlineExecutor()))
+        self.assertEqual(1, self.computed)
+
+    def test_get_or_refresh_serves_stale_entries_while_refreshing(self):
+        self.assertEqual(1, self.cache.get_or_refresh('ns', 'key', self.compute, 0, 60, InlineExecutor()))
+        self.assertFalse(TieredCache.is_fresh(self.cache.get('ns', 'key')))
+        # the stale value goes back, the refresh (inline here) replaces it for next time
+        self.assertEqual(1, self.cache.get_or_refresh('ns', 'key', self.compute, 0, 60, InlineExecutor()))
+        self.assertEqual(2, self.cache.get_or_refresh('ns', 'key', self.compute, 0, 60, InlineExecutor()))
+
+    def test_refreshes_use_refresh_and_the_bulk_lane(self):
+        lanes = []
+
+        def refresh():
+            lanes.append(current_lane())
+            return 'refreshed'
+
+        self.cache.get_or_refresh('ns', 'key', self.compute, 0, 60, InlineExecutor(), refresh=refresh)
+        self.cache.get_or_refresh('ns', 'key', self.compute, 0, 60, InlineExecutor(), refresh=refresh)
+        self.assertEqual('refreshed', self.cache.get('ns', 'key')['value'])
+        self.assertEqual([BULK], lanes)
+        self.assertEqual(1, self.computed)
+
+    def test_failed_refresh_keeps_the_stale_value(self):
+        def fail():
+            raise ValueError('upstream down')
+
+        self.cache.get_or_refresh('ns', 'key', self.compute, 0, 60, InlineExecutor())
+        with self.assertLogs('rest_api.cache', 'WARNING'):
+            self.assertEqual(1, self.cache.get_or_refresh('ns', 'key', fail, 0, 60, InlineExecutor()))
+        self.assertEqual(1, self.cache.get('ns', 'key')['value'])
+
+
+class SingleFlightTest(SimpleTestCase):
+    def test_concurrent_calls_share_one_result(self):
+        single_flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'value'
+
+        leader = threading.Thread(target=lambda: results.append(single_flight.do('key', slow)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(single_flight.do('key', slow))) for _ in range(4)]
+        for follower in followers:
+            follower.start()
+        # give the followers time to find the leader's call
+        time.sleep(0.05)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+        self.assertEqual(['value'] * 5, results)
+        self.assertEqual(1, len(calls))
+
+    def test_errors_are_shared_and_not_kept(self):
+        single_flight = SingleFlight()
+
+        def fail():
+            raise ValueError('nope')
+
+        with self.assertRaises(ValueError):
+            single_flight.do('key', fail)
+        self.assertEqual('value', single_flight.do('key', lambda: 'value'))
+
+
+class RateLimiterTest(SimpleTestCase):
+    def setUp(self):
+        # 10 tokens that barely refill, and no waiting so running out raises straight away
+        self.limiter = RateLimiter(MemoryBuckets(), budgets={'skyscanner': (0.001, 10)}, max_wait_seconds=0)
+
+    def acquire(self, n, lane_name):
+        with lane(lane_name):
+            for _ in range(n):
+                self.limiter.acquire(SKYSCANNER_URL)
+
+    def test_bulk_leaves_a_reserve_for_interactive(self):
+        self.acquire(8, BULK)
+        with self.assertRaises(RateLimitExceeded):
+            self.acquire(1, BULK)
+        self.acquire(2, INTERACTIVE)
+        with self.assertRaises(RateLimitExceeded):
+            self.acquire(1, INTERACTIVE)
+
+    def test_interactive_can_use_the_whole_bucket(self):
+        self.acquire(10, INTERACTIVE)
+        with self.assertRaises(RateLimitExceeded):
+            self.acquire(1, INTERACTIVE)
+
+    def test_bulk_fits_in_a_bucket_of_one(self):
+        # what FLYORDRIVE_RATE_LIMITS=eia=1 means
+        limiter = RateLimiter(MemoryBuckets(), budgets=parse_budgets('eia=1'), max_wait_seconds=0)
+        with lane(BULK):
+            limiter.acquire(EIA_URL)
+
+    def test_bulk_requests_bigger_than_the_bucket(self):
+        limiter = RateLimiter(MemoryBuckets(), budgets={'distance_matrix': (0.001, 10)}, max_wait_seconds=0)
+        with lane(BULK):
+            limiter.acquire(DISTANCE_MATRIX_URL + '?origins=a|b|c|d&destinations=e|f|g|h')
+
+    def test_async_takes_off_the_event_loop(self):
+        buckets = MemoryBuckets()
+        take, threads = buckets.take, []
+
+        def recording_take(*args):
+            threads.append(threading.get_ident())
+            return take(*args)
+
+        buckets.take = recording_take
+        limiter = RateLimiter(buckets, budgets={'skyscanner': (0.001, 1)}, max_wait_seconds=0)
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(limiter.acquire_async(SKYSCANNER_URL))
+            with self.assertRaises(RateLimitExceeded):
+                loop.run_until_complete(limiter.acquire_async(SKYSCANNER_URL))
+        finally:
+            loop.close()
+        self.assertEqual(2, len(threads))
+        self.assertNotIn(threading.get_ident(), threads)
+
+    def test_unlimited_hosts(self):
+        for _ in range(100):
+            self.limiter.acquire('https://example.com/')
+
+    def test_throttled_drains_the_bucket(self):
+        with self.assertLogs('rest_api.rate_limit', 'WARNING'):
+            self.limiter.throttled(SKYSCANNER_URL)
+        with self.assertRaises(RateLimitExceeded):
+            self.acquire(1, INTERACTIVE)
+
+    def test_unknown_lane(self):
+        with self.assertRaises(ValueError):
+            with lane('fast'):
+                pass
+
+
+class FakeDistanceMatrix:
+    """
+    Routes between made up places, none to or from anywhere called 'Island'
+    """
+
+    def __init__(self):
+        self.requests = []
+
+    def route(self, origin, destination):
+        if 'Island' in (origin, destination):
+            return None
+        return 1000 * len(origin + destination), 60
+
+    def get_driving_route(self, origin, destination):
+        self.requests.append(([origin], [destination]))
+        return self.route(origin, destination)
+
+    def get_driving_routes(self, origins, destinations):
+        self.requests.append((origins, destinations))
+        return [[self.route(o, d) for d in destinations] for o in origins]
+
+
+class AsyncFakeDistanceMatrix(FakeDistanceMatrix):
+    async def get_driving_routes(self, origins, destinations):
+        return super().get_driving_routes(origins, destinations)
+
+
+class CachedDistanceMatrixTest(SimpleTestCase):
+    def setUp(self):
+        self.upstream = FakeDistanceMatrix()
+        self.gdm = CachedGoogleDistanceMatrixGateway(self.upstream, TieredCache())
+
+    def test_matrix_fetched_once(self):
+        expected = [[(2000, 60), (3000, 60)], [(3000, 60), (4000, 60)]]
+        self.assertEqual(expected, self.gdm.get_driving_routes(['A', 'BB'], ['C', 'DD']))
+        self.assertEqual(expected, self.gdm.get_driving_routes(['a', ' BB '], ['C', 'dd']))
+        self.assertEqual([(['A', 'BB'], ['C', 'DD'])], self.upstream.requests)
+
+    def test_only_the_holes_are_fetched(self):
+        self.gdm.get_driving_route('A', 'C')
+        self.gdm.get_driving_routes(['A', 'BB'], ['C'])
+        self.gdm.get_driving_routes(['A', 'BB'], ['C', 'DD'])
+        self.assertEqual([(['A'], ['C']), (['BB'], ['C']), (['A', 'BB'], ['DD'])], self.upstream.requests)
+        # single routes come out of the matrix's cache too
+        self.assertEqual((4000, 60), self.gdm.get_driving_route('BB', 'DD'))
+        self.assertEqual(3, len(self.upstream.requests))
+
+    def test_no_route_isnt_cached(self):
+        self.assertEqual([[(2000, 60), None]], self.gdm.get_driving_routes(['A'], ['C', 'Island']))
+        self.assertEqual([[(2000, 60), None]], self.gdm.get_driving_routes(['A'], ['C', 'Island']))
+        self.assertEqual([(['A'], ['C', 'Island']), (['A'], ['Island'])], self.upstream.requests)
+
+    def test_async_matrix(self):
+        upstream = AsyncFakeDistanceMatrix()
+        gdm = AsyncCachedGoogleDistanceMatrixGateway(upstream, TieredCache())
+        loop = asyncio.new_event_loop()
+        try:
+            for _ in range(2):
+                routes = loop.run_until_complete(gdm.get_driving_routes(['A', 'BB'], ['C']))
+                self.assertEqual([[(2000, 60)], [(3000, 60)]], routes)
+        finally:
+            loop.close()
+        self.assertEqual([(['A', 'BB'], ['C'])], upstream.requests)
+
+
+class FakeGoogle:
+    def __init__(self):
+        self.calls = 0
+
+    def get_driving_route(self, origin, destination):
+        self.calls += 1
+        return 1000 * len(origin + destination), 60
+
+
+class ReplayGatewayTest(SimpleTestCase):
+    def setUp(self):
+        self.fixtures_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for root, _, files in os.walk(self.fixtures_dir, topdown=False):
+            for name in files:
+                os.remove(os.path.join(root, name))
+            os.rmdir(root)
+
+    def test_replays_what_was_recorded(self):
+        live = FakeGoogle()
+        recorder = ReplayGateway('google', live, fixtures_dir=self.fixtures_dir)
+        self.assertEqual((21000, 60), recorder.get_driving_route('Chicago, IL', 'Boston, MA'))
+
+        replayer = ReplayGateway('google', fixtures_dir=self.fixtures_dir)
+        # through json, so the tuple comes back a list
+        self.assertEqual([21000, 60], replayer.get_driving_route('Chicago, IL', 'Boston, MA'))
+        self.assertEqual(1, live.calls)
+        with self.assertRaises(FixtureNotFound):
+            replayer.get_driving_route('Boston, MA', 'Chicago, IL')
+
+    def test_backends_record_then_replay(self):
+        live = FakeGoogle()
+        settings = {'FLYORDRIVE_FIXTURES_DIR': self.fixtures_dir, 'FLYORDRIVE_GATEWAY_LATENCY_MS': '0'}
+        with mock.patch.dict(os.environ, settings, FLYORDRIVE_GATEWAY_MODE='record'):
+            build_gateway('google', lambda: live).get_driving_route('A', 'B')
+            with self.assertRaises(ValueError):
+                build_async_gateway('google', FakeGoogle)
+        with mock.patch.dict(os.environ, settings, FLYORDRIVE_GATEWAY_MODE='replay'):
+            self.assertEqual([2000, 60], build_gateway('google', FakeGoogle).get_driving_route('A', 'B'))
+            gateway = build_async_gateway('google', FakeGoogle)
+            loop = asyncio.new_event_loop()
+            try:
+                self.assertEqual([2000, 60], loop.run_until_complete(gateway.get_driving_route('A', 'B')))
+            finally:
+                loop.close()
+        self.assertEqual(1, live.calls)
+
+    def test_delayed_gateway(self):
+        self.assertFalse(InjectedLatency())
+        gateway = DelayedGateway(FakeGoogle(), InjectedLatency(0.05))
+        start = time.monotonic()
+        self.assertEqual((2000, 60), gateway.get_driving_route('A', 'B'))
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+
+class CircuitBreakerTest(SimpleTestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker('test', failures_to_open=3, open_seconds=60)
+
+    def fail(self, n, error=None):
+        for _ in range(n):
+            self.breaker.before_call()
+            self.breaker.record(error or ConnectionError('down'))
+
+    def test_opens_after_failures_in_a_row(self):
+        self.fail(2)
+        self.breaker.before_call()
+        self.breaker.record(None)
+        self.fail(2)
+        self.assertEqual(CircuitBreaker.CLOSED, self.breaker.state)
+        with self.assertLogs('rest_api.resilience', 'WARNING'):
+            self.fail(1)
+        self.assertEqual(CircuitBreaker.OPEN, self.breaker.state)
+        with self.assertRaises(CircuitOpen):
+            self.breaker.before_call()
+
+    def test_half_open_lets_one_trial_through(self):
+        with self.assertLogs('rest_api.resilience', 'WARNING'):
+            self.fail(3)
+        self.breaker.open_seconds = 0
+        self.breaker.before_call()
+        self.assertEqual(CircuitBreaker.HALF_OPEN, self.breaker.state)
+        with self.assertRaises(CircuitOpen):
+            self.breaker.before_call()
+        with self.assertLogs('rest_api.resilience', 'WARNING'):
+            self.breaker.record(None)
+        self.assertEqual(CircuitBreaker.CLOSED, self.breaker.state)
+        self.assertEqual(0, self.breaker.failures)
+
+    def test_failed_trial_opens_again(self):
+        with self.assertLogs('rest_api.resilience', 'WARNING'):
+            self.fail(3)
+        self.breaker.open_seconds = 0
+        self.breaker.before_call()
+        self.breaker.record(ConnectionError('still down'))
+        self.assertEqual(CircuitBreaker.OPEN, self.breaker.state)
+
+    def test_request_errors_dont_count(self):
+        self.fail(2)
+        for error in (LookupError('no such place'), RateLimitExceeded('busy'), DeadlineExceeded('out of time')):
+            self.fail(5, error)
+        self.assertEqual(CircuitBreaker.CLOSED, self.breaker.state)
+        self.assertEqual(2, self.breaker.failures)
+
+    def test_request_errors_leave_half_open_alone(self):
+        with self.assertLogs('rest_api.resilience', 'WARNING'):
+            self.fail(3)
+        self.breaker.open_seconds = 0
+        self.fail(1, RateLimitExceeded('busy'))
+        self.assertEqual(CircuitBreaker.HALF_OPEN, self.breaker.state)
+        # and the next call gets to be the trial
+        self.breaker.before_call()
+
+    def test_upstream_timeouts_count(self):
+        with self.assertLogs('rest_api.resilience', 'WARNING'):
+            self.fail(3, UpstreamTimeout('too slow'))
+        self.assertEqual(CircuitBreaker.OPEN, self.breaker.state)
+
+    def test_abandoned_trial(self):
+        with self.assertLogs('rest_api.resilience', 'WARNING'):
+            self.fail(3)
+        self.breaker.open_seconds = 0
+        self.breaker.before_call()
+        self.breaker.abandon()
+        self.breaker.before_call()
+
+
+class SlowFirstCall:
+    """
+    Stands in for an upstream where the first request gets stuck and any retry answers straight away
+    """
+
+    def __init__(self, stuck_seconds=0.5):
+        self.stuck_seconds = stuck_seconds
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def next_call(self):
+        with self.lock:
+            self.calls += 1
+            return self.calls
+
+    def get_lat_lng(self, place):
+        if self.next_call() == 1:
+            time.sleep(self.stuck_seconds)
+            return 'first'
+        return 'hedge'
+
+
+class AsyncSlowFirstCall(SlowFirstCall):
+    async def get_lat_lng(self, place):
+        if self.next_call() == 1:
+            await asyncio.sleep(self.stuck_seconds)
+            return 'first'
+        return 'hedge'
+
+
+class HedgingTest(SimpleTestCase):
+    def gateway(self, cls=ResilientGateway, upstream=None):
+        gateway = cls('test', upstream or SlowFirstCall(), CircuitBreaker('test'))
+        # calls usually take 10ms
+        for _ in range(20):
+            gateway.latency('get_lat_lng').observe(0.01)
+        return gateway
+
+    def test_hedge_delay_from_the_p95(self):
+        tracker = LatencyTracker()
+        for i in range(19):
+            tracker.observe(i / 100)
+        self.assertIsNone(tracker.hedge_delay())
+        tracker.observe(0.19)
+        self.assertAlmostEqual(0.18, tracker.hedge_delay())
+        tracker = LatencyTracker()
+        for _ in range(20):
+            tracker.observe(0.001)
+        self.assertEqual(MIN_HEDGE_DELAY_SECONDS, tracker.hedge_delay())
+
+    def test_hedges_are_rationed(self):
+        tracker = LatencyTracker()
+        for _ in range(20):
+            tracker.observe(0.01)
+        self.assertIsNotNone(tracker.hedge_delay())
+        tracker.hedging()
+        # one hedge in two calls is well over HEDGE_RATIO
+        self.assertIsNone(tracker.hedge_delay())
+
+    def test_slow_call_is_hedged(self):
+        gateway = self.gateway()
+        start = time.monotonic()
+        self.assertEqual('hedge', gateway.get_lat_lng('Chicago, IL'))
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertEqual(1, gateway.latency('get_lat_lng').hedged)
+
+    def test_background_calls_arent_hedged(self):
+        gateway = self.gateway(upstream=SlowFirstCall(0.05))
+        with lane(BULK):
+            self.assertEqual('first', gateway.get_lat_lng('Chicago, IL'))
+        self.assertEqual(0, gateway.latency('get_lat_lng').hedged)
+
+    def test_slow_async_call_is_hedged(self):
+        gateway = self.gateway(AsyncResilientGateway, AsyncSlowFirstCall())
+        loop = asyncio.new_event_loop()
+        try:
+            start = time.monotonic()
+            self.assertEqual('hedge', loop.run_until_complete(gateway.get_lat_lng('Chicago, IL')))
+            self.assertLess(time.monotonic() - start, 0.4)
+        finally:
+            loop.close()
+        self.assertEqual(1, gateway.latency('get_lat_lng').hedged)
+
+
+class DomainTest(SimpleTestCase):
+    def skeleton(self):
+        stops = (OvernightStop(1.0, 2.0, 80), OvernightStop(3.0, 4.0, 90))
+        drives = DrivingInfo(100, 3600, 170, 20, overnight_stops=stops)
+        return TripSkeleton((41.9, -87.6), (40.7, -74.0), (1200000, 43200),
+                            FlyingTripInfo(FlightInfo(120, 150), drives), False,
+                            (Airport('ORD', 41.97, -87.9), Airport('JFK', 40.64, -73.78)))
+
+    def test_reversed(self):
+        skeleton = self.skeleton()
+        back = skeleton.reversed(FlightInfo(125, 180))
+        self.assertEqual(skeleton.destination_coords, back.origin_coords)
+        self.assertEqual(skeleton.origin_coords, back.destination_coords)
+        self.assertEqual(skeleton.driving_route, back.driving_route)
+        self.assertEqual(['JFK', 'ORD'], [airport.code for airport in back.airports])
+        self.assertEqual(FlightInfo(125, 180), back.flying_info.flight_info)
+        self.assertEqual(tuple(reversed(skeleton.flying_info.driving_info.overnight_stops)),
+                         back.flying_info.driving_info.overnight_stops)
+        self.assertEqual(skeleton, back.reversed(skeleton.flying_info.flight_info))
+
+    def test_reversed_without_flying(self):
+        skeleton = TripSkeleton((41.9, -87.6), (42.0, -87.0), (50000, 1800), None)
+        back = skeleton.reversed(None)
+        self.assertIsNone(back.flying_info)
+        self.assertIsNone(back.airports)
+
+    def test_dict_round_trip(self):
+        skeleton = self.skeleton()
+        self.assertEqual(skeleton, TripSkeleton.from_dict(json.loads(json.dumps(skeleton.to_dict()))))
+
+    def test_to_json_is_text(self):
+        info = self.skeleton().flying_info
+        self.assertIsInstance(info.to_json(), str)
+        self.assertEqual(info.to_dict(), json.loads(info.to_json()))
+
+    def test_copy_and_pickle(self):
+        skeleton = self.skeleton()
+        self.assertFalse(hasattr(skeleton, '__dict__'))
+        self.assertEqual(skeleton, copy.copy(skeleton))
+        self.assertEqual(skeleton, copy.deepcopy(skeleton))
+        self.assertEqual(skeleton, pickle.loads(pickle.dumps(skeleton)))
+
+
+class FareEstimatorTest(SimpleTestCase):
+    MONTH = '2024-09'
+
+    def setUp(self):
+        self.ord = Airport('ORD', 41.97, -87.9)
+        self.jfk = Airport('JFK', 40.64, -73.78)
+        self.fares = FareEstimator(FareHistory(':memory:'), AirportIndex([self.ord, self.jfk]))
+
+    def test_distance_when_nothing_is_known(self):
+        km = float(haversine_km(*self.ord.coords(), *self.jfk.coords()))
+        expected = FareEstimator.DEFAULT_BASE_FARE + FareEstimator.DEFAULT_FARE_PER_KM * km
+        self.assertAlmostEqual(expected, self.fares.estimate(self.ord, self.jfk, self.MONTH))
+
+    def test_never_below_the_floor(self):
+        self.fares.history.add('ORD', 'JFK', self.MONTH, [5, 10])
+        self.assertEqual(MIN_FARE, self.fares.estimate(self.ord, self.jfk, self.MONTH))
+
+    def test_route_fares_for_the_month(self):
+        self.fares.observe('ORD', 'JFK', self.MONTH, [200, 300, None])
+        self.fares.observe('ORD', 'JFK', '2024-12', [900])
+        self.assertAlmostEqual(250, self.fares.estimate(self.ord, self.jfk, self.MONTH))
+
+    def test_route_fares_the_other_way(self):
+        self.fares.observe('JFK', 'ORD', self.MONTH, [220])
+        self.assertAlmostEqual(220, self.fares.estimate(self.ord, self.jfk, self.MONTH))
+        self.assertIsNone(self.fares.recent(self.ord, self.jfk, self.MONTH))
+
+    def test_own_fares_count_more_than_the_way_back(self):
+        self.fares.observe('ORD', 'JFK', '2024-12', [300])
+        self.fares.observe('JFK', 'ORD', self.MONTH, [100])
+        self.fares.fit()
+        own = 300 * self.fares.season_factor(self.MONTH) / self.fares.season_factor('2024-12')
+        weight = FareEstimator.REVERSE_WEIGHT
+        self.assertAlmostEqual((own + weight * 100) / (1 + weight), self.fares.estimate(self.ord, self.jfk, self.MONTH))
+
+    def test_own_fares_for_the_month_over_the_way_back(self):
+        self.fares.observe('ORD', 'JFK', self.MONTH, [300])
+        self.fares.observe('JFK', 'ORD', self.MONTH, [100])
+        self.assertAlmostEqual(300, self.fares.estimate(self.ord, self.jfk, self.MONTH))
+
+    def test_route_fares_for_other_months(self):
+        # other routes run cheap in September and dear in December
+        for origin in ('ATL', 'DEN', 'SEA'):
+            self.fares.observe(origin, 'LAX', self.MONTH, [100] * 40)
+            self.fares.observe(origin, 'LAX', '2024-12', [300] * 40)
+        self.fares.observe('ORD', 'JFK', '2024-12', [300])
+        self.fares.fit()
+        september, december = self.fares.season_factor(self.MONTH), self.fares.season_factor('2024-12')
+        self.assertLess(september, 1)
+        self.assertGreater(december, 1)
+        self.assertAlmostEqual(300 * september / december, self.fares.estimate(self.ord, self.jfk, self.MONTH))
+
+    def test_recent(self):
+        self.assertIsNone(self.fares.recent(self.ord, self.jfk, self.MONTH))
+        self.fares.observe('ORD', 'JFK', self.MONTH, [200, 300])
+        self.assertAlmostEqual(250, self.fares.recent(self.ord, self.jfk, self.MONTH))
+        self.assertIsNone(self.fares.recent(self.ord, self.jfk, '2024-12'))
+
+    def test_old_fares_arent_recent(self):
+        self.fares.history.add('ORD', 'JFK', self.MONTH, [200], now=time.time() - 7 * 24 * 60 * 60)
+        self.assertIsNone(self.fares.recent(self.ord, self.jfk, self.MONTH))
+
+
+class RoadEstimatorTest(SimpleTestCase):
+    CHICAGO = (41.88, -87.63)
+    WAUKEGAN = (42.36, -87.84)
+
+    def setUp(self):
+        self.km = float(haversine_km(*self.CHICAGO, *self.WAUKEGAN))
+
+    def observe(self, estimator, samples, detour=1.2, speed_kmh=60):
+        road_km = self.km * detour
+        for _ in range(samples):
+            estimator.observe(self.CHICAGO, self.WAUKEGAN, (road_km * 1000, road_km / speed_kmh * 3600))
+
+    def assert_route(self, expected, route):
+        self.assertAlmostEqual(expected[0], route[0], delta=1)
+        self.assertAlmostEqual(expected[1], route[1], delta=1)
+
+    def test_priors_only_as_a_last_resort(self):
+        estimator = RoadEstimator()
+        self.assertIsNone(estimator.estimate(self.CHICAGO, self.WAUKEGAN))
+        road_km = self.km * RoadEstimator.DEFAULT_DETOUR_FACTOR
+        speed_kmh = RoadEstimator.DEFAULT_SPEEDS_KMH[1]
+        self.assert_route((road_km * 1000, road_km / speed_kmh * 3600),
+                          estimator.estimate(self.CHICAGO, self.WAUKEGAN, require_calibration=False))
+
+    def test_learns_the_region_and_band(self):
+        estimator = RoadEstimator()
+        self.observe(estimator, RoadEstimator.MIN_SAMPLES - 1)
+        self.assertIsNone(estimator.estimate(self.CHICAGO, self.WAUKEGAN))
+        self.observe(estimator, 1)
+        road_km = self.km * 1.2
+        self.assert_route((road_km * 1000, road_km / 60 * 3600), estimator.estimate(self.CHICAGO, self.WAUKEGAN))
+        # a short hop is a different band, still unlearned
+        self.assertIsNone(estimator.estimate(self.CHICAGO, (41.9, -87.7)))
+
+    def test_ignores_routes_it_cant_learn_from(self):
+        estimator = RoadEstimator()
+        estimator.observe(self.CHICAGO, self.WAUKEGAN, None)
+        estimator.observe(self.CHICAGO, self.WAUKEGAN, (1000, 0))
+        estimator.observe(self.CHICAGO, (41.8801, -87.6301), (500, 60))
+        self.assertEqual({}, estimator.stats)
+
+    def test_calibration_survives_a_restart(self):
+        cache = TieredCache()
+        self.observe(RoadEstimator(cache), RoadEstimator.SAVE_EVERY)
+        self.assertIsNotNone(RoadEstimator(cache).estimate(self.CHICAGO, self.WAUKEGAN))
+
+
+class RoutePlannerTest(SimpleTestCase):
+    HOUR = 60 * 60
+
+    def test_day_leg_ends(self):
+        self.assertEqual([], day_leg_ends(6 * self.HOUR, 8 * 60))
+        self.assertEqual([0.8], day_leg_ends(10 * self.HOUR, 8 * 60))
+        self.assertEqual([0.4, 0.8], day_leg_ends(20 * self.HOUR, 8 * 60))
+
+    def test_pushes_on_through_the_final_stretch(self):
+        self.assertEqual([], day_leg_ends(8 * self.HOUR + FINAL_STRETCH_MINUTES * 60, 8 * 60))
+        self.assertEqual(1, len(day_leg_ends(8 * self.HOUR + FINAL_STRETCH_MINUTES * 60 + 1, 8 * 60)))
+
+    def test_day_leg_ends_needs_some_driving(self):
+        with self.assertRaises(ValueError):
+            day_leg_ends(10 * self.HOUR, 0)
+
+    def test_overnight_points_along_the_way(self):
+        points = overnight_points((0.0, 0.0), (0.0, 10.0), 20 * self.HOUR, 8 * 60)
+        self.assertEqual(2, len(points))
+        for (lat, lng), expected_lng in zip(points, (4.0, 8.0)):
+            self.assertAlmostEqual(0, lat)
+            self.assertAlmostEqual(expected_lng, lng)
+
+    def test_hotels_priced_per_night(self):
+        calculator = TripCalculatorBase()
+        stops = calculator._overnight_stops([(1.0, 2.0), (3.0, 4.0)], [120, None])
+        self.assertEqual([120, TripCalculatorBase.DEFAULT_HOTEL_NIGHTLY], [stop.nightly_price for stop in stops])
+        route = (1600000, 20 * self.HOUR)
+        priced = calculator._price_drive(route, 8 * 60, 20, 3.0, overnight_stops=stops)
+        self.assertEqual(120 + TripCalculatorBase.DEFAULT_HOTEL_NIGHTLY, priced.hotel_total_price)
+        self.assertEqual(stops, priced.overnight_stops)
+        # without stops every night is at the default
+        priced = calculator._price_drive(route, 8 * 60, 20, 3.0)
+        self.assertEqual(2 * TripCalculatorBase.DEFAULT_HOTEL_NIGHTLY, priced.hotel_total_price)
+
+
+class AirportPairSearchTest(SimpleTestCase):
+    # an hour's flight costs this much on top of the fare
+    HOUR_COST = TripCalculatorBase.VALUE_OF_TIME_PER_HOUR
+
+    def setUp(self):
+        self.calculator = TripCalculatorBase()
+        self.ports = [Airport(code, lat, lng, rank) for rank, (code, lat, lng) in enumerate(
+            [('ORD', 41.97, -87.9), ('MDW', 41.79, -87.75), ('JFK', 40.64, -73.78), ('LGA', 40.78, -73.87)])]
+        self.drive = DrivingInfo(10, 1800, 0, 5)
+
+    def pairs(self, *bounds):
+        return [(bound, (self.ports[0], self.drive), (self.ports[2], self.drive), 60) for bound in bounds]
+
+    def flight(self, cost):
+        # costs `cost` all told, with the drives at either end
+        return FlightInfo(60, cost - self.HOUR_COST - 2 * self.calculator._generalized_cost(self.drive))
+
+    def test_cheapest_bound_alone_first(self):
+        search = AirportPairSearch(self.calculator, self.pairs(100, 200, 300))
+        batch = search.next_batch()
+        self.assertEqual([100], [pair[0] for pair in batch])
+        search.add_quotes(batch, [self.flight(150)])
+        # nothing left can beat it
+        self.assertEqual([], search.next_batch())
+        self.assertEqual((1, 150), (search.quoted, search.best_cost))
+
+    def test_rest_at_once_up_to_the_limit(self):
+        search = AirportPairSearch(self.calculator, self.pairs(100, 200, 300, 400))
+        search.add_quotes(search.next_batch(), [self.flight(1000)])
+        batch = search.next_batch()
+        # MAX_FLIGHT_QUOTES in all
+        self.assertEqual([200, 300], [pair[0] for pair in batch])
+        search.add_quotes(batch, [self.flight(500), None])
+        self.assertEqual([], search.next_batch())
+        self.assertAlmostEqual(500, search.best_cost)
+        self.assertEqual(self.flight(500), search.best[2])
+
+    def test_nothing_quoted(self):
+        search = AirportPairSearch(self.calculator, self.pairs(100, 200))
+        search.add_quotes(search.next_batch(), [None])
+        search.add_quotes(search.next_batch(), [None])
+        self.assertIsNone(search.best)
+        self.assertEqual([], search.next_batch())
+
+    def test_pairs_by_bound(self):
+        origin_legs = [(self.ports[0], self.drive), (self.ports[1], self.drive)]
+        destination_legs = [(self.ports[2], self.drive), (self.ports[3], self.drive)]
+
+        def cached(origin, destination):
+            # the closest airports are dear
+            return FlightInfo(120, 900) if (origin.code, destination.code) == ('ORD', 'JFK') else None
+
+        pairs = self.calculator._airport_pairs(origin_legs, destination_legs, cached)
+        self.assertEqual(4, len(pairs))
+        self.assertEqual(sorted(pair[0] for pair in pairs), [pair[0] for pair in pairs])
+        self.assertEqual(('ORD', 'JFK'), (pairs[-1][1][0].code, pairs[-1][2][0].code))
+        # unquoted pairs are bounded by the cheapest fare there could be
+        minutes = pairs[0][3]
+        self.assertAlmostEqual(2 * self.calculator._generalized_cost(self.drive)
+                               + self.calculator._flight_cost(FlightInfo(minutes, MIN_FARE)), pairs[0][0])
+        self.assertEqual([], self.calculator._airport_pairs([], destination_legs, cached))
+
+
+class JobStoreTest(SimpleTestCase):
+    def setUp(self):
+        self.store = JobStore(':memory:')
+
+    def age(self, job_id, seconds):
+        with self.store.lock:
+            self.store.con.execute('UPDATE job SET updated_at = updated_at - ? WHERE id = ?;', (seconds, job_id))
+
+    def test_lifecycle(self):
+        job_id = self.store.create('trip', {'origin': 'A', 'destination': 'B'})
+        self.assertEqual(QUEUED, self.store.get(job_id)['status'])
+        self.store.start(job_id)
+        self.store.add_partial(job_id, 'driving', {'total_price': 1})
+        self.assertEqual({'driving': {'total_price': 1}}, self.store.get(job_id)['partial'])
+        self.store.finish(job_id, {'done': True})
+        job = self.store.get(job_id)
+        self.assertEqual((DONE, {'done': True}), (job['status'], job['result']))
+        self.assertEqual([('trip', {'origin': 'A', 'destination': 'B'})], self.store.recent_requests(0))
+
+    def test_only_running_jobs_stall(self):
+        queued = self.store.create('trip', {})
+        running = self.store.create('trip', {})
+        self.store.start(running)
+        self.age(queued, JobStore.STALLED_SECONDS + 1)
+        self.age(running, JobStore.STALLED_SECONDS + 1)
+        self.assertEqual(QUEUED, self.store.get(queued)['status'])
+        self.assertEqual(FAILED, self.store.get(running)['status'])
+
+    def test_unknown_job(self):
+        self.assertIsNone(self.store.get('nope'))
+
+
+class ApiTest(SimpleTestCase):
+    """
+    The endpoints against the stub gateways
+    """
+
+    def post(self, url, body):
+        return self.client.post(url, json.dumps(body), content_type='application/json')
+
+    def assert_trip(self, trip):
+        self.assertGreater(trip['driving']['total_price'], 0)
+        self.assertGreater(trip['flying']['total_info']['total_price'], 0)
+        self.assertGreater(trip['flying']['flying_info']['estimated_price'], 0)
+
+    def test_calculate(self):
+        response = self.post('/api/calculate', {'origin': 'Chicago, IL', 'destination': 'New York, NY'})
+        self.assertEqual(200, response.status_code)
+        self.assert_trip(response.json())
+
+    def test_calculate_async(self):
+        response = self.post('/api/async/calculate', {'origin': 'Seattle, WA', 'destination': 'Denver, CO'})
+        self.assertEqual(200, response.status_code)
+        self.assert_trip(response.json())
+
+    def test_matrix(self):
+        response = self.post('/api/calculate/matrix', {'origins': ['Chicago, IL', 'Boston, MA'],
+                                                       'destinations': ['Miami, FL', 'Austin, TX', 'Boston, MA']})
+        self.assertEqual(200, response.status_code)
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(['Chicago, IL', 'Boston, MA'], [row['origin'] for row in rows])
+        for row in rows:
+            self.assertEqual(['Miami, FL', 'Austin, TX', 'Boston, MA'], [trip['destination'] for trip in row['trips']])
+        self.assert_trip(rows[0]['trips'][0])
+
+    def test_columnar_matrix(self):
+        response = self.post('/api/calculate/matrix', {'origins': ['Chicago, IL'], 'destinations': ['Miami, FL', 'Austin, TX'],
+                                                       'columnar': True})
+        row, = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(['Miami, FL', 'Austin, TX'], row['columns']['destinations'])
+        self.assertEqual(2, len(row['columns']['driving']['total_price']))
+        self.assertEqual(2, len(row['columns']['flying']['estimated_price']))
+
+    def test_itinerary(self):
+        response = self.post('/api/calculate/itinerary', {'stops': ['Chicago, IL', 'Denver, CO', 'Austin, TX'],
+                                                          'round_trip': True})
+        self.assertEqual(200, response.status_code)
+        itinerary = response.json()
+        self.assertEqual([('Chicago, IL', 'Denver, CO'), ('Denver, CO', 'Austin, TX'), ('Austin, TX', 'Chicago, IL')],
+                         [(leg['origin'], leg['destination']) for leg in itinerary['legs']])
+        self.assertAlmostEqual(sum(leg['driving']['total_price'] for leg in itinerary['legs']),
+                               itinerary['total']['driving']['total_price'])
+
+    def test_bad_requests(self):
+        self.assertEqual(400, self.post('/api/calculate/matrix', {'origins': []}).status_code)
+        self.assertEqual(400, self.post('/api/calculate/itinerary', {'stops': ['Chicago, IL']}).status_code)
+        self.assertEqual(400, self.post('/api/jobs', {'origin': 'Chicago, IL'}).status_code)
+        self.assertEqual(405, self.client.get('/api/calculate').status_code)
+
+    def poll(self, job_id, timeout=30):
+        give_up_at = time.monotonic() + timeout
+        while time.monotonic() < give_up_at:
+            job = self.client.get(f'/api/jobs/{job_id}').json()
+            if job['status'] in (DONE, FAILED):
+                return job
+            time.sleep(0.05)
+        self.fail(f'job {job_id} never finished')
+
+    def test_trip_job(self):
+        response = self.post('/api/jobs', {'origin': 'Chicago, IL', 'destination': 'Nashville, TN'})
+        self.assertEqual(202, response.status_code)
+        job_id = response.json()['id']
+        self.assertEqual(f'/api/jobs/{job_id}', response['Location'])
+        job = self.poll(job_id)
+        self.assertEqual((DONE, None), (job['status'], job['error']))
+        self.assert_trip(job['result'])
+        self.assertIn('driving', job['partial'])
+
+    def test_matrix_job(self):
+        job_id = self.post('/api/jobs', {'origins': ['Chicago, IL', 'Atlanta, GA'], 'destinations': ['Miami, FL']}).json()['id']
+        job = self.poll(job_id)
+        self.assertEqual(DONE, job['status'])
+        self.assertEqual(['Chicago, IL', 'Atlanta, GA'], [row['origin'] for row in job['result']])
+        self.assertEqual({'Chicago, IL', 'Atlanta, GA'}, set(job['partial']))
+
+    def test_itinerary_job(self):
+        job_id = self.post('/api/jobs', {'stops': ['Boston, MA', 'Chicago, IL']}).json()['id']
+        job = self.poll(job_id)
+        self.assertEqual(DONE, job['status'])
+        self.assertEqual(1, len(job['result']['legs']))
+        self.assertIn('leg_0', job['partial'])
+
+    def test_unknown_job(self):
+        self.assertEqual(404, self.client.get('/api/jobs/nope').status_code)
+
+    def test_metrics(self):
+        self.post('/api/calculate', {'origin': 'Chicago, IL', 'destination': 'New York, NY'})
+        response = self.client.get('/metrics')
+        self.assertEqual(200, response.status_code)
+        self.assertIn(b'flyordrive_', response.content)
+
+
+class AsyncTripCalculatorTest(SimpleTestCase):
+    def test_speculative_quote_is_wound_down(self):
+        service = AsyncTripCalculatorService()
+        calls = {'started': 0, 'finished': 0}
+
+        async def no_quotes(origin, destination):
+            calls['started'] += 1
+            try:
+                # the first, speculative quote is still out when the search is done
+                await asyncio.sleep(0.5 if calls['started'] == 1 else 0)
+                raise RuntimeError('SkyScanner is down')
+            finally:
+                calls['finished'] += 1
+
+        service.sky.get_flight_info = no_quotes
+        unretrieved = []
+        loop = asyncio.new_event_loop()
+        loop.set_exception_handler(lambda _, context: unretrieved.append(context))
+        try:
+            trip = loop.run_until_complete(service.calculate_trip('Seattle, WA', 'Denver, CO'))
+            finished = calls['finished']
+            gc.collect()
+        finally:
+            loop.close()
+        self.assertIsNotNone(trip['driving'])
+        self.assertEqual(calls['started'], finished)
+        self.assertEqual([], unretrieved)
+
+
+class WarmCacheTest(SimpleTestCase):
+    def write(self, text):
+        f = tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False)
+        self.addCleanup(os.remove, f.name)
+        with f:
+            f.write(text)
+        return f.name
+
+    def test_read_pairs(self):
+        path = self.write('# popular\nChicago, IL\tNew York, NY\n\nBoston, MA \t Miami, FL\n')
+        self.assertEqual([('Chicago, IL', 'New York, NY'), ('Boston, MA', 'Miami, FL')], read_pairs(path))
+        with self.assertRaises(CommandError):
+            read_pairs(self.write('Chicago, IL to New York, NY\n'))
+
+    def test_job_pairs(self):
+        requests = [
+            ('trip', {'origin': 'A', 'destination': 'B'}),
+            ('matrix', {'origins': ['A', 'B'], 'destinations': ['B', 'C']}),
+            ('itinerary', {'stops': ['A', 'B', 'C'], 'round_trip': True}),
+        ]
+        self.assertEqual([('A', 'B'), ('A', 'B'), ('A', 'C'), ('B', 'C'), ('A', 'B'), ('B', 'C'), ('C', 'A')],
+                         list(job_pairs(requests)))
+
+    def test_log_pairs(self):
+        path = self.write('2024-09-01 10:00:00,123 INFO rest_api.services calculating trip for A, X to B, Y\n'
+                          '2024-09-03 10:00:00,123 INFO rest_api.services calculating trip for C to D\n'
+                          'INFO calculating trip for E to F\n'
+                          '2024-09-03 10:00:01,000 INFO django.server "POST /api/calculate HTTP/1.1" 200\n')
+        since = time.mktime((2024, 9, 2, 0, 0, 0, 0, 0, -1))
+        self.assertEqual([('C', 'D'), ('E', 'F')], list(log_pairs(path, since)))
+
+    def test_warms_the_trips_both_ways(self):
+        path = self.write('Chicago, IL\tNew York, NY\n')
+        out = io.StringIO()
+        call_command('warm_cache', pairs=[path], both_ways=True, rate=0, stdout=out, stderr=io.StringIO())
+        self.assertIn('Warmed 2 of 2 trips', out.getvalue())
+
+    def test_nothing_to_warm(self):
+        with self.assertRaises(CommandError):
+            call_command('warm_cache', stdout=io.StringIO())
+
+
+class PopulateSqliteTest(SimpleTestCase):
+    def setUp(self):
+        self.populate = load_script('populate_sqlite')
+        self.dir = tempfile.TemporaryDirectory()
+        self.con = sqlite3.connect(':memory:', isolation_level=None)
+
+    def tearDown(self):
+        self.con.close()
+        self.dir.cleanup()
+
+    def airports_file(self, name, lines):
+        path = os.path.join(self.dir.name, name)
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return path
+
+    def ranks(self):
+        return self.con.execute('SELECT aita_code FROM airport ORDER BY popularity_rank;').fetchall()
+
+    def test_load(self):
+        path = self.airports_file('a.txt', ['ATL;33.64,-84.43', 'LAX;33.94,-118.41', 'not an airport', 'ATL;1,1',
+                                            'BAD;95,0'])
+        written, skipped = self.populate.load(self.con, [path], batch_size=1)
+        self.assertEqual((2, {path: 2}), (written, skipped))
+        self.assertEqual([('ATL',), ('LAX',)], self.ranks())
+
+    def test_full_load_ranks_unlisted_airports_last(self):
+        self.populate.load(self.con, [self.airports_file('all.txt', ['ABR;45.45,-98.42', 'ABI;32.41,-99.68',
+                                                                     'ATL;33.64,-84.43', 'ADK;51.88,-176.65'])])
+        self.con.execute("UPDATE airport SET place_name = 'Aberdeen' WHERE aita_code = 'ABR';")
+        self.populate.load(self.con, [self.airports_file('major.txt', ['ATL;33.64,-84.43', 'LAX;33.94,-118.41'])])
+        self.assertEqual([('ATL',), ('LAX',), ('ABR',), ('ABI',), ('ADK',)], self.ranks())
+        ranks = [rank for rank, in self.con.execute('SELECT popularity_rank FROM airport;')]
+        self.assertEqual(len(ranks), len(set(ranks)))
+        self.assertEqual('Aberdeen', self.con.execute("SELECT place_name FROM airport WHERE aita_code = 'ABR';").fetchone()[0])
+
+    def test_append_ranks_new_airports_last(self):
+        self.populate.load(self.con, [self.airports_file('major.txt', ['ATL;33.64,-84.43', 'LAX;33.94,-118.41'])])
+        self.populate.load(self.con, [self.airports_file('more.txt', ['ABR;45.45,-98.42', 'ATL;33.64,-84.43'])],
+                           append=True)
+        self.assertEqual([('ATL',), ('LAX',), ('ABR',)], self.ranks())
+
+    def test_moved_airports_are_looked_up_again(self):
+        self.populate.load(self.con, [self.airports_file('a.txt', ['ATL;33.64,-84.43'])])
+        self.con.execute("UPDATE airport SET place_name = 'Atlanta';")
+        self.populate.load(self.con, [self.airports_file('b.txt', ['ATL;33.65,-84.43'])])
+        self.assertIsNone(self.con.execute('SELECT place_name FROM airport;').fetchone()[0])
+
+    def test_index_from_db(self):
+        path = os.path.join(self.dir.name, 'db.sqlite3')
+        con = sqlite3.connect(path, isolation_level=None)
+        self.populate.load(con, [self.airports_file('a.txt', ['LAX;33.94,-118.41', 'ATL;33.64,-84.43'])])
+        con.close()
+        index = AirportIndex.from_db(path)
+        self.assertEqual(['LAX', 'ATL'], [airport.code for airport in index.airports])
+        self.assertEqual('ATL', index.nearest((33.7, -84.4))[0][0].code)
+
+
+class GasRegionsTest(SimpleTestCase):
+    CITIES = {
+        'california': [(37.77, -122.42), (34.05, -118.24), (32.72, -117.16), (38.58, -121.49)],
+        'west_coast': [(47.61, -122.33), (45.52, -122.68), (36.17, -115.14), (33.45, -112.07), (61.22, -149.9),
+                       (21.31, -157.86)],
+        'rocky_mountain': [(39.74, -104.99), (40.76, -111.89), (43.62, -116.2), (46.87, -113.99)],
+        # Houston, Dallas, El Paso, Albuquerque, Las Cruces, Midland, Presidio, Amarillo, New Orleans, Birmingham
+        'gulf_coast': [(29.76, -95.37), (32.78, -96.8), (31.76, -106.49), (35.08, -106.65), (32.32, -106.76),
+                       (31.99, -102.08), (29.56, -104.37), (35.22, -101.83), (29.95, -90.07), (33.52, -86.8)],
+        # Key West, Miami, Tampa, Atlanta, Charleston, Washington, New York, Boston, Pittsburgh
+        'east_coast': [(24.55, -81.78), (25.76, -80.19), (27.95, -82.46), (33.75, -84.39), (32.78, -79.93),
+                       (38.9, -77.04), (40.71, -74.0), (42.36, -71.06), (40.44, -79.99)],
+        # Chicago, Kansas City, Oklahoma City, Nashville, Memphis, Detroit, Minneapolis, Chattanooga
+        'midwest': [(41.88, -87.63), (39.1, -94.58), (35.47, -97.52), (36.15, -86.78), (35.15, -90.05),
+                    (42.33, -83.05), (44.98, -93.27), (35.05, -85.31)],
+        # Toronto, Mexico City, London
+        'us': [(43.65, -79.38), (19.43, -99.13), (51.51, -0.13)],
+    }
+
+    def test_cities(self):
+        for region, cities in self.CITIES.items():
+            for coords in cities:
+                self.assertEqual(region, region_for(coords), coords)
+
+
+class FlakyEIA:
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def get_region_price(self, region):
+        self.calls += 1
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('EIA is down')
+        return 3.5, '20240902'
+
+
+class GasPriceStoreTest(SimpleTestCase):
+    def test_prices_by_region(self):
+        store = GasPriceStore(FlakyEIA(0))
+        self.assertEqual(DEFAULT_GAS_PRICE, store.price_for((41.88, -87.63)))
+        self.assertTrue(store.refresh())
+        self.assertEqual(3.5, store.price_for((41.88, -87.63)))
+        store.prices = {'us': 3.1}
+        self.assertEqual(3.1, store.price_for((41.88, -87.63)))
+
+    def test_failed_refresh_isnt_a_refresh(self):
+        eia = FlakyEIA(100)
+        store = GasPriceStore(eia)
+        with self.assertLogs('rest_api.services.gas_price_store', 'WARNING'):
+            self.assertFalse(store.refresh())
+        self.assertIsNone(store.refreshed_at)
+        self.assertEqual(DEFAULT_GAS_PRICE, store.national_price())
+
+    def test_refresher_retries_failures_soon(self):
+        eia = FlakyEIA(len(EIAGateway.region_series))
+        store = GasPriceStore(eia)
+        store.RETRY_SECONDS = 0.05
+        with self.assertLogs('rest_api.services.gas_price_store', 'WARNING'):
+            store.start_refreshing(60 * 60)
+            try:
+                give_up_at = time.monotonic() + 5
+                while store.refreshed_at is None and time.monotonic() < give_up_at:
+                    time.sleep(0.01)
+            finally:
+                store.stop_refreshing()
+        self.assertEqual(3.5, store.national_price())
+
+    def test_prices_shared_through_the_cache(self):
+        cache = TieredCache()
+        GasPriceStore(FlakyEIA(0), cache).refresh()
+        eia = FlakyEIA(0)
+        store = GasPriceStore(eia, cache)
+        self.assertEqual(3.5, store.price_for((29.76, -95.37)))
+        self.assertIsNotNone(store.refreshed_at)
+        self.assertEqual(0, eia.calls)
@@ -8,5 +8,11 @@ urlpatterns = [
     path('api/', include(router.urls)),
     path('api-auth/', include('rest_framework.urls', namespace='rest_framework')),
     # path('api/buoy_reads/<int:buoy_id>', views.BuoyReadingViewSet.ListBuoyReadings.as_view()),
-    path('api/calculate', views.calculate_trip)
+    path('api/calculate', views.calculate_trip),
+    path('api/async/calculate', views.calculate_trip_async),
+    path('api/calculate/matrix', views.calculate_trip_matrix),
+    path('api/calculate/itinerary', views.calculate_itinerary),
+    path('api/jobs', views.submit_job),
+    path('api/jobs/<str:job_id>', views.get_job),
+    path('metrics', views.metrics)
 ]
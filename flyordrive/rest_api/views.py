@@ -1,8 +1,14 @@
-from django.http import HttpResponse
+from django.http import (HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed, HttpResponseNotFound,
+                         StreamingHttpResponse)
 import json
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
-from .services.trip_calculator_service import TripCalculatorService
+from .jobs import get_job_runner
+from .metrics import registry
+from .rate_limit import BULK, iterate_in_lane
+from .serialization import dumps, dumps_line
+from .services.async_trip_calculator_service import get_async_trip_calculator_service
+from .services.trip_calculator_service import get_trip_calculator_service
 
 # TODO hack
 @csrf_exempt
@@ -11,6 +17,106 @@ def calculate_trip(request):
     data = json.loads(request.body)
     origin = data.get('origin', None)
     destination = data.get('destination', None)
-    # TODO dont create a new instance each request...
-    response = json.dumps(TripCalculatorService().calculate_trip(origin, destination))
+    response = dumps(get_trip_calculator_service().calculate_trip(origin, destination))
     return HttpResponse(response, content_type='application/json')
+
+
+async def calculate_trip_async(request):
+    """
+    Same as calculate_trip, but doesn't tie up a worker thread while waiting on upstreams when served over ASGI
+    """
+    # django's csrf_exempt and require_http_methods don't understand coroutine views yet
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    data = json.loads(request.body)
+    origin = data.get('origin', None)
+    destination = data.get('destination', None)
+    response = dumps(await get_async_trip_calculator_service().calculate_trip(origin, destination))
+    return HttpResponse(response, content_type='application/json')
+
+
+calculate_trip_async.csrf_exempt = True
+
+
+@csrf_exempt
+@require_http_methods(['POST'])
+def calculate_trip_matrix(request):
+    """
+    Body is {"origins": [...], "destinations": [...]} plus the optional trip parameters,
+    and "columnar": true for each row's trips as columns rather than a list (see domain.TripColumns).
+    Responds with newline delimited json, one line per origin as soon as its row is done.
+    Matrices are bulk work, single trips get the upstream rate limits first
+    """
+    data = json.loads(request.body)
+    origins = data.get('origins', None)
+    destinations = data.get('destinations', None)
+    if not origins or not destinations:
+        return HttpResponseBadRequest('origins and destinations must be non-empty lists')
+
+    kwargs = {k: data[k] for k in ('max_one_day_driving_minutes', 'car_mpg', 'columnar') if k in data}
+    rows = iterate_in_lane(BULK, get_trip_calculator_service().calculate_matrix(origins, destinations, **kwargs))
+    return StreamingHttpResponse((dumps_line(row) for row in rows), content_type='application/x-ndjson')
+
+
+@csrf_exempt
+@require_http_methods(['POST'])
+def calculate_itinerary(request):
+    """
+    Body is {"stops": [...], "round_trip": true/false} plus the optional trip parameters,
+    see TripCalculatorService.calculate_itinerary
+    """
+    data = json.loads(request.body)
+    stops = data.get('stops', None)
+    if not stops or len(stops) < 2:
+        return HttpResponseBadRequest('stops must be a list of at least two places')
+
+    kwargs = {k: data[k] for k in ('max_one_day_driving_minutes', 'car_mpg') if k in data}
+    response = dumps(get_trip_calculator_service().calculate_itinerary(stops, bool(data.get('round_trip')), **kwargs))
+    return HttpResponse(response, content_type='application/json')
+
+
+@csrf_exempt
+@require_http_methods(['POST'])
+def submit_job(request):
+    """
+    Body is a calculate_trip body ({"origin", "destination"}), a matrix body ({"origins", "destinations"})
+    or an itinerary body ({"stops", "round_trip"}), plus the optional trip parameters.
+    Responds 202 straight away with the job id to poll
+    """
+    data = json.loads(request.body)
+    kwargs = {k: data[k] for k in ('max_one_day_driving_minutes', 'car_mpg') if k in data}
+    if data.get('stops') and len(data['stops']) >= 2:
+        job_id = get_job_runner().submit_itinerary(data['stops'], bool(data.get('round_trip')), **kwargs)
+    elif data.get('origins') and data.get('destinations'):
+        if 'columnar' in data:
+            kwargs['columnar'] = data['columnar']
+        job_id = get_job_runner().submit_matrix(data['origins'], data['destinations'], **kwargs)
+    elif data.get('origin') and data.get('destination'):
+        job_id = get_job_runner().submit_trip(data['origin'], data['destination'], **kwargs)
+    else:
+        return HttpResponseBadRequest('expected origin and destination, origins and destinations, or stops')
+
+    response = HttpResponse(dumps({'id': job_id, 'status': 'queued'}), content_type='application/json', status=202)
+    response['Location'] = f'/api/jobs/{job_id}'
+    return response
+
+
+@require_http_methods(['GET'])
+def get_job(request, job_id):
+    """
+    The job's status, the legs (or matrix rows, or itinerary legs) finished so far under partial,
+    and once it's done the same result calculate_trip (or the matrix rows, or calculate_itinerary) would have returned
+    """
+    job = get_job_runner().store.get(job_id)
+    if job is None:
+        return HttpResponseNotFound('no such job')
+    return HttpResponse(dumps(job), content_type='application/json')
+
+
+@require_http_methods(['GET'])
+def metrics(request):
+    """
+    Prometheus text format: upstream call counts and latencies, per stage latencies,
+    upstream calls per trip, and response cache hit rates
+    """
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4')
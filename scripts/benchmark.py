@@ -0,0 +1,181 @@
+"""
+Benchmark the trip calculator without spending any API quota. Run from the repo root:
+
+    python scripts/benchmark.py                      # everything
+    python scripts/benchmark.py single --trips 50
+    python scripts/benchmark.py bulk --size 8 --clients 16
+    python scripts/benchmark.py nearest --sizes 1000 10000 100000
+
+Upstreams are the synthetic stub gateways with 50ms of injected latency per call unless
+FLYORDRIVE_GATEWAY_MODE / FLYORDRIVE_GATEWAY_LATENCY_MS say otherwise, e.g. replay recorded fixtures with
+FLYORDRIVE_GATEWAY_MODE=replay (record them by running the server once with FLYORDRIVE_GATEWAY_MODE=record).
+Caches are in memory only, and "cold" runs start every trip with an empty cache
+"""
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import math
+import os
+import random
+import statistics
+import sys
+import time
+
+os.environ.setdefault('FLYORDRIVE_GATEWAY_MODE', 'stub')
+os.environ.setdefault('FLYORDRIVE_GATEWAY_LATENCY_MS', '50')
+os.environ.setdefault('FLYORDRIVE_CACHE_DB', '')
+os.environ.setdefault('FLYORDRIVE_FARE_HISTORY_DB', '')
+os.environ.setdefault('FLYORDRIVE_GAS_REFRESH_SECONDS', '0')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'flyordrive'))
+
+from rest_api.cache import TieredCache  # noqa: E402
+from rest_api.services.airport_index import AirportIndex, get_airport_index  # noqa: E402
+from rest_api.services.async_trip_calculator_service import AsyncTripCalculatorService  # noqa: E402
+from rest_api.services.domain import Airport  # noqa: E402
+from rest_api.services.gas_price_store import get_gas_price_store  # noqa: E402
+from rest_api.services.trip_calculator_service import TripCalculatorService  # noqa: E402
+
+AIRPORT_FILES = ['flyordrive/major_airport_locations.txt', 'flyordrive/airport_locs.txt']
+CITIES = [
+    'San Francisco, CA', 'Los Angeles, CA', 'Seattle, WA', 'Denver, CO', 'Austin, TX', 'Chicago, IL',
+    'Nashville, TN', 'Atlanta, GA', 'Miami, FL', 'New York, NY', 'Boston, MA', 'Minneapolis, MN',
+]
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def report(label, seconds):
+    print(f"  {label:<28} n={len(seconds):<5} mean={statistics.mean(seconds) * 1000:8.1f}ms "
+          f"p50={percentile(seconds, 50) * 1000:8.1f}ms p95={percentile(seconds, 95) * 1000:8.1f}ms "
+          f"max={max(seconds) * 1000:8.1f}ms")
+
+
+def city_pairs(n, seed=0):
+    rng = random.Random(seed)
+    return [tuple(rng.sample(CITIES, 2)) for _ in range(n)]
+
+
+def cold(service):
+    # fresh caches, so every upstream call in the trip is actually made
+    service.gdm.cache = TieredCache()
+    service.sky.cache = TieredCache()
+    service.hotels.cache = TieredCache()
+    if hasattr(service, 'results'):
+        service.results = TieredCache()
+    return service
+
+
+def time_calls(fn, args_list):
+    seconds = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def bench_single(args):
+    print(f"single trip latency, {args.trips} trips")
+    pairs = city_pairs(args.trips)
+    for label, concurrent in (('sequential', False), ('concurrent', True)):
+        service = TripCalculatorService(concurrent=concurrent)
+        report(f'{label} cold', time_calls(lambda o, d: cold(service).calculate_trip(o, d), pairs))
+        time_calls(service.calculate_trip, pairs)
+        report(f'{label} warm', time_calls(service.calculate_trip, pairs))
+
+    loop = asyncio.new_event_loop()
+    try:
+        service = AsyncTripCalculatorService()
+        report('async cold', time_calls(lambda o, d: loop.run_until_complete(cold(service).calculate_trip(o, d)), pairs))
+        time_calls(lambda o, d: loop.run_until_complete(service.calculate_trip(o, d)), pairs)
+        report('async warm', time_calls(lambda o, d: loop.run_until_complete(service.calculate_trip(o, d)), pairs))
+    finally:
+        loop.close()
+
+
+def bench_bulk(args):
+    places = CITIES + [f'Town {i}' for i in range(max(0, args.size - len(CITIES)))]
+    origins = places[:args.size]
+    destinations = list(reversed(places))[:args.size]
+    print(f"bulk throughput, {len(origins)}x{len(destinations)} matrix and {args.clients} concurrent clients")
+
+    service = cold(TripCalculatorService())
+    start = time.perf_counter()
+    trips = sum(len(row['trips']) for row in service.calculate_matrix(origins, destinations))
+    elapsed = time.perf_counter() - start
+    print(f"  {'matrix':<28} {trips} trips in {elapsed:.2f}s, {trips / elapsed:.1f} trips/s")
+
+    service = cold(TripCalculatorService())
+    pairs = [(o, d) for o in origins for d in destinations if o != d]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as clients:
+        seconds = list(clients.map(lambda pair: time_calls(service.calculate_trip, [pair])[0], pairs))
+    elapsed = time.perf_counter() - start
+    print(f"  {'independent trips':<28} {len(pairs)} trips in {elapsed:.2f}s, {len(pairs) / elapsed:.1f} trips/s")
+    report('per trip', seconds)
+
+
+def synthetic_index(size, seed=0):
+    # uniform over the sphere, a worst case compared to real airports clustering around cities
+    rng = random.Random(seed)
+    airports = []
+    for rank in range(size):
+        lat = math.degrees(math.asin(rng.uniform(-1, 1)))
+        airports.append(Airport(f'S{rank}', lat, rng.uniform(-180, 180), rank))
+    return AirportIndex(airports)
+
+
+def bench_nearest(args):
+    rng = random.Random(1)
+    queries = [(rng.uniform(25, 49), rng.uniform(-124, -67)) for _ in range(args.queries)]
+    print(f"nearest airport lookup, k=3, {len(queries)} query points")
+
+    indexes = [(path, lambda path=path: AirportIndex.from_file(path)) for path in AIRPORT_FILES if os.path.exists(path)]
+    indexes += [(f'synthetic {size}', lambda size=size: synthetic_index(size)) for size in args.sizes]
+    for label, build in indexes:
+        start = time.perf_counter()
+        index = build()
+        built = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for coords in queries:
+            index.nearest(coords, k=3)
+        tree = (time.perf_counter() - start) / len(queries)
+
+        start = time.perf_counter()
+        index.nearest_many(queries, k=3)
+        batched = (time.perf_counter() - start) / len(queries)
+
+        print(f"  {label:<42} airports={len(index):<7} build={built * 1000:8.1f}ms "
+              f"k-d tree={tree * 1e6:8.1f}us/query batched={batched * 1e6:8.1f}us/query")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmarks', nargs='*', help='any of single, bulk, nearest (default all)')
+    parser.add_argument('--trips', type=int, default=30, help='trips per single trip run')
+    parser.add_argument('--size', type=int, default=6, help='origins (and destinations) in the bulk matrix')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent clients for bulk independent trips')
+    parser.add_argument('--queries', type=int, default=1000, help='query points for nearest airport lookup')
+    parser.add_argument('--sizes', type=int, nargs='*', default=[1000, 10000, 100000],
+                        help='synthetic airport table sizes for nearest airport lookup')
+    args = parser.parse_args()
+    benchmarks = {'single': bench_single, 'bulk': bench_bulk, 'nearest': bench_nearest}
+    unknown = set(args.benchmarks) - set(benchmarks)
+    if unknown:
+        parser.error(f"unknown benchmarks {sorted(unknown)}, pick from {sorted(benchmarks)}")
+
+    print(f"gateways: {os.environ['FLYORDRIVE_GATEWAY_MODE']}, "
+          f"{os.environ['FLYORDRIVE_GATEWAY_LATENCY_MS']}ms injected latency, "
+          f"{len(get_airport_index())} airports in the service index")
+    get_gas_price_store().refresh()
+
+    for name in args.benchmarks or benchmarks:
+        benchmarks[name](args)
+
+
+if __name__ == '__main__':
+    main()
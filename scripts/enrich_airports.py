@@ -0,0 +1,29 @@
+"""
+Reverse geocode every airport once and store the result, so trip calculations can route
+to airports without any geocoding calls of their own. Run after populate_sqlite.py, from the repo root.
+Only airports that haven't been enriched yet are looked up, so it's safe to re-run.
+"""
+import os
+import sqlite3
+
+import googlemaps
+
+con = sqlite3.connect('flyordrive/db.sqlite3')
+cur = con.cursor()
+gmaps = googlemaps.Client(key=os.environ['GOOGLE_API_KEY'])
+
+rows = cur.execute("""SELECT id, aita_code, lat, lng FROM airport
+                      WHERE place_id IS NULL
+                      ORDER BY popularity_rank;""").fetchall()
+for airport_id, code, lat, lng in rows:
+    try:
+        result = gmaps.reverse_geocode((lat, lng))[0]
+    except (googlemaps.exceptions.ApiError, IndexError) as e:
+        print(f"Skipping {code}: {e!r}")
+        continue
+    place_name = result['address_components'][0]['long_name']
+    print(f"{code} -> {place_name}")
+    cur.execute("UPDATE airport SET place_name = ?, place_id = ? WHERE id = ?;",
+                (place_name, result['place_id'], airport_id))
+    # commit as we go so an interrupted run keeps its progress
+    con.commit()
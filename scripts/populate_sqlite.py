@@ -1,17 +1,187 @@
+"""
+Load `CODE;lat,lng` airport lists into the sqlite db, then write the airport index snapshot the service
+starts from. Run from the repo root:
+
+    python scripts/populate_sqlite.py                                    # the bundled major airports
+    python scripts/populate_sqlite.py flyordrive/major_airport_locations.txt flyordrive/airport_locs.txt
+    python scripts/populate_sqlite.py --append more_airports.txt         # add to what's already there
+
+Files are read a line at a time and written in batches inside a single transaction, so big lists load in seconds.
+Each list is taken to be in descending popularity order, and earlier files rank above later ones.
+Loading upserts: airports already in the db get the new position (or keep theirs with --append) and coordinates,
+but keep what scripts/enrich_airports.py looked up for them unless they've moved. Airports a full load doesn't list
+are kept too, ranked after the ones it does in the order they were in.
+Lines without coordinates (like airport_codes.txt) are skipped
+"""
+import argparse
+import os
 import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'flyordrive'))
+
+from rest_api.services.airport_index import AirportIndex  # noqa: E402
+
+DEFAULT_DB_PATH = 'flyordrive/db.sqlite3'
+DEFAULT_AIRPORTS_FILE = 'flyordrive/major_airport_locations.txt'
+DEFAULT_SNAPSHOT_PATH = 'flyordrive/airport_index.npz'
+BATCH_SIZE = 10000
+
+# built after the rows are in, keeping them up to date row by row is most of the cost of a big load.
+# codes are indexed by their UNIQUE constraint, the upserts need that one throughout
+INDEXES = {
+    'airport_popularity_rank': 'CREATE INDEX airport_popularity_rank ON airport (popularity_rank);',
+    'airport_lat_lng': 'CREATE INDEX airport_lat_lng ON airport (lat, lng);',
+}
+
+UPSERT = """INSERT INTO airport (aita_code, lat, lng, popularity_rank) VALUES (?, ?, ?, ?)
+            ON CONFLICT (aita_code) DO UPDATE SET
+                lat = excluded.lat,
+                lng = excluded.lng,
+                popularity_rank = {rank},
+                -- a moved airport needs looking up again
+                place_name = CASE WHEN lat = excluded.lat AND lng = excluded.lng THEN place_name END,
+                place_id = CASE WHEN lat = excluded.lat AND lng = excluded.lng THEN place_id END;"""
+
+
+def create_table(cur):
+    columns = [row[1] for row in cur.execute("PRAGMA table_info(airport);")]
+    if columns and 'popularity_rank' not in columns:
+        # db from before lat/lng were typed, keep the rows but rebuild the table
+        print("Migrating old airport table")
+        cur.execute("ALTER TABLE airport RENAME TO airport_old;")
+
+    cur.execute("""CREATE TABLE IF NOT EXISTS airport
+                    (id INTEGER NOT NULL PRIMARY KEY,
+                     aita_code TEXT NOT NULL UNIQUE,
+                     lat REAL NOT NULL,
+                     lng REAL NOT NULL,
+                     popularity_rank INTEGER NOT NULL,
+                     place_name TEXT,
+                     place_id TEXT);""")
+
+    if columns and 'popularity_rank' not in columns:
+        cur.execute("""INSERT OR IGNORE INTO airport (id, aita_code, lat, lng, popularity_rank)
+                       SELECT id, aita_code, CAST(lat AS REAL), CAST(lng AS REAL), id FROM airport_old;""")
+        cur.execute("DROP TABLE airport_old;")
+
+
+def read_airports(paths, first_rank, skipped):
+    """
+    Stream (code, lat, lng, rank) out of the files. An airport listed more than once keeps its first
+    (most popular) position
+
+    :param skipped: dict to count the lines that aren't airports in, by file
+    """
+    seen = set()
+    rank = first_rank
+    for path in paths:
+        skipped[path] = 0
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    code, coords = line.strip().split(';')
+                    lat, lng = coords.split(',')
+                    lat, lng = float(lat), float(lng)
+                except ValueError:
+                    if line.strip():
+                        skipped[path] += 1
+                    continue
+                if not code or not (-90 <= lat <= 90 and -180 <= lng <= 180):
+                    skipped[path] += 1
+                    continue
+                if code in seen:
+                    continue
+                seen.add(code)
+                yield code, lat, lng, rank
+                rank += 1
+
+
+def batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def load(con, paths, append=False, batch_size=BATCH_SIZE):
+    """
+    :return: (rows written, {path: lines skipped})
+    """
+    cur = con.cursor()
+    skipped = {}
+    written = 0
+    cur.execute("BEGIN;")
+    try:
+        create_table(cur)
+        for name in INDEXES:
+            cur.execute(f"DROP INDEX IF EXISTS {name};")
+        first_rank = 1
+        if append:
+            first_rank = cur.execute("SELECT COALESCE(MAX(popularity_rank), 0) + 1 FROM airport;").fetchone()[0]
+        else:
+            # every airport the files list gets a new rank, so whatever's still negative afterwards wasn't listed
+            cur.execute("UPDATE airport SET popularity_rank = -popularity_rank;")
+        upsert = UPSERT.format(rank='popularity_rank' if append else 'excluded.popularity_rank')
+        for batch in batches(read_airports(paths, first_rank, skipped), batch_size):
+            cur.executemany(upsert, batch)
+            written += len(batch)
+        if not append:
+            last_rank = cur.execute("SELECT COALESCE(MAX(popularity_rank), 0) FROM airport;").fetchone()[0]
+            cur.execute("UPDATE airport SET popularity_rank = ? - popularity_rank WHERE popularity_rank <= 0;",
+                        (last_rank,))
+        for sql in INDEXES.values():
+            cur.execute(sql)
+        cur.execute("COMMIT;")
+    except BaseException:
+        cur.execute("ROLLBACK;")
+        raise
+    return written, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load airport lists into the sqlite db and snapshot the airport index")
+    parser.add_argument('files', nargs='*', default=[DEFAULT_AIRPORTS_FILE],
+                        help="`CODE;lat,lng` files, most popular airport first")
+    parser.add_argument('--db', default=DEFAULT_DB_PATH)
+    parser.add_argument('--append', action='store_true',
+                        help="rank the new airports after the ones already loaded, and leave those where they are")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--snapshot', default=DEFAULT_SNAPSHOT_PATH,
+                        help="where to write the airport index snapshot the service loads at startup")
+    parser.add_argument('--no-snapshot', action='store_true')
+    parser.add_argument('--snapshot-only', action='store_true',
+                        help="don't load anything, only rewrite the snapshot, e.g. after enrich_airports.py")
+    args = parser.parse_args()
+
+    # autocommit mode, load manages its own transaction
+    con = sqlite3.connect(args.db, isolation_level=None)
+    try:
+        if not args.snapshot_only:
+            # a failed load rolls back anyway, no need to sync every page on the way
+            con.execute("PRAGMA synchronous = OFF;")
+            con.execute("PRAGMA cache_size = -65536;")
+            start = time.perf_counter()
+            written, skipped = load(con, args.files, args.append, args.batch_size)
+            for path, count in skipped.items():
+                if count:
+                    print(f"Skipped {count} lines without a code and valid coordinates in {path}")
+            total = con.execute("SELECT COUNT(*) FROM airport;").fetchone()[0]
+            print(f"Loaded {written} airports in {time.perf_counter() - start:.2f}s, {total} in {args.db}")
+    finally:
+        con.close()
+
+    if not args.no_snapshot:
+        start = time.perf_counter()
+        index = AirportIndex.from_db(args.db)
+        index.save(args.snapshot)
+        print(f"Wrote the index of {len(index)} airports to {args.snapshot} in {time.perf_counter() - start:.2f}s")
+
 
-con = sqlite3.connect('flyordrive/db.sqlite3')
-cur = con.cursor()
-
-cur.execute("""CREATE TABLE IF NOT EXISTS airport 
-                (id INTEGER NOT NULL PRIMARY KEY, aita_code text, lat text, lng text);""")
-
-with open('flyordrive/major_airport_locations.txt', 'r') as f:
-    lines = f.readlines()
-    for line in lines:
-        code,coords = line.split(';')
-        lat,lng = coords.split(',')
-        print(f"Inserting {code}")
-        cur.execute(f"""INSERT INTO airport (aita_code, lat, lng) 
-                        VALUES ('{code}', '{lat}', '{lng}');""")
-    con.commit()
+if __name__ == '__main__':
+    main()